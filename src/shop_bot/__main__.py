@@ -3,6 +3,7 @@ import threading
 import asyncio
 import signal
 import re
+from concurrent.futures import ThreadPoolExecutor
 try:
 
     import colorama
@@ -15,6 +16,8 @@ from shop_bot.webhook_server import app as webhook_app
 from shop_bot.data_manager.scheduler import periodic_subscription_check
 from shop_bot.data_manager import remnawave_repository as rw_repo
 from shop_bot.bot_controller import BotController
+from shop_bot.bot import handlers
+from shop_bot.modules import remnawave_api
 
 def main():
     if colorama_available:
@@ -116,6 +119,14 @@ def main():
         if bot_controller.get_status()["is_running"]:
             bot_controller.stop()
             await asyncio.sleep(2)
+        try:
+            await remnawave_api.close_shared_clients()
+        except Exception:
+            logger.warning("Не удалось закрыть HTTP-клиенты Remnawave", exc_info=True)
+        try:
+            await handlers.close_http_session()
+        except Exception:
+            logger.warning("Не удалось закрыть HTTP-сессию платёжных API", exc_info=True)
         tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
         if tasks:
             [task.cancel() for task in tasks]
@@ -124,7 +135,10 @@ def main():
 
     async def start_services():
         loop = asyncio.get_running_loop()
+        # Пул для синхронных вызовов БД из хендлеров (asyncio.to_thread)
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=16, thread_name_prefix="db"))
         bot_controller.set_loop(loop)
+        handlers.set_app_loop(loop)
         flask_app.config['EVENT_LOOP'] = loop
         try:
             webhook_app._support_bot_controller.set_loop(loop)
@@ -2,6 +2,14 @@ import logging
 import os
 import uuid
 import qrcode
+try:
+    import segno
+except ImportError:
+    segno = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
 import aiohttp
 import re
 import hashlib
@@ -14,13 +22,15 @@ from html import escape as html_escape
 
 from urllib.parse import urlencode
 from hmac import compare_digest
-from functools import wraps
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from functools import lru_cache, wraps
 from io import BytesIO
 from yookassa import Payment, Configuration
 from datetime import datetime, timedelta, timezone
 from aiosend import CryptoPay, TESTNET
-from decimal import Decimal, ROUND_HALF_UP
-from typing import Dict
+from decimal import Context, Decimal, ROUND_HALF_UP, localcontext
+from typing import Dict, Final
 
 from pytonconnect import TonConnect
 from .callback_safety import fast_callback_answer, catch_callback_errors, handle_unknown_callback
@@ -29,7 +39,9 @@ from aiogram.types import BufferedInputFile, LabeledPrice, PreCheckoutQuery
 from aiogram.filters import Command, CommandObject, CommandStart, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.enums import ChatMemberStatus
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.default import DefaultBotProperties
+from aiogram.enums import ChatMemberStatus, ParseMode
 from aiogram.exceptions import TelegramBadRequest
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from shop_bot.bot import keyboards
@@ -37,11 +49,15 @@ from shop_bot.data_manager.remnawave_repository import (
     add_to_balance,
     deduct_from_balance,
     get_setting,
+    get_setting_cached,
+    get_settings_generation,
     get_user,
     register_user_if_not_exists,
     get_next_key_number,
     create_payload_pending,
+    update_pending_metadata,
     claim_processed_payment,
+    is_payment_processed,
     get_pending_status,
     get_pending_metadata,
     find_and_complete_pending_transaction,
@@ -49,11 +65,12 @@ from shop_bot.data_manager.remnawave_repository import (
     get_balance,
     get_referral_count,
     get_plan_by_id,
-    get_all_hosts,
+    get_all_hosts_cached,
     get_plans_for_host,
-    get_active_plans_for_host,
+    get_active_plans_for_host_cached,
     redeem_promo_code,
     check_promo_code_available,
+    check_promo_code_available_cached,
     update_promo_code_status,
     record_key_from_payload,
     add_to_referral_balance_all,
@@ -61,7 +78,6 @@ from shop_bot.data_manager.remnawave_repository import (
     get_referral_balance,
     get_referral_top_rich,
     get_referral_rank_and_count,
-    get_all_users,
     set_terms_agreed,
     set_referral_start_bonus_received,
     set_referral_trial_day_bonus_received,
@@ -99,41 +115,181 @@ from shop_bot.data_manager.database import get_franchise_min_withdraw, get_franc
 TELEGRAM_BOT_USERNAME = None
 PAYMENT_METHODS = None
 
+# Decimal-константы денежных расчётов (Decimal неизменяем, парсить строку на каждый вызов незачем)
+_D_ZERO: Final = Decimal("0")
+_D_CENT: Final = Decimal("0.01")
+# Сумма в TON — до тысячных; 12 значащих цифр для пересчёта курса с запасом
+_D_TON_QUANT: Final = Decimal("0.001")
+_TON_CTX: Final = Context(prec=12, rounding=ROUND_HALF_UP)
+
+# Подписи к QR-коду TON Connect: меняется только сумма
+_TON_TOPUP_CAPTION_TMPL: Final = (
+    "💎 Оплата через TON Connect\n\n"
+    "Сумма к оплате: `%s` TON\n\n"
+    "Нажмите кнопку ниже, чтобы открыть кошелёк и подтвердить перевод."
+)
+_TON_CAPTION_TMPL: Final = (
+    "💎 **Оплата через TON Connect**\n\n"
+    "Сумма к оплате: `%s` **TON**\n\n"
+    "✅ **Способ 1 (на телефоне):** Нажмите кнопку **'Открыть кошелек'** ниже.\n"
+    "✅ **Способ 2 (на компьютере):** Отсканируйте QR-код кошельком.\n\n"
+    "После подключения кошелька подтвердите транзакцию."
+)
+
+@lru_cache(maxsize=64)
+def _setting_decimal(raw: str) -> Decimal:
+    """Decimal из строкового значения настройки; значения почти не меняются, парсим один раз."""
+    return Decimal(raw)
+
+
+@lru_cache(maxsize=64)
+def _setting_decimal_cents(raw: str) -> Decimal:
+    return Decimal(raw).quantize(_D_CENT)
+
+
+def _to_cents(value) -> int:
+    """Сумма в копейках для сравнения сумм платежей (без quantize и Decimal-контекста)."""
+    if isinstance(value, int):
+        return value * 100
+    if isinstance(value, float):
+        return int(round(value * 100))
+    return int(Decimal(str(value or "0")).scaleb(2).to_integral_value(ROUND_HALF_UP))
+
+
+# Пул UUID4: 64 идентификатора из одного чтения os.urandom вместо syscall на каждый платёж
+_UUID_POOL: deque[uuid.UUID] = deque()
+_UUID_BATCH = 64
+
+
+def _new_uuid() -> uuid.UUID:
+    try:
+        return _UUID_POOL.popleft()
+    except IndexError:
+        raw = os.urandom(16 * _UUID_BATCH)
+        _UUID_POOL.extend(uuid.UUID(bytes=raw[i:i + 16], version=4) for i in range(16, len(raw), 16))
+        return uuid.UUID(bytes=raw[:16], version=4)
+
+
+# Инвойсы CryptoBot, уже проведённые в этом процессе: повторные нажатия
+# «Проверить оплату» отвечают сразу, без запроса к API и БД.
+_PROCESSED_INVOICES: OrderedDict[int, float] = OrderedDict()
+_PROCESSED_INVOICES_TTL = 3600
+_PROCESSED_INVOICES_MAX = 8192
+
+
+def _invoice_processed(invoice_id: int) -> bool:
+    ts = _PROCESSED_INVOICES.get(invoice_id)
+    if ts is None:
+        return False
+    if time.monotonic() - ts > _PROCESSED_INVOICES_TTL:
+        _PROCESSED_INVOICES.pop(invoice_id, None)
+        return False
+    return True
+
+
+def _mark_invoice_processed(invoice_id: int) -> None:
+    _PROCESSED_INVOICES[invoice_id] = time.monotonic()
+    _PROCESSED_INVOICES.move_to_end(invoice_id)
+    while len(_PROCESSED_INVOICES) > _PROCESSED_INVOICES_MAX:
+        _PROCESSED_INVOICES.popitem(last=False)
+
+
+# payment_id, которые этот процесс успешно занял через claim_processed_payment: повторные
+# вебхуки отсекаются без обращения к БД (сама БД остаётся источником истины)
+_RECENT_PAYMENTS: OrderedDict[str, None] = OrderedDict()
+_RECENT_PAYMENTS_MAX = 4096
+
+
+def _remember_payment(payment_id: str) -> None:
+    _RECENT_PAYMENTS[payment_id] = None
+    _RECENT_PAYMENTS.move_to_end(payment_id)
+    while len(_RECENT_PAYMENTS) > _RECENT_PAYMENTS_MAX:
+        _RECENT_PAYMENTS.popitem(last=False)
+
+
+def _invoice_amount_cents(inv: dict) -> int | None:
+    """Сумма инвойса CryptoBot в копейках; None, если сумму не удалось разобрать."""
+    try:
+        return _to_cents(inv.get("amount") or inv.get("fiat_amount") or inv.get("paid_amount"))
+    except Exception:
+        return None
+
+
+def _as_float(value, default: float = 0.0) -> float:
+    """float() для значений из БД: пустое/некорректное значение → default."""
+    try:
+        return float(value) if value else default
+    except (TypeError, ValueError):
+        return default
+
+
+def _as_int(value, default: int = 0) -> int:
+    try:
+        return int(value) if value else default
+    except (TypeError, ValueError):
+        return default
+
+
 def _is_true(value) -> bool:
     return str(value).strip().lower() in ('true','1','on','yes','y')
 
+
+def _settings_memo(ttl: float):
+    """Кеширует результат функции без аргументов, собранный из настроек.
+    Пересчёт — по истечении ttl или после любой записи настроек (update_setting)."""
+    def decorator(fn):
+        cached: list = []  # [(generation, monotonic ts, value)]
+
+        @wraps(fn)
+        def wrapper():
+            generation = get_settings_generation()
+            now = time.monotonic()
+            if cached:
+                gen, ts, value = cached[0]
+                if gen == generation and now - ts < ttl:
+                    return value
+            value = fn()
+            cached[:] = [(generation, now, value)]
+            return value
+
+        wrapper.cache_clear = cached.clear
+        return wrapper
+    return decorator
+
+
+@_settings_memo(ttl=30.0)
 def _get_payment_methods() -> dict:
     """Собирает доступные способы оплаты из актуальных настроек (без перезапуска бота)."""
-    yookassa_shop_id = get_setting('yookassa_shop_id')
-    yookassa_secret_key = get_setting('yookassa_secret_key')
+    yookassa_shop_id = get_setting_cached('yookassa_shop_id')
+    yookassa_secret_key = get_setting_cached('yookassa_secret_key')
     yookassa_enabled = bool(yookassa_shop_id and yookassa_secret_key)
 
-    cryptobot_token = get_setting('cryptobot_token')
+    cryptobot_token = get_setting_cached('cryptobot_token')
     cryptobot_enabled = bool(cryptobot_token)
 
-    heleket_shop_id = get_setting('heleket_merchant_id')
-    heleket_api_key = get_setting('heleket_api_key')
+    heleket_shop_id = get_setting_cached('heleket_merchant_id')
+    heleket_api_key = get_setting_cached('heleket_api_key')
     heleket_enabled = bool(heleket_shop_id and heleket_api_key)
 
-    platega_merchant_id = get_setting('platega_merchant_id')
-    platega_secret = get_setting('platega_secret')
+    platega_merchant_id = get_setting_cached('platega_merchant_id')
+    platega_secret = get_setting_cached('platega_secret')
     platega_enabled = bool(platega_merchant_id and platega_secret)
 
-    ton_wallet_address = get_setting('ton_wallet_address')
-    tonapi_key = get_setting('tonapi_key')
+    ton_wallet_address = get_setting_cached('ton_wallet_address')
+    tonapi_key = get_setting_cached('tonapi_key')
     tonconnect_enabled = bool(ton_wallet_address and tonapi_key)
 
-    yoomoney_raw = get_setting('yoomoney_enabled')
-    yoomoney_wallet = get_setting('yoomoney_wallet')
-    yoomoney_secret = get_setting('yoomoney_secret')
+    yoomoney_raw = get_setting_cached('yoomoney_enabled')
+    yoomoney_wallet = get_setting_cached('yoomoney_wallet')
+    yoomoney_secret = get_setting_cached('yoomoney_secret')
     if yoomoney_raw is None:
         yoomoney_enabled = bool(yoomoney_wallet and yoomoney_secret)
     else:
         yoomoney_enabled = _is_true(yoomoney_raw)
 
-    stars_flag = _is_true(get_setting('stars_enabled') or 'false')
+    stars_flag = _is_true(get_setting_cached('stars_enabled') or 'false')
     try:
-        stars_ratio = float(get_setting('stars_per_rub') or '0')
+        stars_ratio = float(get_setting_cached('stars_per_rub') or '0')
     except Exception:
         stars_ratio = 0.0
     stars_enabled = stars_flag and (stars_ratio > 0)
@@ -148,12 +304,288 @@ def _get_payment_methods() -> dict:
         'stars': stars_enabled,
     }
 
+
+def _referral_discount_percent(user_data: dict | None) -> Decimal:
+    """Скидка приглашённого пользователя на первую покупку, % (0 — если не положена)."""
+    if not user_data or not user_data.get('referred_by') or user_data.get('total_spent', 0) != 0:
+        return _D_ZERO
+    try:
+        return Decimal(str(get_setting_cached("referral_discount") or "0"))
+    except Exception:
+        return _D_ZERO
+
+
+def compute_final_price(plan: dict, user_data: dict | None, promo_code: str | None, promo_discount) -> Decimal:
+    """Цена тарифа с учётом реферальной скидки и уже посчитанной скидки промокода (не ниже 0.01)."""
+    price = Decimal(str(plan['price']))
+    percent = _referral_discount_percent(user_data)
+    if percent > 0:
+        price -= (price * percent / 100).quantize(_D_CENT)
+    promo_discount = Decimal(str(promo_discount or 0))
+    if promo_code and promo_discount > 0:
+        price = (price - promo_discount).quantize(_D_CENT)
+        if price < _D_CENT:
+            price = _D_CENT
+    return price
+
+
+def _final_price_from_state(data: dict, plan: dict, user_id: int) -> Decimal:
+    """Итоговая цена, посчитанная в show_payment_options; пересчёт — только для старых состояний FSM."""
+    stored = data.get('final_price_decimal')
+    if stored:
+        try:
+            return Decimal(stored)
+        except Exception:
+            pass
+    return compute_final_price(plan, get_user(user_id), data.get('promo_code'), data.get('promo_discount'))
+
+
+def _plan_payment_metadata(data: dict, plan: dict, *, user_id: int, price, payment_method: str, **extra) -> dict:
+    """Метаданные покупки тарифа из состояния FSM — общий набор полей для всех способов оплаты.
+    Остаются обычным dict: их читают через .get() и сериализуют в JSON для pending-записей."""
+    metadata = {
+        "user_id": user_id,
+        "months": int(plan.get('months') or 0),
+        "duration_days": int(plan.get('duration_days') or 0),
+        "price": float(price),
+        "action": data.get('action'),
+        "key_id": data.get('key_id'),
+        "host_name": data.get('host_name'),
+        "plan_id": data.get('plan_id'),
+        "customer_email": data.get('customer_email'),
+        "payment_method": payment_method,
+    }
+    metadata.update(extra)
+    return metadata
+
 ADMIN_ID = None
 CRYPTO_BOT_TOKEN = get_setting("cryptobot_token")
 
 PENDING_GIFTS: dict[int, dict] = {}
 logger = logging.getLogger(__name__)
 
+# (host_name, key_id) -> (monotonic ts, exists) — гасит повторные проверки ключа в Remnawave
+# при быстрых повторных нажатиях "Мои ключи"
+_KEY_EXISTS_CACHE: dict[tuple[str, str], tuple[float, bool]] = {}
+_KEY_EXISTS_TTL = 30.0
+_KEY_SYNC_PROBE_TIMEOUT = 5.0
+# Через сколько секунд показывать «⏳ Переношу ключ...» при смене сервера
+_SWITCH_PROGRESS_DELAY = 0.8
+# key_id -> (monotonic ts, host_name, connection_string): ссылка из последнего просмотра ключа,
+# чтобы «QR-код» сразу после «Показать ключ» не ходил в Remnawave повторно
+_CONN_STRING_CACHE: dict[int, tuple[float, str, str]] = {}
+_CONN_STRING_TTL = 300.0
+_CONN_STRING_CACHE_MAX = 10_000
+
+
+def _remember_connection_string(key_id: int, host_name: str | None, connection_string: str | None) -> None:
+    if not connection_string:
+        return
+    if len(_CONN_STRING_CACHE) >= _CONN_STRING_CACHE_MAX:
+        _CONN_STRING_CACHE.clear()
+    _CONN_STRING_CACHE[key_id] = (time.monotonic(), host_name or "", connection_string)
+
+
+def _cached_connection_string(key_data: dict) -> str | None:
+    """Ссылка из кеша, если она свежая и ключ с тех пор не переносился на другой хост."""
+    cached = _CONN_STRING_CACHE.get(key_data.get("key_id"))
+    if not cached:
+        return None
+    ts, host_name, connection_string = cached
+    if time.monotonic() - ts >= _CONN_STRING_TTL or host_name != (key_data.get("host_name") or ""):
+        return None
+    return connection_string
+
+# Ссылки на фоновые задачи, чтобы их не собрал GC до завершения
+_BACKGROUND_TASKS: set[asyncio.Task] = set()
+
+
+def _spawn_background(coro, *, name: str | None = None) -> asyncio.Task:
+    """Запускает корутину в фоне (fire-and-forget) и держит на неё ссылку до завершения."""
+    task = asyncio.create_task(coro, name=name)
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_BACKGROUND_TASKS.discard)
+    return task
+
+
+# Долгоживущий цикл приложения (задаётся при старте). Вебхук без запущенного бота
+# обрабатывает платёж во временном asyncio.run(), который отменяет незавершённые задачи
+_APP_LOOP: asyncio.AbstractEventLoop | None = None
+
+
+def set_app_loop(loop: asyncio.AbstractEventLoop) -> None:
+    global _APP_LOOP
+    _APP_LOOP = loop
+
+
+async def _run_detached_if_possible(coro, *, name: str | None = None) -> None:
+    """В цикле приложения уводит корутину в фон, во временном цикле — дожидается её."""
+    if _APP_LOOP is not None and asyncio.get_running_loop() is _APP_LOOP:
+        _spawn_background(coro, name=name)
+    else:
+        await coro
+
+
+async def _gather_quietly(*aws) -> None:
+    """Ждёт все корутины параллельно, проглатывая их исключения (для фоновых уведомлений)."""
+    await asyncio.gather(*aws, return_exceptions=True)
+
+
+async def _db(fn, *args, **kwargs):
+    """Синхронный вызов БД в пуле потоков, чтобы не блокировать цикл событий."""
+    return await asyncio.to_thread(fn, *args, **kwargs)
+
+
+async def _show_payment_placeholder(message: types.Message) -> None:
+    """Сразу показывает «⏳ Готовлю ссылку…», пока идут запросы к БД и платёжке."""
+    try:
+        await message.edit_text("⏳ Готовлю ссылку на оплату…")
+    except TelegramBadRequest:
+        pass
+
+
+def _json_loads(raw: bytes | str):
+    """Разбор JSON-ответа платёжного API: orjson, если установлен, иначе stdlib.
+    Пустое тело — None, как у aiohttp resp.json()."""
+    if not raw or not raw.strip():
+        return None
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def _json_dumps(obj) -> bytes:
+    """Тело JSON-запроса в байтах (для session.post(data=...))."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+# Общая HTTP-сессия для платёжных API: пул соединений и keep-alive вместо
+# нового TCP+TLS рукопожатия на каждый запрос
+_HTTP_SESSION: aiohttp.ClientSession | None = None
+
+
+def _get_http_session() -> aiohttp.ClientSession:
+    """Возвращает общую aiohttp-сессию, создавая её при первом обращении."""
+    global _HTTP_SESSION
+    if _HTTP_SESSION is None or _HTTP_SESSION.closed:
+        _HTTP_SESSION = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300),
+        )
+    return _HTTP_SESSION
+
+
+# Сессия Bot API для проверки токенов клонов: временный Bot живёт один запрос,
+# а соединение с api.telegram.org переиспользуется между проверками
+_TOKEN_CHECK_SESSION: AiohttpSession | None = None
+
+
+def _get_token_check_session() -> AiohttpSession:
+    global _TOKEN_CHECK_SESSION
+    if _TOKEN_CHECK_SESSION is None:
+        _TOKEN_CHECK_SESSION = AiohttpSession()
+    return _TOKEN_CHECK_SESSION
+
+
+# Экземпляры основного бота для уведомлений из клонов (по токену): один Bot
+# и его сессия живут весь процесс вместо нового TLS-соединения на каждое сообщение
+_ROOT_BOTS: dict[str, Bot] = {}
+_ROOT_BOT_DEFAULTS: Final = DefaultBotProperties(parse_mode=ParseMode.HTML)
+
+
+def _get_root_bot(token: str) -> Bot:
+    root_bot = _ROOT_BOTS.get(token)
+    if root_bot is None:
+        root_bot = Bot(token=token, default=_ROOT_BOT_DEFAULTS)
+        _ROOT_BOTS[token] = root_bot
+    return root_bot
+
+
+# Очередь уведомлений админу от основного бота (заявки на вывод из клонов):
+# один фоновый воркер отправляет их по порядку, хендлер только кладёт в очередь
+_ROOT_NOTIFY_QUEUE: asyncio.Queue | None = None
+_ROOT_NOTIFY_WORKER: asyncio.Task | None = None
+
+
+async def _root_notify_worker(queue: asyncio.Queue) -> None:
+    while True:
+        token, chat_id, text = await queue.get()
+        try:
+            await _get_root_bot(token).send_message(chat_id, text)
+        except Exception as e:
+            logger.warning(f"Root bot notification to {chat_id} failed: {e}")
+        finally:
+            queue.task_done()
+
+
+def _enqueue_root_notification(token: str, chat_id: int, text: str) -> None:
+    """Ставит сообщение от основного бота в очередь; воркер запускается при первом вызове."""
+    global _ROOT_NOTIFY_QUEUE, _ROOT_NOTIFY_WORKER
+    if _ROOT_NOTIFY_WORKER is None or _ROOT_NOTIFY_WORKER.done():
+        _ROOT_NOTIFY_QUEUE = asyncio.Queue()
+        _ROOT_NOTIFY_WORKER = asyncio.create_task(
+            _root_notify_worker(_ROOT_NOTIFY_QUEUE), name="root-notify-worker"
+        )
+    _ROOT_NOTIFY_QUEUE.put_nowait((token, chat_id, text))
+
+
+async def close_http_session() -> None:
+    """Закрывает общие HTTP-сессии (вызывается при остановке приложения)."""
+    global _HTTP_SESSION, _TOKEN_CHECK_SESSION, _ROOT_NOTIFY_WORKER
+    worker, _ROOT_NOTIFY_WORKER = _ROOT_NOTIFY_WORKER, None
+    if worker is not None:
+        worker.cancel()
+    session, _HTTP_SESSION = _HTTP_SESSION, None
+    if session is not None and not session.closed:
+        await session.close()
+    token_session, _TOKEN_CHECK_SESSION = _TOKEN_CHECK_SESSION, None
+    if token_session is not None:
+        await token_session.close()
+    root_bots = list(_ROOT_BOTS.values())
+    _ROOT_BOTS.clear()
+    for root_bot in root_bots:
+        try:
+            await root_bot.session.close()
+        except Exception:
+            pass
+
+
+# Даты ключей приходят из БД строками и повторяются от запроса к запросу — парсим один раз
+_parse_iso = lru_cache(maxsize=8192)(datetime.fromisoformat)
+# Банки и реквизиты партнёров повторяются из экрана в экран — экранируем один раз
+_html_escape_cached = lru_cache(maxsize=1024)(html_escape)
+# Нормализация дат вида "2025/01/02 10:00:00" к ISO; суффикс "Z" fromisoformat понимает сам (3.11+)
+_ISO_TRANSLATE: Final = str.maketrans({' ': 'T', '/': '-'})
+
+
+@lru_cache(maxsize=4096)
+def _parse_expire_ms(raw: str) -> int | None:
+    """Срок действия ключа из БД в миллисекундах epoch (наивные даты считаются UTC); None, если не разобрать."""
+    try:
+        dt = datetime.fromisoformat(raw.translate(_ISO_TRANSLATE))
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        return int(dt.timestamp() * 1000)
+    except (ValueError, OverflowError, OSError):
+        return None
+
+
+@lru_cache(maxsize=2048)
+def _render_qr(connection_string: str) -> bytes:
+    """PNG с QR-кодом ссылки или TON Connect URL (CPU-bound, вызывать через asyncio.to_thread).
+    Результат детерминирован, поэтому повторные запросы QR по той же ссылке берутся из кеша.
+    segno пишет PNG напрямую (без PIL) и заметно быстрее; qrcode — запасной вариант."""
+    bio = BytesIO()
+    if segno is not None:
+        segno.make_qr(connection_string, error="l").save(bio, kind="png", scale=6, border=2)
+        return bio.getvalue()
+    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_L, box_size=6, border=2)
+    qr.add_data(connection_string)
+    qr.make(fit=True)
+    qr.make_image().save(bio, "PNG")
+    return bio.getvalue()
+
 errors = {
     "A019": "username уже занят",
     "400": "неверные данные",
@@ -283,6 +715,115 @@ async def _handle_key_creation_failure(
         action_label=action_label,
     )
 
+# Тексты инструкций по умолчанию (если в настройках не задан свой вариант)
+_HOWTO_ANDROID_TEXT: Final[str] = (
+    "<b>Подключение на Android</b>\n\n"
+    "1. <b>Установите приложение V2RayTun:</b> Загрузите и установите приложение V2RayTun из Google Play Store.\n"
+    "2. <b>Скопируйте свой ключ (vless://)</b> Перейдите в раздел «Моя подписка» в нашем боте и скопируйте свой ключ.\n"
+    "3. <b>Импортируйте конфигурацию:</b>\n"
+    "   • Откройте V2RayTun.\n"
+    "   • Нажмите на значок + в правом нижнем углу.\n"
+    "   • Выберите «Импортировать конфигурацию из буфера обмена» (или аналогичный пункт).\n"
+    "4. <b>Выберите сервер:</b> Выберите появившийся сервер в списке.\n"
+    "5. <b>Подключитесь к VPN:</b> Нажмите на кнопку подключения (значок «V» или воспроизведения). Возможно, потребуется разрешение на создание VPN-подключения.\n"
+    "6. <b>Проверьте подключение:</b> После подключения проверьте свой IP-адрес, например, на https://whatismyipaddress.com/. Он должен отличаться от вашего реального IP."
+)
+_HOWTO_IOS_TEXT: Final[str] = (
+    "<b>Подключение на iOS (iPhone/iPad)</b>\n\n"
+    "1. <b>Установите приложение V2RayTun:</b> Загрузите и установите приложение V2RayTun из App Store.\n"
+    "2. <b>Скопируйте свой ключ (vless://):</b> Перейдите в раздел «Моя подписка» в нашем боте и скопируйте свой ключ.\n"
+    "3. <b>Импортируйте конфигурацию:</b>\n"
+    "   • Откройте V2RayTun.\n"
+    "   • Нажмите на значок +.\n"
+    "   • Выберите «Импортировать конфигурацию из буфера обмена» (или аналогичный пункт).\n"
+    "4. <b>Выберите сервер:</b> Выберите появившийся сервер в списке.\n"
+    "5. <b>Подключитесь к VPN:</b> Включите главный переключатель в V2RayTun. Возможно, потребуется разрешить создание VPN-подключения.\n"
+    "6. <b>Проверьте подключение:</b> После подключения проверьте свой IP-адрес, например, на https://whatismyipaddress.com/. Он должен отличаться от вашего реального IP."
+)
+_HOWTO_WINDOWS_TEXT: Final[str] = (
+    "<b>Подключение на Windows</b>\n\n"
+    "1. <b>Установите приложение Nekoray:</b> Загрузите Nekoray с https://github.com/MatsuriDayo/Nekoray/releases. Выберите подходящую версию (например, Nekoray-x64.exe).\n"
+    "2. <b>Распакуйте архив:</b> Распакуйте скачанный архив в удобное место.\n"
+    "3. <b>Запустите Nekoray.exe:</b> Откройте исполняемый файл.\n"
+    "4. <b>Скопируйте свой ключ (vless://)</b> Перейдите в раздел «Моя подписка» в нашем боте и скопируйте свой ключ.\n"
+    "5. <b>Импортируйте конфигурацию:</b>\n"
+    "   • В Nekoray нажмите «Сервер» (Server).\n"
+    "   • Выберите «Импортировать из буфера обмена».\n"
+    "   • Nekoray автоматически импортирует конфигурацию.\n"
+    "6. <b>Обновите серверы (если нужно):</b> Если серверы не появились, нажмите «Серверы» → «Обновить все серверы».\n"
+    "7. Сверху включите пункт 'Режим TUN' ('Tun Mode')\n"
+    "8. <b>Выберите сервер:</b> В главном окне выберите появившийся сервер.\n"
+    "9. <b>Подключитесь к VPN:</b> Нажмите «Подключить» (Connect).\n"
+    "10. <b>Проверьте подключение:</b> Откройте браузер и проверьте IP на https://whatismyipaddress.com/. Он должен отличаться от вашего реального IP."
+)
+_HOWTO_LINUX_TEXT: Final[str] = (
+    "<b>Подключение на Linux</b>\n\n"
+    "1. <b>Скачайте и распакуйте Nekoray:</b> Перейдите на https://github.com/MatsuriDayo/Nekoray/releases и скачайте архив для Linux. Распакуйте его в удобную папку.\n"
+    "2. <b>Запустите Nekoray:</b> Откройте терминал, перейдите в папку с Nekoray и выполните <code>./nekoray</code> (или используйте графический запуск, если доступен).\n"
+    "3. <b>Скопируйте свой ключ (vless://)</b> Перейдите в раздел «Моя подписка» в нашем боте и скопируйте свой ключ.\n"
+    "4. <b>Импортируйте конфигурацию:</b>\n"
+    "   • В Nekoray нажмите «Сервер» (Server).\n"
+    "   • Выберите «Импортировать из буфера обмена».\n"
+    "   • Nekoray автоматически импортирует конфигурацию.\n"
+    "5. <b>Обновите серверы (если нужно):</b> Если серверы не появились, нажмите «Серверы» → «Обновить все серверы».\n"
+    "6. Сверху включите пункт 'Режим TUN' ('Tun Mode')\n"
+    "7. <b>Выберите сервер:</b> В главном окне выберите появившийся сервер.\n"
+    "8. <b>Подключитесь к VPN:</b> Нажмите «Подключить» (Connect).\n"
+    "9. <b>Проверьте подключение:</b> Откройте браузер и проверьте IP на https://whatismyipaddress.com/. Он должен отличаться от вашего реального IP."
+)
+_HOWTO_INTRO_DEFAULT: Final[str] = "Выберите вашу платформу для инструкции по подключению VLESS:"
+
+# (btn_back_to_menu_text, markup) — общая клавиатура выбора платформы
+_HOWTO_MARKUP_CACHE: tuple[str, types.InlineKeyboardMarkup] | None = None
+
+
+# platform -> (ключ настройки с текстом, текст по умолчанию)
+_HOWTO: Final[dict[str, tuple[str, str]]] = {
+    "android": ("howto_android_text", _HOWTO_ANDROID_TEXT),
+    "ios": ("howto_ios_text", _HOWTO_IOS_TEXT),
+    "windows": ("howto_windows_text", _HOWTO_WINDOWS_TEXT),
+    "linux": ("howto_linux_text", _HOWTO_LINUX_TEXT),
+}
+
+# Один обработчик на все инструкции: howto_<platform> и howto_<platform>_<key_id>,
+# отдельный — на экран выбора платформы howto_vless[_<key_id>]
+_HOWTO_CALLBACK_RE = re.compile(rf"^howto_({'|'.join(_HOWTO)})(?:_(\d+))?$")
+_HOWTO_INTRO_CALLBACK_RE = re.compile(r"^howto_vless(?:_(\d+))?$")
+
+
+def _get_howto_markup() -> types.InlineKeyboardMarkup:
+    """Клавиатура инструкций без привязки к ключу; пересобирается
+    только при смене текста кнопки «Назад в меню»."""
+    global _HOWTO_MARKUP_CACHE
+    back_text = get_setting_cached("btn_back_to_menu_text") or ""
+    cached = _HOWTO_MARKUP_CACHE
+    if cached is None or cached[0] != back_text:
+        markup = keyboards.create_howto_vless_keyboard()
+        cached = (back_text, markup)
+        _HOWTO_MARKUP_CACHE = cached
+    return cached[1]
+
+
+@lru_cache(maxsize=32)
+def _host_kbd(host_names: tuple[str, ...], action: str) -> types.InlineKeyboardMarkup:
+    """Клавиатура выбора хоста; зависит только от имён хостов и action, поэтому кешируется.
+    Имена входят в ключ кеша, так что после правки хостов клавиатура соберётся заново."""
+    return keyboards.create_host_selection_keyboard([{"host_name": name} for name in host_names], action=action)
+
+
+def _host_selection_keyboard(hosts: list[dict], action: str) -> types.InlineKeyboardMarkup:
+    return _host_kbd(tuple(h["host_name"] for h in hosts), action)
+
+
+_TRIAL_TAGS = frozenset({"trial", "триал"})
+
+
+def _is_trial_tag(tag) -> bool:
+    """True, если тег/название ключа обозначает триал (с учётом регистра и пробелов)."""
+    t = tag if isinstance(tag, str) else str(tag)
+    return t in _TRIAL_TAGS or t.strip().lower() in _TRIAL_TAGS
+
+
 def _format_duration_label(months: int | None, duration_days: int | None) -> str:
     try:
         dd = int(duration_days or 0)
@@ -450,7 +991,7 @@ async def grant_referrer_day_bonus_for_trial(*, referred_user_id: int, bot: Bot)
     if not bonus_host:
         bonus_host = get_setting("referral_days_bonus_host") or None
     if not bonus_host:
-        hosts = get_all_hosts() or []
+        hosts = get_all_hosts_cached() or []
         if hosts:
             bonus_host = hosts[0].get("host_name")
     if not bonus_host:
@@ -520,13 +1061,13 @@ async def _create_heleket_payment_request(
         return None
 
 
-    payment_id = str(uuid.uuid4())
+    payment_id = str(_new_uuid())
 
 
     metadata = {
         "user_id": int(user_id),
         "months": int(months or 0),
-        "price": float(Decimal(str(price)).quantize(Decimal("0.01"))),
+        "price": float(Decimal(str(price)).quantize(_D_CENT)),
         "action": state_data.get("action"),
         "key_id": state_data.get("key_id"),
         "host_name": host_name or state_data.get("host_name"),
@@ -545,7 +1086,7 @@ async def _create_heleket_payment_request(
         logger.warning(f"Heleket: не удалось создать pending: {e}")
 
 
-    amount_str = f"{Decimal(str(price)).quantize(Decimal('0.01'))}"
+    amount_str = f"{Decimal(str(price)).quantize(_D_CENT)}"
     body: dict = {
         "amount": amount_str,
         "currency": "RUB",
@@ -578,24 +1119,24 @@ async def _create_heleket_payment_request(
     url = "https://api.heleket.com/v1/payment"
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, headers=headers, json=body, timeout=20) as resp:
-                if resp.status != 200:
-                    text = await resp.text()
-                    logger.error(f"Heleket: HTTP {resp.status}: {text}")
-                    return None
-                data = await resp.json(content_type=None)
-
-                if isinstance(data, dict) and data.get("state") == 0:
-                    try:
-                        result = data.get("result") or {}
-                        pay_url = result.get("url")
-                        if pay_url:
-                            return pay_url
-                    except Exception:
-                        pass
-                logger.error(f"Heleket: неожиданный ответ API: {data}")
+        session = _get_http_session()
+        async with session.post(url, headers=headers, json=body, timeout=20) as resp:
+            if resp.status != 200:
+                text = await resp.text()
+                logger.error(f"Heleket: HTTP {resp.status}: {text}")
                 return None
+            data = _json_loads(await resp.read())
+
+            if isinstance(data, dict) and data.get("state") == 0:
+                try:
+                    result = data.get("result") or {}
+                    pay_url = result.get("url")
+                    if pay_url:
+                        return pay_url
+                except Exception:
+                    pass
+            logger.error(f"Heleket: неожиданный ответ API: {data}")
+            return None
     except Exception as e:
         logger.error(f"Heleket: ошибка при создании инвойса: {e}", exc_info=True)
         return None
@@ -631,11 +1172,11 @@ async def _create_cryptobot_invoice(
     promo_code = state_data.get("promo_code")
     promo_discount = state_data.get("promo_discount")
 
-    payment_id = str(uuid.uuid4())
+    payment_id = str(_new_uuid())
     metadata = {
         "user_id": int(user_id),
         "months": int(months or 0),
-        "price": float(Decimal(str(price_rub)).quantize(Decimal("0.01"))),
+        "price": float(Decimal(str(price_rub)).quantize(_D_CENT)),
         "action": action,
         "key_id": key_id,
         "host_name": (host_name or state_data.get("host_name")),
@@ -643,7 +1184,7 @@ async def _create_cryptobot_invoice(
         "customer_email": customer_email,
         "payment_method": "CryptoBot",
         "promo_code": promo_code,
-        "promo_discount": float(Decimal(str(promo_discount)).quantize(Decimal("0.01"))) if promo_discount else 0.0,
+        "promo_discount": float(Decimal(str(promo_discount)).quantize(_D_CENT)) if promo_discount else 0.0,
         "payment_id": payment_id,
     }
     try:
@@ -652,7 +1193,7 @@ async def _create_cryptobot_invoice(
         logger.warning(f"CryptoBot: не удалось создать pending для {payment_id}: {e}")
 
 
-    price_str = f"{Decimal(str(price_rub)).quantize(Decimal('0.01'))}"
+    price_str = f"{Decimal(str(price_rub)).quantize(_D_CENT)}"
     parts = [
         str(int(user_id)),
         str(int(months or 0)),
@@ -667,7 +1208,7 @@ async def _create_cryptobot_invoice(
 
     parts.append(str(promo_code if promo_code else "None"))
     try:
-        promo_discount_str = f"{Decimal(str(promo_discount)).quantize(Decimal('0.01'))}" if promo_discount else "0"
+        promo_discount_str = f"{Decimal(str(promo_discount)).quantize(_D_CENT)}" if promo_discount else "0"
     except Exception:
         promo_discount_str = "0"
     parts.append(promo_discount_str)
@@ -690,34 +1231,34 @@ async def _create_cryptobot_invoice(
     url = "https://pay.crypt.bot/api/createInvoice"
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, headers=headers, json=body, timeout=20) as resp:
-                if resp.status != 200:
-                    text = await resp.text()
-                    logger.error(f"CryptoBot: HTTP {resp.status}: {text}")
-                    return None
-                data = await resp.json(content_type=None)
-
-                if isinstance(data, dict) and data.get("ok") and isinstance(data.get("result"), dict):
-                    res = data["result"]
-                    pay_url = res.get("bot_invoice_url") or res.get("invoice_url")
-                    invoice_id = res.get("invoice_id")
-                    if pay_url and invoice_id is not None:
-                        return pay_url, int(invoice_id)
-                logger.error(f"CryptoBot: неожиданный ответ API: {data}")
+        session = _get_http_session()
+        async with session.post(url, headers=headers, data=_json_dumps(body), timeout=20) as resp:
+            if resp.status != 200:
+                text = await resp.text()
+                logger.error(f"CryptoBot: HTTP {resp.status}: {text}")
                 return None
+            data = _json_loads(await resp.read())
+
+            if isinstance(data, dict) and data.get("ok") and isinstance(data.get("result"), dict):
+                res = data["result"]
+                pay_url = res.get("bot_invoice_url") or res.get("invoice_url")
+                invoice_id = res.get("invoice_id")
+                if pay_url and invoice_id is not None:
+                    return pay_url, int(invoice_id)
+            logger.error(f"CryptoBot: неожиданный ответ API: {data}")
+            return None
     except Exception as e:
         logger.error(f"CryptoBot: ошибка при создании инвойса: {e}", exc_info=True)
         return None
 
 
-    payment_id = str(uuid.uuid4())
+    payment_id = str(_new_uuid())
 
 
     metadata = {
         "user_id": int(user_id),
         "months": int(months or 0),
-        "price": float(Decimal(str(price)).quantize(Decimal("0.01"))),
+        "price": float(Decimal(str(price)).quantize(_D_CENT)),
         "action": state_data.get("action"),
         "key_id": state_data.get("key_id"),
         "host_name": host_name or state_data.get("host_name"),
@@ -734,7 +1275,7 @@ async def _create_cryptobot_invoice(
         logger.warning(f"Heleket: не удалось создать pending: {e}")
 
 
-    amount_str = f"{Decimal(str(price)).quantize(Decimal('0.01'))}"
+    amount_str = f"{Decimal(str(price)).quantize(_D_CENT)}"
     body: dict = {
         "amount": amount_str,
         "currency": "RUB",
@@ -767,24 +1308,24 @@ async def _create_cryptobot_invoice(
     url = "https://api.heleket.com/v1/payment"
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, headers=headers, json=body, timeout=20) as resp:
-                if resp.status != 200:
-                    text = await resp.text()
-                    logger.error(f"Heleket: HTTP {resp.status}: {text}")
-                    return None
-                data = await resp.json(content_type=None)
-
-                if isinstance(data, dict) and data.get("state") == 0:
-                    try:
-                        result = data.get("result") or {}
-                        pay_url = result.get("url")
-                        if pay_url:
-                            return pay_url
-                    except Exception:
-                        pass
-                logger.error(f"Heleket: неожиданный ответ API: {data}")
+        session = _get_http_session()
+        async with session.post(url, headers=headers, json=body, timeout=20) as resp:
+            if resp.status != 200:
+                text = await resp.text()
+                logger.error(f"Heleket: HTTP {resp.status}: {text}")
                 return None
+            data = _json_loads(await resp.read())
+
+            if isinstance(data, dict) and data.get("state") == 0:
+                try:
+                    result = data.get("result") or {}
+                    pay_url = result.get("url")
+                    if pay_url:
+                        return pay_url
+                except Exception:
+                    pass
+            logger.error(f"Heleket: неожиданный ответ API: {data}")
+            return None
     except Exception as e:
         logger.error(f"Heleket: ошибка при создании инвойса: {e}", exc_info=True)
         return None
@@ -820,6 +1361,55 @@ class SupportDialog(StatesGroup):
 # Franchise (managed clone bots)
 # =============================
 
+# Статичные клавиатуры франшизы: собираются один раз при импорте
+_KB_CANCEL_FACTORY = types.InlineKeyboardMarkup(inline_keyboard=[
+    [types.InlineKeyboardButton(text="❌ Отмена", callback_data="factory_cancel")],
+])
+_KB_PARTNER_WITHDRAW = types.InlineKeyboardMarkup(inline_keyboard=[
+    [types.InlineKeyboardButton(text="❌ Отмена", callback_data="partner_withdraw_cancel")],
+])
+_KB_PARTNER_REQUISITE_INPUT = types.InlineKeyboardMarkup(inline_keyboard=[
+    [types.InlineKeyboardButton(text="❌ Отмена", callback_data="partner_requisite_cancel")],
+])
+
+
+@lru_cache(maxsize=1024)
+def _kb_partner_requisites_for(key: tuple[tuple[int, bool], ...]) -> types.InlineKeyboardMarkup:
+    """Клавиатура реквизитов полностью определяется парами (id, is_default) — кэшируем по ним."""
+    Button = types.InlineKeyboardButton
+    rows = [[Button(text="➕ Добавить карту", callback_data="partner_requisite_add")]]
+    # One row per action to keep callback_data short and stable
+    for rid, is_default in key:
+        if rid <= 0:
+            continue
+        if not is_default:
+            rows.append([Button(text=f"✅ Сделать основной #{rid}", callback_data=f"req_set_default:{rid}")])
+        rows.append([Button(text=f"🗑 Удалить #{rid}", callback_data=f"req_delete:{rid}")])
+    rows.append([Button(text="⬅️ Назад", callback_data="partner_cabinet")])
+    return types.InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+_PARTNER_CABINET_TMPL: Final = (
+    "👤 <b>Личный кабинет</b>\n\n"
+    "Бот: @{username}\n"
+    "Пользователей: <b>{users}</b>\n\n"
+    "Оплачено картой: <b>{gross:.2f} ₽</b>\n"
+    "Ваш процент: <b>{percent:.1f}%</b>\n"
+    "Ваш доход: <b>{commission:.2f} ₽</b>\n"
+    "Доступно к выводу: <b>{available:.2f} ₽</b>\n\n"
+    "ℹ️ Минимальная сумма вывода: <b>{min_withdraw:.0f} ₽</b>\n"
+)
+
+
+@lru_cache(maxsize=8)
+def _kb_partner_cabinet_for(back_text: str) -> types.InlineKeyboardMarkup:
+    """Кабинет партнёра зависит только от подписи кнопки «назад» — кэшируем по ней."""
+    return types.InlineKeyboardMarkup(inline_keyboard=[
+        [types.InlineKeyboardButton(text="💳 Реквизиты", callback_data="partner_requisites")],
+        [types.InlineKeyboardButton(text="💸 Вывод средств", callback_data="partner_withdraw")],
+        [types.InlineKeyboardButton(text=back_text, callback_data="back_to_main_menu")],
+    ])
+
 TOKEN_RE = re.compile(r"^\d+:[A-Za-z0-9_-]{20,}$")
 
 
@@ -829,9 +1419,18 @@ class FranchiseStates(StatesGroup):
     waiting_requisites_bank = State()
     waiting_requisites_value = State()
 
+# Подпись значения реквизита по его типу (всё, что не карта, — телефон)
+_REQUISITE_LABELS: Final[dict[str, str]] = {'card': 'Номер карты'}
+_NONDIGIT_RE = re.compile(r'\D+')
+# Юзернейм получателя подарка (текст после "@"); \Z — без допуска хвостового перевода строки
+_GIFT_USERNAME_RE = re.compile(r"^[A-Za-z0-9_]{5,}\Z")
+_EMAIL_RE = re.compile(r'^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$')
+# Слова, которыми пользователь отменяет ввод промокода
+_CANCEL_WORDS: Final[frozenset[str]] = frozenset({"отмена", "cancel", "назад", "stop", "стоп"})
+
+
 def is_valid_email(email: str) -> bool:
-    pattern = r'^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$'
-    return re.match(pattern, email) is not None
+    return _EMAIL_RE.match(email) is not None
 
 async def show_captcha(message: types.Message, state: FSMContext, user_id: int):
     """Показывает капчу пользователю."""
@@ -949,14 +1548,14 @@ async def show_main_menu(message: types.Message, edit_message: bool = False):
     # Franchise: determine whether this is a managed clone and whether the current user is its owner
     factory_bot_id = 0
     try:
-        factory_bot_id = rw_repo.resolve_factory_bot_id(getattr(message.bot, "id", None))
+        factory_bot_id = rw_repo.resolve_factory_bot_id_cached(getattr(message.bot, "id", None))
     except Exception:
         factory_bot_id = 0
 
     show_partner_cabinet = False
     if factory_bot_id > 0:
         try:
-            info = rw_repo.get_managed_bot(factory_bot_id) or {}
+            info = rw_repo.get_managed_bot_cached(factory_bot_id) or {}
             owner_id = int(info.get("owner_telegram_id") or 0)
             show_partner_cabinet = (owner_id == int(user_id))
         except Exception:
@@ -1086,7 +1685,7 @@ def get_user_router() -> Router:
         if reward_type == "fixed_start_referrer" and referrer_id and user_data and not user_data.get('referral_start_bonus_received'):
             try:
                 amount_raw = get_setting("referral_on_start_referrer_amount") or "20"
-                start_bonus = Decimal(str(amount_raw)).quantize(Decimal("0.01"))
+                start_bonus = Decimal(str(amount_raw)).quantize(_D_CENT)
             except Exception:
                 start_bonus = Decimal("20.00")
             if start_bonus > 0:
@@ -1403,10 +2002,11 @@ def get_user_router() -> Router:
         username = html_escape(str(user_db_data.get('username', 'Пользователь') or 'Пользователь'))
         total_spent, total_months = user_db_data.get('total_spent', 0), user_db_data.get('total_months', 0)
         now = datetime.now()
-        active_keys = [key for key in user_keys if datetime.fromisoformat(key['expiry_date']) > now]
-        if active_keys:
-            latest_key = max(active_keys, key=lambda k: datetime.fromisoformat(k['expiry_date']))
-            latest_expiry_date = datetime.fromisoformat(latest_key['expiry_date'])
+        active_expiries = [
+            exp for exp in (_parse_iso(key['expiry_date']) for key in user_keys) if exp > now
+        ]
+        if active_expiries:
+            latest_expiry_date = max(active_expiries)
             time_left = latest_expiry_date - now
             vpn_status_text = get_vpn_active_text(time_left.days, time_left.seconds // 3600)
         elif user_keys: vpn_status_text = VPN_INACTIVE_TEXT
@@ -1460,7 +2060,7 @@ def get_user_router() -> Router:
         if amount > Decimal("100000"):
             await message.answer("❌ Максимальная сумма пополнения: 100000 RUB", reply_markup=keyboards.create_back_to_menu_keyboard())
             return
-        final_amount = amount.quantize(Decimal("0.01"))
+        final_amount = amount.quantize(_D_CENT)
         await state.update_data(topup_amount=float(final_amount))
         await message.answer(
             f"К пополнению: {final_amount:.2f} RUB\nВыберите способ оплаты:",
@@ -1511,7 +2111,7 @@ def get_user_router() -> Router:
                     }]
                 }
 
-            payment_id = str(uuid.uuid4())
+            payment_id = str(_new_uuid())
             metadata = {
                 "user_id": int(user_id),
                 "price": float(price_float_for_metadata),
@@ -1533,13 +2133,11 @@ def get_user_router() -> Router:
             }
             if receipt:
                 payment_payload['receipt'] = receipt
-            payment = Payment.create(payment_payload, uuid.uuid4())
+            payment = await asyncio.to_thread(Payment.create, payment_payload, _new_uuid())
             try:
                 provider_payment_id = getattr(payment, "id", None)
                 if provider_payment_id:
-                    metadata2 = dict(metadata)
-                    metadata2["yookassa_payment_id"] = str(provider_payment_id)
-                    create_payload_pending(payment_id, int(user_id), float(price_float_for_metadata), metadata2)
+                    update_pending_metadata(payment_id, {"yookassa_payment_id": str(provider_payment_id)})
             except Exception as e:
                 logger.warning(f"YooKassa topup: не удалось сохранить provider id для {payment_id}: {e}")
             await state.clear()
@@ -1553,11 +2151,10 @@ def get_user_router() -> Router:
             await state.clear()
 
 
-    @user_router.callback_query(PaymentProcess.waiting_for_payment_method, F.data == "pay_stars")
     async def create_stars_invoice_handler(callback: types.CallbackQuery, state: FSMContext):
         await callback.answer("Готовлю счёт в Telegram Stars...")
         data = await state.get_data()
-        plan = get_plan_by_id(data.get('plan_id'))
+        plan = await _db(get_plan_by_id, data.get('plan_id'))
         if not plan:
             await callback.message.edit_text("❌ Ошибка: Тариф не найден.")
             await state.clear()
@@ -1569,7 +2166,7 @@ def get_user_router() -> Router:
             stars_ratio_raw = get_setting("stars_per_rub") or '0'
             stars_ratio = Decimal(stars_ratio_raw)
         except Exception:
-            stars_ratio = Decimal('0')
+            stars_ratio = _D_ZERO
         if stars_ratio <= 0:
             await callback.message.edit_text("❌ Оплата в Stars временно недоступна.")
             await state.clear()
@@ -1583,22 +2180,12 @@ def get_user_router() -> Router:
         duration_days = int(plan.get('duration_days') or 0)
         duration_label = _format_duration_label(months, duration_days)
 
-        payment_id = str(uuid.uuid4())
-        metadata = {
-            "user_id": user_id,
-            "months": months,
-            "duration_days": duration_days,
-            "price": float(price_rub),
-            "action": data.get('action'),
-            "key_id": data.get('key_id'),
-            "host_name": data.get('host_name'),
-            "plan_id": data.get('plan_id'),
-            "customer_email": data.get('customer_email'),
-            "payment_method": "Telegram Stars",
-            "payment_id": payment_id,
-        }
+        payment_id = str(_new_uuid())
+        metadata = _plan_payment_metadata(
+            data, plan, user_id=user_id, price=price_rub, payment_method="Telegram Stars", payment_id=payment_id,
+        )
         try:
-            ok = create_payload_pending(payment_id, user_id, float(price_rub), metadata)
+            ok = await _db(create_payload_pending, payment_id, user_id, float(price_rub), metadata)
             logger.info(f"Создано ожидание Stars: ok={ok}, payment_id={payment_id}, user_id={user_id}, price_rub={price_rub}")
         except Exception as e:
             logger.error(f"Не удалось создать ожидание для Stars payment_id={payment_id}: {e}", exc_info=True)
@@ -1633,7 +2220,7 @@ def get_user_router() -> Router:
             stars_ratio_raw = get_setting("stars_per_rub") or '0'
             stars_ratio = Decimal(stars_ratio_raw)
         except Exception:
-            stars_ratio = Decimal('0')
+            stars_ratio = _D_ZERO
         if stars_ratio <= 0:
             await callback.message.edit_text("❌ Оплата в Stars временно недоступна.")
             await state.clear()
@@ -1641,7 +2228,7 @@ def get_user_router() -> Router:
         stars_amount = int((amount_rub * stars_ratio).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
         if stars_amount <= 0:
             stars_amount = 1
-        payment_id = str(uuid.uuid4())
+        payment_id = str(_new_uuid())
         metadata = {
             "user_id": user_id,
             "price": float(amount_rub),
@@ -1708,9 +2295,9 @@ def get_user_router() -> Router:
                 stars_ratio_raw = get_setting("stars_per_rub") or '0'
                 stars_ratio = Decimal(stars_ratio_raw)
             except Exception:
-                stars_ratio = Decimal('0')
+                stars_ratio = _D_ZERO
             if total_stars > 0 and stars_ratio > 0:
-                amount_rub = (Decimal(total_stars) / stars_ratio).quantize(Decimal('0.01'))
+                amount_rub = (Decimal(total_stars) / stars_ratio).quantize(_D_CENT)
                 metadata = {
                     "user_id": message.from_user.id,
                     "price": float(amount_rub),
@@ -1733,14 +2320,15 @@ def get_user_router() -> Router:
 
 
 
+    @_settings_memo(ttl=30.0)
     def _platega_is_enabled() -> bool:
-        return bool((get_setting("platega_merchant_id") or "").strip() and (get_setting("platega_secret") or "").strip())
+        return bool((get_setting_cached("platega_merchant_id") or "").strip() and (get_setting_cached("platega_secret") or "").strip())
 
     def _platega_get_base_url() -> str:
-        return (get_setting("platega_base_url") or "https://app.platega.io").strip().rstrip("/")
+        return (get_setting_cached("platega_base_url") or "https://app.platega.io").strip().rstrip("/")
 
     def _platega_get_method_code() -> int:
-        raw = (get_setting("platega_active_methods") or "2").strip()
+        raw = (get_setting_cached("platega_active_methods") or "2").strip()
         for part in raw.split(","):
             part = part.strip()
             if not part:
@@ -1763,18 +2351,18 @@ def get_user_router() -> Router:
         }
         try:
             timeout = aiohttp.ClientTimeout(total=25, connect=10, sock_read=20)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.request(method, url, headers=headers, json=json_data) as resp:
-                    text = await resp.text()
-                    if resp.status >= 400:
-                        logger.error(f"Platega API HTTP {resp.status}: {text}")
-                        return None
-                    if not text:
-                        return None
-                    try:
-                        return json.loads(text)
-                    except Exception:
-                        return None
+            session = _get_http_session()
+            async with session.request(method, url, headers=headers, json=json_data, timeout=timeout) as resp:
+                text = await resp.text()
+                if resp.status >= 400:
+                    logger.error(f"Platega API HTTP {resp.status}: {text}")
+                    return None
+                if not text:
+                    return None
+                try:
+                    return _json_loads(text)
+                except Exception:
+                    return None
         except Exception as e:
             logger.error(f"Platega request failed: {e}", exc_info=True)
             return None
@@ -1782,7 +2370,7 @@ def get_user_router() -> Router:
     async def _create_platega_payment_link(*, amount_rub: Decimal, payment_id: str, description: str) -> tuple[str | None, str | None]:
         body = {
             "paymentMethod": _platega_get_method_code(),
-            "paymentDetails": {"amount": float(amount_rub.quantize(Decimal('0.01'))), "currency": "RUB"},
+            "paymentDetails": {"amount": float(amount_rub.quantize(_D_CENT)), "currency": "RUB"},
             "description": (description or "")[:64],
             "return": f"https://t.me/{TELEGRAM_BOT_USERNAME}",
             "failedUrl": f"https://t.me/{TELEGRAM_BOT_USERNAME}",
@@ -1816,11 +2404,10 @@ def get_user_router() -> Router:
         url = base + "?" + urlencode(params)
         return url
 
-    @user_router.callback_query(PaymentProcess.waiting_for_payment_method, F.data == "pay_yoomoney")
     async def pay_yoomoney_handler(callback: types.CallbackQuery, state: FSMContext):
         await callback.answer("Готовлю ссылку YooMoney...")
         data = await state.get_data()
-        plan = get_plan_by_id(data.get('plan_id'))
+        plan = await _db(get_plan_by_id, data.get('plan_id'))
         if not plan:
             await callback.message.edit_text("❌ Ошибка: Тариф не найден.")
             await state.clear()
@@ -1846,21 +2433,11 @@ def get_user_router() -> Router:
         months = int(plan.get('months') or 0)
         duration_days = int(plan.get('duration_days') or 0)
         duration_label = _format_duration_label(months, duration_days)
-        payment_id = str(uuid.uuid4())
-        metadata = {
-            "user_id": user_id,
-            "months": months,
-            "duration_days": duration_days,
-            "price": float(price_rub),
-            "action": data.get('action'),
-            "key_id": data.get('key_id'),
-            "host_name": data.get('host_name'),
-            "plan_id": data.get('plan_id'),
-            "customer_email": data.get('customer_email'),
-            "payment_method": "YooMoney",
-            "payment_id": payment_id,
-        }
-        create_payload_pending(payment_id, user_id, float(price_rub), metadata)
+        payment_id = str(_new_uuid())
+        metadata = _plan_payment_metadata(
+            data, plan, user_id=user_id, price=price_rub, payment_method="YooMoney", payment_id=payment_id,
+        )
+        await _db(create_payload_pending, payment_id, user_id, float(price_rub), metadata)
         pay_url = _build_yoomoney_link(wallet, price_rub, payment_id)
         await callback.message.edit_text(
             "Нажмите на кнопку ниже для оплаты:",
@@ -1898,7 +2475,7 @@ def get_user_router() -> Router:
             await state.clear()
             return
         
-        payment_id = str(uuid.uuid4())
+        payment_id = str(_new_uuid())
         metadata = {
             "user_id": user_id,
             "price": float(amount_rub),
@@ -2016,7 +2593,7 @@ def get_user_router() -> Router:
         Configuration.secret_key = secret_key
 
         try:
-            payment = Payment.find_one(provider_payment_id)
+            payment = await asyncio.to_thread(Payment.find_one, provider_payment_id)
         except Exception as e:
             logger.error(f"YooKassa manual check: failed to fetch payment {provider_payment_id}: {e}", exc_info=True)
             await callback.answer("⚠️ Не удалось проверить оплату через YooKassa. Попробуйте позже.", show_alert=True)
@@ -2039,8 +2616,8 @@ def get_user_router() -> Router:
             currency = (getattr(amount_obj, "currency", "") or "").upper()
 
         try:
-            expected_amount = Decimal(str(pending_meta.get('price') or pending_meta.get('amount_rub') or '0')).quantize(Decimal('0.01'))
-            got_amount = Decimal(str(value_str or '0')).quantize(Decimal('0.01'))
+            expected_amount = Decimal(str(pending_meta.get('price') or pending_meta.get('amount_rub') or '0')).quantize(_D_CENT)
+            got_amount = Decimal(str(value_str or '0')).quantize(_D_CENT)
         except Exception as e:
             logger.warning(f"YooKassa manual check: amount parse error for {pid}: value={value_str} error={e}")
             await callback.answer("⚠️ Не удалось проверить сумму оплаты. Попробуйте позже.", show_alert=True)
@@ -2099,25 +2676,25 @@ def get_user_router() -> Router:
 
         try:
             logger.info(f"🌐 Проверяем платеж через API ЮMoney: {pid}")
-            async with aiohttp.ClientSession() as session:
-                data = {"label": pid, "records": "10"}
-                headers = {
-                    "Authorization": f"Bearer {token}",
-                    "Accept": "application/json",
-                    "Content-Type": "application/x-www-form-urlencoded",
-                }
-                async with session.post("https://yoomoney.ru/api/operation-history", data=data, headers=headers, timeout=15) as resp:
-                    text = await resp.text()
-                    logger.info(f"📡 Ответ API: статус={resp.status}")
-                    if resp.status != 200:
-                        await callback.answer("⚠️ Не удалось проверить оплату через YooMoney. Попробуйте позже.", show_alert=True)
-                        return
+            session = _get_http_session()
+            data = {"label": pid, "records": "10"}
+            headers = {
+                "Authorization": f"Bearer {token}",
+                "Accept": "application/json",
+                "Content-Type": "application/x-www-form-urlencoded",
+            }
+            async with session.post("https://yoomoney.ru/api/operation-history", data=data, headers=headers, timeout=15) as resp:
+                text = await resp.text()
+                logger.info(f"📡 Ответ API: статус={resp.status}")
+                if resp.status != 200:
+                    await callback.answer("⚠️ Не удалось проверить оплату через YooMoney. Попробуйте позже.", show_alert=True)
+                    return
         except Exception as e:
             logger.error(f"💥 Ошибка проверки API для {pid}: {e}")
             await callback.answer("⚠️ Ошибка связи с YooMoney. Попробуйте позже.", show_alert=True)
             return
         try:
-            payload = json.loads(text)
+            payload = _json_loads(text) or {}
         except Exception as e:
             logger.error(f"💥 Не удалось разобрать ответ API: {e}")
             payload = {}
@@ -2169,7 +2746,7 @@ def get_user_router() -> Router:
             await state.clear()
             return
 
-        payment_id = str(uuid.uuid4())
+        payment_id = str(_new_uuid())
         metadata = {
             "user_id": user_id,
             "price": float(amount_rub),
@@ -2186,9 +2763,7 @@ def get_user_router() -> Router:
             return
 
         try:
-            metadata2 = dict(metadata)
-            metadata2["platega_transaction_id"] = txid
-            create_payload_pending(payment_id, user_id, float(amount_rub), metadata2)
+            update_pending_metadata(payment_id, {"platega_transaction_id": txid})
         except Exception:
             pass
 
@@ -2300,10 +2875,11 @@ def get_user_router() -> Router:
             await state.clear()
             return
 
-        price_ton = (amount_rub / usdt_rub_rate / ton_usdt_rate).quantize(Decimal("0.001"), rounding=ROUND_HALF_UP)
+        with localcontext(_TON_CTX):
+            price_ton = (amount_rub / usdt_rub_rate / ton_usdt_rate).quantize(_D_TON_QUANT)
         amount_nanoton = int(price_ton * 1_000_000_000)
 
-        payment_id = str(uuid.uuid4())
+        payment_id = str(_new_uuid())
         metadata = {
             "user_id": user_id,
             "price": float(amount_rub),
@@ -2315,24 +2891,20 @@ def get_user_router() -> Router:
 
         transaction_payload = {
             'messages': [{'address': wallet_address, 'amount': str(amount_nanoton), 'payload': payment_id}],
-            'valid_until': int(datetime.now().timestamp()) + 600
+            'valid_until': int(time.time()) + 600
         }
 
         try:
             connect_url = await _start_ton_connect_process(user_id, transaction_payload)
-            qr_img = qrcode.make(connect_url)
-            bio = BytesIO(); qr_img.save(bio, "PNG"); qr_file = BufferedInputFile(bio.getvalue(), "ton_qr.png")
+            qr_png = await asyncio.to_thread(_render_qr, connect_url)
+            qr_file = BufferedInputFile(qr_png, "ton_qr.png")
             try:
                 await callback.message.delete()
             except Exception:
                 pass
             await callback.message.answer_photo(
                 photo=qr_file,
-                caption=(
-                    f"💎 Оплата через TON Connect\n\n"
-                    f"Сумма к оплате: `{price_ton}` TON\n\n"
-                    f"Нажмите кнопку ниже, чтобы открыть кошелёк и подтвердить перевод."
-                ),
+                caption=_TON_TOPUP_CAPTION_TMPL % (price_ton,),
                 reply_markup=keyboards.create_ton_connect_keyboard(connect_url)
             )
             await state.clear()
@@ -2777,6 +3349,23 @@ def get_user_router() -> Router:
         except Exception:
             return None
 
+    async def _remnawave_key_exists_cached(key_data: dict) -> bool | None:
+        """То же, что _remnawave_key_exists, но с коротким TTL-кэшем по (host_name, key_id).
+
+        Кэшируются только однозначные ответы (True/False): ошибка API не должна «залипать».
+        """
+        cache_key = (str(key_data.get('host_name') or ''), str(key_data.get('key_id') or ''))
+        now = time.monotonic()
+        cached = _KEY_EXISTS_CACHE.get(cache_key)
+        if cached is not None and now - cached[0] < _KEY_EXISTS_TTL:
+            return cached[1]
+        exists = await _remnawave_key_exists(key_data)
+        if exists is not None:
+            _KEY_EXISTS_CACHE[cache_key] = (time.monotonic(), exists)
+        else:
+            _KEY_EXISTS_CACHE.pop(cache_key, None)
+        return exists
+
 
     
 
@@ -2797,8 +3386,9 @@ def get_user_router() -> Router:
                 return len(val)
             if isinstance(val, int):
                 return val
-            if isinstance(val, str) and val.strip().isdigit():
-                return int(val.strip())
+            if isinstance(val, str):
+                sv = val.strip()
+                return int(sv) if sv.isdigit() else None
             if isinstance(val, dict):
                 # Часто список лежит внутри data/items/list/rows/results/devices/hwids
                 for kk in (
@@ -2819,8 +3409,10 @@ def get_user_router() -> Router:
                     inner = val.get(kk)
                     if isinstance(inner, int):
                         return inner
-                    if isinstance(inner, str) and inner.strip().isdigit():
-                        return int(inner.strip())
+                    if isinstance(inner, str):
+                        si = inner.strip()
+                        if si.isdigit():
+                            return int(si)
             return None
 
         # 1) Пробуем извлечь из наиболее вероятных ключей (camelCase + snake_case)
@@ -2932,50 +3524,63 @@ def get_user_router() -> Router:
         except Exception:
             hwid_payload = None
 
-        def _count_any(val) -> int:
-            if val is None:
-                return 0
-            if isinstance(val, list):
-                return len(val)
-            if isinstance(val, int):
-                return max(0, val)
-            if isinstance(val, str) and val.strip().isdigit():
-                return int(val.strip())
-            if isinstance(val, dict):
-                # ready counts
-                for kk in ("total", "count", "totalCount", "itemsCount", "total_count", "items_count"):
-                    inner = val.get(kk)
-                    c = _count_any(inner)
-                    if c:
-                        return c
-
-                # common containers
-                for kk in (
-                    "items",
-                    "data",
-                    "list",
-                    "rows",
-                    "results",
-                    "devices",
-                    "hwidDevices",
-                    "hwid_devices",
-                    "hwids",
-                ):
-                    inner = val.get(kk)
-                    c = _count_any(inner)
-                    if c:
-                        return c
-
-                # fallback scan
-                # (но не путаем лимиты устройств с количеством подключённых устройств)
-                for k, v in val.items():
-                    lk = str(k).lower()
-                    if ("hwid" in lk or "device" in lk or lk in ("data", "items", "list", "rows")) and not any(
-                        x in lk for x in ("limit", "max", "quota")
-                    ):
-                        c = _count_any(v)
+        def _count_any(root) -> int:
+            # Обход в глубину через явный стек вместо рекурсии; порядок просмотра тот же,
+            # что у рекурсивной версии: возвращаем первое ненулевое значение.
+            stack = [root]
+            while stack:
+                val = stack.pop()
+                if val is None:
+                    continue
+                if isinstance(val, list):
+                    if val:
+                        return len(val)
+                    continue
+                if isinstance(val, int):
+                    if val > 0:
+                        return val
+                    continue
+                if isinstance(val, str):
+                    sv = val.strip()
+                    if sv.isdigit():
+                        c = int(sv)
                         if c:
                             return c
+                    continue
+                if isinstance(val, dict):
+                    # ready counts
+                    children = [
+                        val.get(kk)
+                        for kk in ("total", "count", "totalCount", "itemsCount", "total_count", "items_count")
+                    ]
+
+                    # common containers
+                    children.extend(
+                        val.get(kk)
+                        for kk in (
+                            "items",
+                            "data",
+                            "list",
+                            "rows",
+                            "results",
+                            "devices",
+                            "hwidDevices",
+                            "hwid_devices",
+                            "hwids",
+                        )
+                    )
+
+                    # fallback scan
+                    # (но не путаем лимиты устройств с количеством подключённых устройств)
+                    for k, v in val.items():
+                        lk = str(k).lower()
+                        if ("hwid" in lk or "device" in lk or lk in ("data", "items", "list", "rows")) and not any(
+                            x in lk for x in ("limit", "max", "quota")
+                        ):
+                            children.append(v)
+
+                    children.reverse()
+                    stack.extend(children)
             return 0
 
         return _count_any(hwid_payload)
@@ -2990,7 +3595,11 @@ def get_user_router() -> Router:
           2) тариф, выбранный при покупке/продлении (vpn_keys.description JSON -> plan_id)
           3) fallback на первый активный тариф хоста
         """
-        host_name = (key_data or {}).get("host_name")
+        kd = key_data or {}
+        host_name = kd.get("host_name")
+        tag = kd.get("tag") or ""
+        email = kd.get("key_email") or ""
+        desc = kd.get("description")
 
         # 1) Prefer per-key origin info (stored in vpn_keys.description/tag)
         plan_name_from_key = None
@@ -2998,8 +3607,7 @@ def get_user_router() -> Router:
         device_limit_from_key: int | None = None
 
         try:
-            tag = (key_data or {}).get("tag") or ""
-            if str(tag).strip().lower() in {"trial", "триал"}:
+            if _is_trial_tag(tag):
                 plan_name_from_key = "триал"
         except Exception:
             pass
@@ -3007,14 +3615,13 @@ def get_user_router() -> Router:
         # Extra heuristic for legacy trial keys: we often generate emails like "trial_*@bot.local".
         try:
             if plan_name_from_key is None:
-                em = str((key_data or {}).get("key_email") or "")
+                em = str(email)
                 if em.lower().startswith("trial_") or ("@bot.local" in em.lower() and "trial" in em.lower()):
                     plan_name_from_key = "триал"
         except Exception:
             pass
 
         try:
-            desc = (key_data or {}).get("description")
             if isinstance(desc, str) and desc.strip():
                 d = desc.strip()
                 if plan_name_from_key is None and ("trial" in d.lower() or "триал" in d.lower()):
@@ -3085,7 +3692,7 @@ def get_user_router() -> Router:
 
         if not isinstance(plan, dict):
             try:
-                plans = get_active_plans_for_host(host_name) or get_plans_for_host(host_name) or []
+                plans = get_active_plans_for_host_cached(host_name) or get_plans_for_host(host_name) or []
                 plan = plans[0] if plans else None
             except Exception:
                 plan = None
@@ -3138,7 +3745,7 @@ def get_user_router() -> Router:
             else:
                 try:
                     if (not origin_locked) and isinstance(plan_name, str) and not re.search(r"\d", plan_name) and duration_days:
-                        if plan_name.strip().lower() not in {"trial", "триал"}:
+                        if not _is_trial_tag(plan_name):
                             plan_name = f"{duration_days} дней"
                 except Exception:
                     pass
@@ -3150,13 +3757,12 @@ def get_user_router() -> Router:
         # 5) trial fallback
         if device_limit in (None, 0):
             try:
-                tag = (key_data or {}).get("tag") or ""
-                is_trial = str(tag).strip().lower() in {"trial", "триал"} or (plan_name_from_key == "триал")
+                is_trial = _is_trial_tag(tag) or (plan_name_from_key == "триал")
             except Exception:
                 is_trial = False
             if is_trial:
                 try:
-                    raw_dev = (get_setting("trial_device_limit") or "").strip()
+                    raw_dev = (get_setting_cached("trial_device_limit") or "").strip()
                     if raw_dev:
                         v = int(float(raw_dev.replace(",", ".")))
                         if v > 0:
@@ -3167,8 +3773,8 @@ def get_user_router() -> Router:
         # final fallback: if we still don't know origin, at least show current key validity window
         if not plan_name:
             try:
-                created_iso = (key_data or {}).get("created_date") or (key_data or {}).get("created_at")
-                expiry_iso = (key_data or {}).get("expiry_date") or (key_data or {}).get("expire_at")
+                created_iso = kd.get("created_date") or kd.get("created_at")
+                expiry_iso = kd.get("expiry_date") or kd.get("expire_at")
                 if created_iso and expiry_iso:
                     cd = datetime.fromisoformat(str(created_iso))
                     ed = datetime.fromisoformat(str(expiry_iso))
@@ -3186,7 +3792,7 @@ def get_user_router() -> Router:
         group = f"{int(device_limit)} устройств📡"
         return group, plan_name, int(device_limit)
 
-    async def sync_user_keys_with_remnawave(user_id: int) -> int:
+    async def sync_user_keys_with_remnawave(user_id: int) -> tuple[int, list[dict]]:
         """Синхронизирует ключи пользователя в БД с фактическими ключами в Remnawave.
 
         Раньше бот *сразу* удалял ключ из локальной БД, если Remnawave отвечал 404.
@@ -3198,11 +3804,12 @@ def get_user_router() -> Router:
         - удаляем из БД только если ключ отсутствует повторно и "missing_from_server_at" старше 24 часов
         - если ключ снова найден — снимаем пометку missing_from_server_at
 
-        Возвращает количество удалённых из БД ключей.
+        Возвращает (количество удалённых из БД ключей, актуальный список ключей пользователя),
+        чтобы вызывающему коду не приходилось повторно читать ключи из БД.
         """
         keys = get_user_keys(user_id) or []
         if not keys:
-            return 0
+            return 0, []
 
         now_dt = datetime.utcnow()
         grace = timedelta(hours=24)
@@ -3210,6 +3817,15 @@ def get_user_router() -> Router:
         def _parse_missing_dt(value) -> datetime | None:
             if not value:
                 return None
+            # Быстрый путь: БД пишет ровно "YYYY-MM-DD HH:MM:SS" (UTC-naive)
+            if isinstance(value, str) and len(value) == 19 and value[4] == "-" and value[10] == " ":
+                try:
+                    return datetime(
+                        int(value[:4]), int(value[5:7]), int(value[8:10]),
+                        int(value[11:13]), int(value[14:16]), int(value[17:19]),
+                    )
+                except ValueError:
+                    pass
             try:
                 s = str(value).strip()
                 # common formats: "YYYY-MM-DD HH:MM:SS" or ISO
@@ -3225,13 +3841,27 @@ def get_user_router() -> Router:
                 return None
 
         async def _check(key: dict):
-            exists = await _remnawave_key_exists(key)
+            # Зависший Remnawave не должен блокировать экран "Мои ключи":
+            # по таймауту/ошибке считаем результат неизвестным (None) и ничего не трогаем.
+            try:
+                exists = await asyncio.wait_for(_remnawave_key_exists_cached(key), timeout=_KEY_SYNC_PROBE_TIMEOUT)
+            except asyncio.TimeoutError:
+                exists = None
+            except Exception:
+                exists = None
             return key, exists
 
-        tasks = [_check(k) for k in keys]
-        results = await asyncio.gather(*tasks, return_exceptions=True)
+        # TaskGroup отменяет все пробы разом, если отменили саму синхронизацию (например, при остановке бота)
+        async with asyncio.TaskGroup() as tg:
+            tasks = [tg.create_task(_check(k)) for k in keys]
+        results = [t.result() for t in tasks]
 
         removed = 0
+        removed_ids: set[int] = set()
+        missing_str = now_dt.strftime("%Y-%m-%d %H:%M:%S")
+        # Пометки missing_from_server_at копим и пишем в БД одним UPDATE на группу
+        to_mark_missing: list[dict] = []
+        to_clear_missing: list[dict] = []
         for item in results:
             if isinstance(item, Exception):
                 continue
@@ -3247,26 +3877,29 @@ def get_user_router() -> Router:
                     try:
                         if delete_key_by_id(int(key_id)):
                             removed += 1
+                            removed_ids.add(int(key_id))
                     except Exception:
                         pass
                 else:
                     # помечаем как отсутствующий, но не удаляем
-                    try:
-                        database.update_key_fields(
-                            int(key_id),
-                            missing_from_server_at=now_dt.strftime("%Y-%m-%d %H:%M:%S"),
-                        )
-                    except Exception:
-                        pass
+                    to_mark_missing.append(key)
             elif exists is True:
                 # если ранее помечали как missing — снимаем
                 if key.get("missing_from_server_at"):
-                    try:
-                        database.update_key_fields(int(key_id), missing_from_server_at=None)
-                    except Exception:
-                        pass
+                    to_clear_missing.append(key)
+
+        for batch, value in ((to_mark_missing, missing_str), (to_clear_missing, None)):
+            if not batch:
+                continue
+            try:
+                if database.bulk_set_missing_from_server([int(k["key_id"]) for k in batch], value):
+                    for k in batch:
+                        k["missing_from_server_at"] = value
+            except Exception:
+                pass
 
-        return removed
+        live_keys = [k for k in keys if int(k.get("key_id") or 0) not in removed_ids]
+        return removed, live_keys
     # Меняем фильтр: теперь ловим и точный текст, и начало текста для страниц
     @user_router.callback_query(F.data.in_({"manage_keys"}) | F.data.startswith("keys_page_"))
     @registration_required
@@ -3277,17 +3910,19 @@ def get_user_router() -> Router:
         # Если нажали "keys_page_N", вытаскиваем число N.
         page = 0
         if callback.data.startswith("keys_page_"):
-            page = int(callback.data.split("_")[-1])
+            page = int(callback.data.rpartition("_")[2])
 
         # Синхронизацию делаем только при первом входе (на 0-й странице), 
         # чтобы не тормозить перелистывание.
+        # Синхронизация уже возвращает актуальный список ключей — повторно в БД не ходим.
+        synced = None
         if page == 0:
             try:
-                await sync_user_keys_with_remnawave(user_id)
+                synced = await sync_user_keys_with_remnawave(user_id)
             except Exception:
-                pass
+                synced = None
 
-        user_keys = get_user_keys(user_id)
+        user_keys = synced[1] if synced else get_user_keys(user_id)
         
         await callback.message.edit_text(
             "Ваши ключи:" if user_keys else "У вас пока нет ключей.",
@@ -3342,7 +3977,7 @@ def get_user_router() -> Router:
         
         # Получаем номер страницы
         try:
-            page = int(callback.data.split("_")[-1])
+            page = int(callback.data.rpartition("_")[2])
         except (IndexError, ValueError):
             await callback.answer("❌ Ошибка в данных", show_alert=True)
             return
@@ -3382,7 +4017,7 @@ def get_user_router() -> Router:
             await callback.answer("Вы уже использовали бесплатный пробный период.", show_alert=True)
             return
 
-        hosts = get_all_hosts()
+        hosts = get_all_hosts_cached()
         if not hosts:
             await callback.message.edit_text("❌ В данный момент нет доступных серверов для создания пробного ключа.")
             return
@@ -3394,7 +4029,7 @@ def get_user_router() -> Router:
             await callback.answer()
             await callback.message.edit_text(
                 "Выберите сервер, на котором хотите получить пробный ключ:",
-                reply_markup=keyboards.create_host_selection_keyboard(hosts, action="trial")
+                reply_markup=_host_selection_keyboard(hosts, action="trial")
             )
 
     @user_router.callback_query(F.data.startswith("select_host_trial_"))
@@ -3406,7 +4041,7 @@ def get_user_router() -> Router:
 
     async def process_trial_key_creation(message: types.Message, host_name: str):
         user_id = message.chat.id
-        await message.edit_text(f"Отлично! Создаю для вас бесплатный ключ на {get_setting('trial_duration_days')} дня на сервере \"{host_name}\"...")
+        await message.edit_text(f"Отлично! Создаю для вас бесплатный ключ на {get_setting_cached('trial_duration_days')} дня на сервере \"{host_name}\"...")
 
         try:
 
@@ -3419,7 +4054,7 @@ def get_user_router() -> Router:
             traffic_limit_bytes = None
             hwid_device_limit = None
             try:
-                raw_gb = (get_setting('trial_traffic_limit_gb') or '').strip()
+                raw_gb = (get_setting_cached('trial_traffic_limit_gb') or '').strip()
                 if raw_gb:
                     gb = float(raw_gb.replace(',', '.'))
                     if gb > 0:
@@ -3428,7 +4063,7 @@ def get_user_router() -> Router:
                 traffic_limit_bytes = None
 
             try:
-                raw_dev = (get_setting('trial_device_limit') or '').strip()
+                raw_dev = (get_setting_cached('trial_device_limit') or '').strip()
                 if raw_dev:
                     dev = int(float(raw_dev.replace(',', '.')))
                     if dev > 0:
@@ -3440,7 +4075,7 @@ def get_user_router() -> Router:
                 result = await remnawave_api.create_or_update_key_on_host(
                     host_name=host_name,
                     email=candidate_email,
-                    days_to_add=int(get_setting("trial_duration_days")),
+                    days_to_add=int(get_setting_cached("trial_duration_days")),
                     traffic_limit_bytes=traffic_limit_bytes,
                     traffic_limit_strategy='NO_RESET' if traffic_limit_bytes is not None else None,
                     hwid_device_limit=hwid_device_limit,
@@ -3483,7 +4118,7 @@ def get_user_router() -> Router:
 
             # Persist origin info so "🕒 Тариф" shows "триал".
             try:
-                td = int(get_setting("trial_duration_days") or 0)
+                td = int(get_setting_cached("trial_duration_days") or 0)
             except Exception:
                 td = 0
             origin_desc = _build_key_origin_meta(
@@ -3514,22 +4149,27 @@ def get_user_router() -> Router:
     @user_router.callback_query(F.data.startswith("show_key_"))
     @registration_required
     async def show_key_handler(callback: types.CallbackQuery):
-        key_id_to_show = int(callback.data.split("_")[2])
+        key_id_to_show = int(callback.data.rpartition("_")[2])
+        user_id = callback.from_user.id
+        key_data = rw_repo.get_key_by_id(key_id_to_show)
+
+        # Чужой/устаревший ключ — только алерт, без edit_text и запросов в Remnawave
+        if not key_data or key_data.get('user_id') != user_id:
+            await callback.answer("Ключ не найден.", show_alert=True)
+            return
         # Answer callback immediately to avoid Telegram client "spinner" and perceived hangs.
         try:
             await callback.answer()
         except Exception:
             pass
         await callback.message.edit_text("Загружаю информацию о ключе...")
-        user_id = callback.from_user.id
-        key_data = rw_repo.get_key_by_id(key_id_to_show)
 
-        if not key_data or key_data['user_id'] != user_id:
-            await callback.message.edit_text("❌ Ошибка: ключ не найден.")
-            return
-            
         try:
-            details = await remnawave_api.get_key_details_from_host(key_data)
+            # Порядковый номер ключа (SQLite) считаем в потоке, пока идёт запрос в Remnawave
+            details, key_number = await asyncio.gather(
+                remnawave_api.get_key_details_from_host(key_data),
+                asyncio.to_thread(rw_repo.get_key_ordinal, user_id, key_id_to_show),
+            )
             if not details or not details.get('connection_string'):
                 # Если ключ удалён в Remnawave, удалим его и локально, чтобы не висел в списке.
                 try:
@@ -3551,15 +4191,13 @@ def get_user_router() -> Router:
                 return
 
             connection_string = details['connection_string']
-            expiry_date = datetime.fromisoformat(key_data['expiry_date'])
-            created_date = datetime.fromisoformat(key_data['created_date'])
-            
-            all_user_keys = get_user_keys(user_id)
-            key_number = next((i + 1 for i, key in enumerate(all_user_keys) if key['key_id'] == key_id_to_show), 0)
-            
+            _remember_connection_string(key_id_to_show, key_data.get('host_name'), connection_string)
+
             user_payload = details.get('user') if isinstance(details, dict) else None
-            devices_connected = await _get_connected_devices_count(key_data, user_payload)
-            plan_group, plan_name, device_limit = _get_tariff_info_for_key(key_data, user_payload)
+            devices_connected, (plan_group, plan_name, device_limit) = await asyncio.gather(
+                _get_connected_devices_count(key_data, user_payload),
+                asyncio.to_thread(_get_tariff_info_for_key, key_data, user_payload),
+            )
             final_text = get_key_info_text(
                 key_data,
                 key_number,
@@ -3580,7 +4218,6 @@ def get_user_router() -> Router:
     @user_router.callback_query(F.data.startswith("switch_server_"))
     @registration_required
     async def switch_server_start(callback: types.CallbackQuery):
-        await callback.answer()
         try:
             key_id = int(callback.data[len("switch_server_"):])
         except ValueError:
@@ -3592,7 +4229,7 @@ def get_user_router() -> Router:
             await callback.answer("Ключ не найден.", show_alert=True)
             return
 
-        hosts = get_all_hosts()
+        hosts = get_all_hosts_cached()
         if not hosts:
             await callback.answer("Нет доступных серверов.", show_alert=True)
             return
@@ -3603,15 +4240,15 @@ def get_user_router() -> Router:
             await callback.answer("Другие серверы отсутствуют.", show_alert=True)
             return
 
+        await callback.answer()
         await callback.message.edit_text(
             "Выберите новый сервер (локацию) для этого ключа:",
-            reply_markup=keyboards.create_host_selection_keyboard(hosts, action=f"switch_{key_id}")
+            reply_markup=_host_selection_keyboard(hosts, action=f"switch_{key_id}")
         )
 
     @user_router.callback_query(F.data.startswith("select_host_switch_"))
     @registration_required
     async def select_host_for_switch(callback: types.CallbackQuery):
-        await callback.answer()
         payload = callback.data[len("select_host_switch_"):]
         parts = payload.split("_", 1)
         if len(parts) != 2:
@@ -3637,29 +4274,37 @@ def get_user_router() -> Router:
         if new_host_name == old_host:
             await callback.answer("Это уже текущий сервер.", show_alert=True)
             return
-
+        await callback.answer()
 
         try:
-            expiry_dt = datetime.fromisoformat(key_data['expiry_date'])
+            expiry_dt = _parse_iso(key_data['expiry_date'])
             expiry_timestamp_ms_exact = int(expiry_dt.timestamp() * 1000)
         except Exception:
 
             now_dt = datetime.now()
             expiry_timestamp_ms_exact = int((now_dt + timedelta(days=1)).timestamp() * 1000)
 
-        await callback.message.edit_text(
-            f"⏳ Переношу ключ на сервер \"{new_host_name}\"..."
-        )
-
         email = key_data.get('key_email')
         try:
-
-            result = await remnawave_api.create_or_update_key_on_host(
+            switch_task = asyncio.create_task(remnawave_api.create_or_update_key_on_host(
                 new_host_name,
                 email,
                 days_to_add=None,
                 expiry_timestamp_ms=expiry_timestamp_ms_exact
-            )
+            ))
+            # Промежуточное «⏳ Переношу...» шлём, только если Remnawave отвечает дольше порога:
+            # на быстром пути пользователь сразу видит итоговое сообщение (одно edit_text вместо двух)
+            done, _ = await asyncio.wait({switch_task}, timeout=_SWITCH_PROGRESS_DELAY)
+            if not done:
+                # Прогресс — best-effort: ошибка правки сообщения не должна бросать
+                # уже запущенный перенос на полпути (ключ остался бы на двух панелях)
+                try:
+                    await callback.message.edit_text(
+                        f"⏳ Переношу ключ на сервер \"{new_host_name}\"..."
+                    )
+                except Exception as exc:
+                    logger.debug(f"Switch progress edit failed for key {key_id}: {exc}")
+            result = await switch_task
             if not result:
                 await callback.message.edit_text(
                     f"❌ Не удалось перенести ключ на сервер \"{new_host_name}\". Попробуйте позже."
@@ -3667,11 +4312,14 @@ def get_user_router() -> Router:
                 return
 
 
-            try:
-                await remnawave_api.delete_client_on_host(old_host, email)
-            except Exception:
-                pass
+            async def _safe_delete_old_client():
+                try:
+                    await remnawave_api.delete_client_on_host(old_host, email)
+                except Exception as exc:
+                    logger.warning(f"Failed to delete key {key_id} ({email}) from old host {old_host}: {exc}")
 
+            # Удаление со старого сервера пользователю не нужно ждать — уводим в фон
+            _spawn_background(_safe_delete_old_client(), name=f"switch-delete-{key_id}")
 
             update_key_host_and_info(
                 key_id=key_id,
@@ -3682,17 +4330,18 @@ def get_user_router() -> Router:
 
 
             try:
+                # create_or_update_key_on_host уже вернул ссылку и payload пользователя —
+                # повторный запрос деталей к новому хосту не нужен
                 updated_key = rw_repo.get_key_by_id(key_id)
-                details = await remnawave_api.get_key_details_from_host(updated_key)
-                if details and details.get('connection_string'):
-                    connection_string = details['connection_string']
-                    expiry_date = datetime.fromisoformat(updated_key['expiry_date'])
-                    created_date = datetime.fromisoformat(updated_key['created_date'])
-                    all_user_keys = get_user_keys(callback.from_user.id)
-                    key_number = next((i + 1 for i, k in enumerate(all_user_keys) if k['key_id'] == key_id), 0)
-                    user_payload = details.get('user') if isinstance(details, dict) else None
-                    devices_connected = await _get_connected_devices_count(updated_key, user_payload)
-                    plan_group, plan_name, device_limit = _get_tariff_info_for_key(updated_key, user_payload)
+                connection_string = result.get('connection_string')
+                if updated_key and connection_string:
+                    _remember_connection_string(key_id, new_host_name, connection_string)
+                    key_number = rw_repo.get_key_ordinal(callback.from_user.id, key_id)
+                    user_payload = result.get('user')
+                    devices_connected, (plan_group, plan_name, device_limit) = await asyncio.gather(
+                        _get_connected_devices_count(updated_key, user_payload),
+                        asyncio.to_thread(_get_tariff_info_for_key, updated_key, user_payload),
+                    )
                     final_text = get_key_info_text(
                         updated_key,
                         key_number,
@@ -3727,342 +4376,89 @@ def get_user_router() -> Router:
     @user_router.callback_query(F.data.startswith("show_qr_"))
     @registration_required
     async def show_qr_handler(callback: types.CallbackQuery):
-        await callback.answer("Генерирую QR-код...")
-        key_id = int(callback.data.split("_")[2])
+        key_id = int(callback.data.rpartition("_")[2])
         key_data = rw_repo.get_key_by_id(key_id)
-        if not key_data or key_data['user_id'] != callback.from_user.id: return
+        if not key_data or key_data.get('user_id') != callback.from_user.id:
+            await callback.answer("Ключ не найден.", show_alert=True)
+            return
+        await callback.answer("Генерирую QR-код...")
         
         try:
-            details = await remnawave_api.get_key_details_from_host(key_data)
-            if not details or not details['connection_string']:
-                await callback.answer("Ошибка: Не удалось сгенерировать QR-код.", show_alert=True)
-                return
-
-            connection_string = details['connection_string']
-            qr_img = qrcode.make(connection_string)
-            bio = BytesIO(); qr_img.save(bio, "PNG"); bio.seek(0)
-            qr_code_file = BufferedInputFile(bio.read(), filename="vpn_qr.png")
+            connection_string = _cached_connection_string(key_data)
+            if not connection_string:
+                details = await remnawave_api.get_key_details_from_host(key_data)
+                if not details or not details['connection_string']:
+                    await callback.answer("Ошибка: Не удалось сгенерировать QR-код.", show_alert=True)
+                    return
+                connection_string = details['connection_string']
+                _remember_connection_string(key_id, key_data.get('host_name'), connection_string)
+            png = await asyncio.to_thread(_render_qr, connection_string)
+            qr_code_file = BufferedInputFile(png, filename="vpn_qr.png")
             await callback.message.answer_photo(photo=qr_code_file)
         except Exception as e:
             logger.error(f"Error showing QR for key {key_id}: {e}")
 
-    @user_router.callback_query(F.data.startswith("howto_vless_"))
-    @registration_required
-    async def show_instruction_handler(callback: types.CallbackQuery):
-        await callback.answer()
-        key_id = int(callback.data.split("_")[2])
-
-        intro_text = get_setting("howto_intro_text") or "Выберите вашу платформу для инструкции по подключению VLESS:"
-        await callback.message.edit_text(
-            intro_text,
-            reply_markup=keyboards.create_howto_vless_keyboard_key(key_id),
-            disable_web_page_preview=True
-        )
-    
-    @user_router.callback_query(F.data.startswith("howto_vless"))
+    @user_router.callback_query(F.data.regexp(_HOWTO_INTRO_CALLBACK_RE))
     @registration_required
     async def show_instruction_handler(callback: types.CallbackQuery):
         await callback.answer()
+        match = _HOWTO_INTRO_CALLBACK_RE.match(callback.data or "")
+        key_id = int(match.group(1)) if match and match.group(1) else 0
 
-        intro_text = get_setting("howto_intro_text") or "Выберите вашу платформу для инструкции по подключению VLESS:"
+        intro_text = get_setting_cached("howto_intro_text") or _HOWTO_INTRO_DEFAULT
         await callback.message.edit_text(
             intro_text,
-            reply_markup=keyboards.create_howto_vless_keyboard(),
+            reply_markup=keyboards.create_howto_vless_keyboard_key(key_id) if key_id > 0 else _get_howto_markup(),
             disable_web_page_preview=True
         )
 
-    @user_router.callback_query(F.data == "howto_android")
+    @user_router.callback_query(F.data.regexp(_HOWTO_CALLBACK_RE))
     @registration_required
-    async def howto_android_handler(callback: types.CallbackQuery):
+    async def howto_platform_handler(callback: types.CallbackQuery):
         await callback.answer()
-        text = get_setting("howto_android_text") or (
-            "<b>Подключение на Android</b>\n\n"
-            "1. <b>Установите приложение V2RayTun:</b> Загрузите и установите приложение V2RayTun из Google Play Store.\n"
-            "2. <b>Скопируйте свой ключ (vless://)</b> Перейдите в раздел «Моя подписка» в нашем боте и скопируйте свой ключ.\n"
-            "3. <b>Импортируйте конфигурацию:</b>\n"
-            "   • Откройте V2RayTun.\n"
-            "   • Нажмите на значок + в правом нижнем углу.\n"
-            "   • Выберите «Импортировать конфигурацию из буфера обмена» (или аналогичный пункт).\n"
-            "4. <b>Выберите сервер:</b> Выберите появившийся сервер в списке.\n"
-            "5. <b>Подключитесь к VPN:</b> Нажмите на кнопку подключения (значок «V» или воспроизведения). Возможно, потребуется разрешение на создание VPN-подключения.\n"
-            "6. <b>Проверьте подключение:</b> После подключения проверьте свой IP-адрес, например, на https://whatismyipaddress.com/. Он должен отличаться от вашего реального IP."
-        )
-        markup = keyboards.create_howto_vless_keyboard()
-
-        current_text = callback.message.text or ""
-        current_markup = callback.message.reply_markup
-
-        if current_markup and hasattr(current_markup, "model_dump"):
-            current_markup_dump = current_markup.model_dump()
-        else:
-            current_markup_dump = current_markup
-
-        if markup and hasattr(markup, "model_dump"):
-            new_markup_dump = markup.model_dump()
-        else:
-            new_markup_dump = markup
-
-        if current_text == text and current_markup_dump == new_markup_dump:
+        match = _HOWTO_CALLBACK_RE.match(callback.data or "")
+        if not match:
             return
+        platform, key_raw = match.group(1), match.group(2)
+        setting_key, default_text = _HOWTO[platform]
+        text = get_setting_cached(setting_key) or default_text
+        key_id = int(key_raw) if key_raw else 0
 
-        try:
-            await callback.message.edit_text(
-                text,
-                reply_markup=markup,
-                disable_web_page_preview=True
-            )
-        except TelegramBadRequest as exc:
-            error_message = getattr(exc, "message", str(exc))
-            if "message is not modified" not in error_message.lower():
-                raise
-            logger.debug(
-                "Skipping edit_text for howto_android_handler: message is not modified"
-            )
-
-    @user_router.callback_query(F.data.startswith("howto_android_"))
-    @registration_required
-    async def howto_android_key_handler(callback: types.CallbackQuery):
-        await callback.answer()
-        try:
-            key_id = int((callback.data or "").split("_")[2])
-        except Exception:
-            key_id = 0
-        text = get_setting("howto_android_text") or (
-            "<b>Подключение на Android</b>\n\n"
-            "1. <b>Установите приложение V2RayTun:</b> Загрузите и установите приложение V2RayTun из Google Play Store.\n"
-            "2. <b>Скопируйте свой ключ (vless://)</b> Перейдите в раздел <Моя подписка> в нашем боте и скопируйте свой ключ.\n"
-            "3. <b>Импортируйте конфигурацию:</b>\n"
-            "    Откройте V2RayTun.\n"
-            "    Нажмите на значок + в правом нижнем углу.\n"
-            "    Выберите <Импортировать конфигурацию из буфера обмена> (или аналогичный пункт).\n"
-            "4. <b>Выберите сервер:</b> Выберите появившийся сервер в списке.\n"
-            "5. <b>Подключитесь к VPN:</b> Нажмите на кнопку подключения (значок <V> или воспроизведения). Возможно, потребуется разрешение на создание VPN-подключения.\n"
-            "6. <b>Проверьте подключение:</b> После подключения проверьте свой IP-адрес, например, на https://whatismyipaddress.com/. Он должен отличаться от вашего реального IP."
-        )
-        markup = keyboards.create_howto_vless_keyboard_key(key_id) if key_id > 0 else keyboards.create_howto_vless_keyboard()
-        try:
-            await callback.message.edit_text(text, reply_markup=markup, disable_web_page_preview=True)
-        except TelegramBadRequest as exc:
-            error_message = getattr(exc, "message", str(exc))
-            if "message is not modified" not in error_message.lower():
-                raise
-
-    @user_router.callback_query(F.data == "howto_ios")
-    @registration_required
-    async def howto_ios_handler(callback: types.CallbackQuery):
-        await callback.answer()
-        text = get_setting("howto_ios_text") or (
-            "<b>Подключение на iOS (iPhone/iPad)</b>\n\n"
-            "1. <b>Установите приложение V2RayTun:</b> Загрузите и установите приложение V2RayTun из App Store.\n"
-            "2. <b>Скопируйте свой ключ (vless://):</b> Перейдите в раздел «Моя подписка» в нашем боте и скопируйте свой ключ.\n"
-            "3. <b>Импортируйте конфигурацию:</b>\n"
-            "   • Откройте V2RayTun.\n"
-            "   • Нажмите на значок +.\n"
-            "   • Выберите «Импортировать конфигурацию из буфера обмена» (или аналогичный пункт).\n"
-            "4. <b>Выберите сервер:</b> Выберите появившийся сервер в списке.\n"
-            "5. <b>Подключитесь к VPN:</b> Включите главный переключатель в V2RayTun. Возможно, потребуется разрешить создание VPN-подключения.\n"
-            "6. <b>Проверьте подключение:</b> После подключения проверьте свой IP-адрес, например, на https://whatismyipaddress.com/. Он должен отличаться от вашего реального IP."
-        )
-        await callback.message.edit_text(
-            text,
-            reply_markup=keyboards.create_howto_vless_keyboard(),
-            disable_web_page_preview=True
-        )
-
-    @user_router.callback_query(F.data.startswith("howto_ios_"))
-    @registration_required
-    async def howto_ios_key_handler(callback: types.CallbackQuery):
-        await callback.answer()
-        try:
-            key_id = int((callback.data or "").split("_")[2])
-        except Exception:
-            key_id = 0
-        text = get_setting("howto_ios_text") or (
-            "<b>Подключение на iOS (iPhone/iPad)</b>\n\n"
-            "1. <b>Установите приложение V2RayTun:</b> Загрузите и установите приложение V2RayTun из App Store.\n"
-            "2. <b>Скопируйте свой ключ (vless://):</b> Перейдите в раздел <Моя подписка> в нашем боте и скопируйте свой ключ.\n"
-            "3. <b>Импортируйте конфигурацию:</b>\n"
-            "    Откройте V2RayTun.\n"
-            "    Нажмите на значок +.\n"
-            "    Выберите <Импортировать конфигурацию из буфера обмена> (или аналогичный пункт).\n"
-            "4. <b>Выберите сервер:</b> Выберите появившийся сервер в списке.\n"
-            "5. <b>Подключитесь к VPN:</b> Включите главный переключатель в V2RayTun. Возможно, потребуется разрешить создание VPN-подключения.\n"
-            "6. <b>Проверьте подключение:</b> После подключения проверьте свой IP-адрес, например, на https://whatismyipaddress.com/. Он должен отличаться от вашего реального IP."
-        )
-        markup = keyboards.create_howto_vless_keyboard_key(key_id) if key_id > 0 else keyboards.create_howto_vless_keyboard()
-        try:
-            await callback.message.edit_text(text, reply_markup=markup, disable_web_page_preview=True)
-        except TelegramBadRequest as exc:
-            error_message = getattr(exc, "message", str(exc))
-            if "message is not modified" not in error_message.lower():
-                raise
-
-    @user_router.callback_query(F.data == "howto_windows")
-    @registration_required
-    async def howto_windows_handler(callback: types.CallbackQuery):
-        await callback.answer()
-        text = get_setting("howto_windows_text") or (
-            "<b>Подключение на Windows</b>\n\n"
-            "1. <b>Установите приложение Nekoray:</b> Загрузите Nekoray с https://github.com/MatsuriDayo/Nekoray/releases. Выберите подходящую версию (например, Nekoray-x64.exe).\n"
-            "2. <b>Распакуйте архив:</b> Распакуйте скачанный архив в удобное место.\n"
-            "3. <b>Запустите Nekoray.exe:</b> Откройте исполняемый файл.\n"
-            "4. <b>Скопируйте свой ключ (vless://)</b> Перейдите в раздел «Моя подписка» в нашем боте и скопируйте свой ключ.\n"
-            "5. <b>Импортируйте конфигурацию:</b>\n"
-            "   • В Nekoray нажмите «Сервер» (Server).\n"
-            "   • Выберите «Импортировать из буфера обмена».\n"
-            "   • Nekoray автоматически импортирует конфигурацию.\n"
-            "6. <b>Обновите серверы (если нужно):</b> Если серверы не появились, нажмите «Серверы» → «Обновить все серверы».\n"
-            "7. Сверху включите пункт 'Режим TUN' ('Tun Mode')\n"
-            "8. <b>Выберите сервер:</b> В главном окне выберите появившийся сервер.\n"
-            "9. <b>Подключитесь к VPN:</b> Нажмите «Подключить» (Connect).\n"
-            "10. <b>Проверьте подключение:</b> Откройте браузер и проверьте IP на https://whatismyipaddress.com/. Он должен отличаться от вашего реального IP."
-        )
-        markup = keyboards.create_howto_vless_keyboard()
-
-        current_text = callback.message.text or ""
-        current_markup = callback.message.reply_markup
-
-        if current_markup and hasattr(current_markup, "model_dump"):
-            current_markup_dump = current_markup.model_dump()
-        else:
-            current_markup_dump = current_markup
-
-        if markup and hasattr(markup, "model_dump"):
-            new_markup_dump = markup.model_dump()
-        else:
-            new_markup_dump = markup
-
-        if current_text == text and current_markup_dump == new_markup_dump:
-            return
-
-        try:
-            await callback.message.edit_text(
-                text,
-                reply_markup=markup,
-                disable_web_page_preview=True
-            )
-        except TelegramBadRequest as exc:
-            error_message = getattr(exc, "message", str(exc))
-            if "message is not modified" not in error_message.lower():
-                raise
-            logger.debug(
-                "Skipping edit_text for howto_windows_handler: message is not modified"
-            )
-
-    @user_router.callback_query(F.data.startswith("howto_windows_"))
-    @registration_required
-    async def howto_windows_key_handler(callback: types.CallbackQuery):
-        await callback.answer()
-        try:
-            key_id = int((callback.data or "").split("_")[2])
-        except Exception:
-            key_id = 0
-        text = get_setting("howto_windows_text") or (
-            "<b>Подключение на Windows</b>\n\n"
-            "1. <b>Установите приложение Nekoray:</b> Загрузите Nekoray с https://github.com/MatsuriDayo/Nekoray/releases. Выберите подходящую версию (например, Nekoray-x64.exe).\n"
-            "2. <b>Распакуйте архив:</b> Распакуйте скачанный архив в удобное место.\n"
-            "3. <b>Запустите Nekoray.exe:</b> Откройте исполняемый файл.\n"
-            "4. <b>Скопируйте свой ключ (vless://)</b> Перейдите в раздел <Моя подписка> в нашем боте и скопируйте свой ключ.\n"
-            "5. <b>Импортируйте конфигурацию:</b>\n"
-            "    В Nekoray нажмите <Сервер> (Server).\n"
-            "    Выберите <Импортировать из буфера обмена>.\n"
-            "    Nekoray автоматически импортирует конфигурацию.\n"
-            "6. <b>Обновите серверы (если нужно):</b> Если серверы не появились, нажмите <Серверы>  <Обновить все серверы>.\n"
-            "7. Сверху включите пункт 'Режим TUN' ('Tun Mode')\n"
-            "8. <b>Выберите сервер:</b> В главном окне выберите появившийся сервер.\n"
-            "9. <b>Подключитесь к VPN:</b> Нажмите <Подключить> (Connect).\n"
-            "10. <b>Проверьте подключение:</b> Откройте браузер и проверьте IP на https://whatismyipaddress.com/. Он должен отличаться от вашего реального IP."
-        )
-        markup = keyboards.create_howto_vless_keyboard_key(key_id) if key_id > 0 else keyboards.create_howto_vless_keyboard()
-        try:
-            await callback.message.edit_text(text, reply_markup=markup, disable_web_page_preview=True)
-        except TelegramBadRequest as exc:
-            error_message = getattr(exc, "message", str(exc))
-            if "message is not modified" not in error_message.lower():
-                raise
-
-    @user_router.callback_query(F.data == "howto_linux")
-    @registration_required
-    async def howto_linux_handler(callback: types.CallbackQuery):
-        await callback.answer()
-        text = get_setting("howto_linux_text") or (
-            "<b>Подключение на Linux</b>\n\n"
-            "1. <b>Скачайте и распакуйте Nekoray:</b> Перейдите на https://github.com/MatsuriDayo/Nekoray/releases и скачайте архив для Linux. Распакуйте его в удобную папку.\n"
-            "2. <b>Запустите Nekoray:</b> Откройте терминал, перейдите в папку с Nekoray и выполните <code>./nekoray</code> (или используйте графический запуск, если доступен).\n"
-            "3. <b>Скопируйте свой ключ (vless://)</b> Перейдите в раздел «Моя подписка» в нашем боте и скопируйте свой ключ.\n"
-            "4. <b>Импортируйте конфигурацию:</b>\n"
-            "   • В Nekoray нажмите «Сервер» (Server).\n"
-            "   • Выберите «Импортировать из буфера обмена».\n"
-            "   • Nekoray автоматически импортирует конфигурацию.\n"
-            "5. <b>Обновите серверы (если нужно):</b> Если серверы не появились, нажмите «Серверы» → «Обновить все серверы».\n"
-            "6. Сверху включите пункт 'Режим TUN' ('Tun Mode')\n"
-            "7. <b>Выберите сервер:</b> В главном окне выберите появившийся сервер.\n"
-            "8. <b>Подключитесь к VPN:</b> Нажмите «Подключить» (Connect).\n"
-            "9. <b>Проверьте подключение:</b> Откройте браузер и проверьте IP на https://whatismyipaddress.com/. Он должен отличаться от вашего реального IP."
-        )
-        await callback.message.edit_text(
-            text,
-            reply_markup=keyboards.create_howto_vless_keyboard(),
-            disable_web_page_preview=True
-        )
-
-    @user_router.callback_query(F.data.startswith("howto_linux_"))
-    @registration_required
-    async def howto_linux_key_handler(callback: types.CallbackQuery):
-        await callback.answer()
-        try:
-            key_id = int((callback.data or "").split("_")[2])
-        except Exception:
-            key_id = 0
-        text = get_setting("howto_linux_text") or (
-            "<b>Подключение на Linux</b>\n\n"
-            "1. <b>Скачайте и распакуйте Nekoray:</b> Перейдите на https://github.com/MatsuriDayo/Nekoray/releases и скачайте архив для Linux. Распакуйте его в удобную папку.\n"
-            "2. <b>Запустите Nekoray:</b> Откройте терминал, перейдите в папку с Nekoray и выполните <code>./nekoray</code> (или используйте графический запуск, если доступен).\n"
-            "3. <b>Скопируйте свой ключ (vless://)</b> Перейдите в раздел <Моя подписка> в нашем боте и скопируйте свой ключ.\n"
-            "4. <b>Импортируйте конфигурацию:</b>\n"
-            "    В Nekoray нажмите <Сервер> (Server).\n"
-            "    Выберите <Импортировать из буфера обмена>.\n"
-            "    Nekoray автоматически импортирует конфигурацию.\n"
-            "5. <b>Обновите серверы (если нужно):</b> Если серверы не появились, нажмите <Серверы>  <Обновить все серверы>.\n"
-            "6. Сверху включите пункт 'Режим TUN' ('Tun Mode')\n"
-            "7. <b>Выберите сервер:</b> В главном окне выберите появившийся сервер.\n"
-            "8. <b>Подключитесь к VPN:</b> Нажмите <Подключить> (Connect).\n"
-            "9. <b>Проверьте подключение:</b> Откройте браузер и проверьте IP на https://whatismyipaddress.com/. Он должен отличаться от вашего реального IP."
-        )
-        markup = keyboards.create_howto_vless_keyboard_key(key_id) if key_id > 0 else keyboards.create_howto_vless_keyboard()
+        markup = keyboards.create_howto_vless_keyboard_key(key_id) if key_id > 0 else _get_howto_markup()
         try:
             await callback.message.edit_text(text, reply_markup=markup, disable_web_page_preview=True)
         except TelegramBadRequest as exc:
             error_message = getattr(exc, "message", str(exc))
             if "message is not modified" not in error_message.lower():
                 raise
+            logger.debug("Skipping edit_text for howto_%s: message is not modified", platform)
 
     @user_router.callback_query(F.data == "gift_new_key")
     @registration_required
     async def gift_new_key_handler(callback: types.CallbackQuery):
         await callback.answer()
-        hosts = get_all_hosts()
+        hosts = get_all_hosts_cached()
         if not hosts:
             await callback.message.edit_text("❌ В данный момент нет доступных серверов для покупки.")
             return
         
         await callback.message.edit_text(
             "Выберите сервер, на котором хотите подарить ключ:",
-            reply_markup=keyboards.create_host_selection_keyboard(hosts, action="gift")
+            reply_markup=_host_selection_keyboard(hosts, action="gift")
         )
 
     @user_router.callback_query(F.data == "buy_new_key")
     @registration_required
     async def buy_new_key_handler(callback: types.CallbackQuery):
         await callback.answer()
-        hosts = get_all_hosts()
+        hosts = get_all_hosts_cached()
         if not hosts:
             await callback.message.edit_text("❌ В данный момент нет доступных серверов для покупки.")
             return
         
         await callback.message.edit_text(
             "Выберите сервер, на котором хотите приобрести ключ:",
-            reply_markup=keyboards.create_host_selection_keyboard(hosts, action="new")
+            reply_markup=_host_selection_keyboard(hosts, action="new")
         )
 
     @user_router.callback_query(F.data.startswith("select_host_new_"))
@@ -4070,7 +4466,7 @@ def get_user_router() -> Router:
     async def select_host_for_purchase_handler(callback: types.CallbackQuery):
         await callback.answer()
         host_name = callback.data[len("select_host_new_"):]
-        plans = get_active_plans_for_host(host_name)
+        plans = get_active_plans_for_host_cached(host_name)
         if not plans:
             await callback.message.edit_text(f"❌ Для сервера \"{host_name}\" не настроены тарифы.")
             return
@@ -4083,7 +4479,7 @@ def get_user_router() -> Router:
     async def select_host_for_gift_handler(callback: types.CallbackQuery):
         await callback.answer()
         host_name = callback.data[len("select_host_gift_"):]
-        plans = get_active_plans_for_host(host_name)
+        plans = get_active_plans_for_host_cached(host_name)
         if not plans:
             await callback.message.edit_text(f"❌ Для сервера \"{host_name}\" не настроены тарифы.")
             return
@@ -4096,27 +4492,25 @@ def get_user_router() -> Router:
     @user_router.callback_query(F.data.startswith("extend_key_"))
     @registration_required
     async def extend_key_handler(callback: types.CallbackQuery):
-        await callback.answer()
-
         try:
-            key_id = int(callback.data.split("_")[2])
+            key_id = int(callback.data.rpartition("_")[2])
         except (IndexError, ValueError):
-            await callback.message.edit_text("❌ Произошла ошибка. Неверный формат ключа.")
+            await callback.answer("Некорректный идентификатор ключа.", show_alert=True)
             return
 
-        key_data = rw_repo.get_key_by_id(key_id)
+        # Ключ и активные тарифы его хоста (тарифы — из кэша)
+        key_data, plans = rw_repo.get_key_with_plans(key_id)
 
-        if not key_data or key_data['user_id'] != callback.from_user.id:
-            await callback.message.edit_text("❌ Ошибка: Ключ не найден или не принадлежит вам.")
+        if not key_data or key_data.get('user_id') != callback.from_user.id:
+            await callback.answer("Ключ не найден.", show_alert=True)
             return
-        
+        await callback.answer()
+
         host_name = key_data.get('host_name')
         if not host_name:
             await callback.message.edit_text("❌ Ошибка: У этого ключа не указан сервер. Обратитесь в поддержку.")
             return
 
-        plans = get_active_plans_for_host(host_name)
-
         if not plans:
             await callback.message.edit_text(
                 f"❌ Извините, для сервера \"{host_name}\" в данный момент не настроены тарифы для продления."
@@ -4137,18 +4531,31 @@ def get_user_router() -> Router:
     @registration_required
     async def plan_selection_handler(callback: types.CallbackQuery, state: FSMContext):
         await callback.answer()
-        
-        parts = callback.data.split("_")[1:]
-        action = parts[-2]
-        key_id = int(parts[-1])
-        plan_id = int(parts[-3])
-        host_name = "_".join(parts[:-3])
+
+        payload = callback.data[len("buy_"):]
+        resolved = keyboards.resolve_plan_token(payload)
+        if resolved is not None:
+            host_name, plan_id, action, key_id = resolved
+        else:
+            # Старый формат кнопок: buy_<host_name>_<plan_id>_<action>_<key_id>;
+            # host_name может содержать "_"
+            parts = payload.rsplit("_", 3)
+            try:
+                host_name, plan_id_raw, action, key_id_raw = parts
+                plan_id = int(plan_id_raw)
+                key_id = int(key_id_raw)
+            except ValueError:
+                await callback.message.edit_text(
+                    "⌛ Кнопка устарела. Откройте список тарифов заново.",
+                    reply_markup=keyboards.create_back_to_menu_keyboard()
+                )
+                return
 
         await state.update_data(
             action=action, key_id=key_id, plan_id=plan_id, host_name=host_name
         )
 
-        email_prompt_enabled = (_is_true(get_setting("payment_email_prompt_enabled") or "false"))
+        email_prompt_enabled = (_is_true(get_setting_cached("payment_email_prompt_enabled") or "false"))
         if email_prompt_enabled:
             await callback.message.edit_text(
                 "📧 Пожалуйста, введите ваш email для отправки чека об оплате.\n\n"
@@ -4175,7 +4582,7 @@ def get_user_router() -> Router:
                     reply_markup=keyboards.create_back_to_menu_keyboard()
                 )
                 return
-            plans = get_active_plans_for_host(host_name)
+            plans = await _db(get_active_plans_for_host_cached, host_name)
             if not plans:
                 await callback.message.edit_text(f"❌ Для сервера \"{host_name}\" не настроены тарифы.")
                 return
@@ -4196,7 +4603,7 @@ def get_user_router() -> Router:
                     reply_markup=keyboards.create_back_to_menu_keyboard()
                 )
                 return
-            key_data = rw_repo.get_key_by_id(key_id)
+            key_data = await _db(rw_repo.get_key_by_id, key_id)
             if not key_data or key_data.get('user_id') != callback.from_user.id:
                 await callback.message.edit_text("❌ Ошибка: Ключ не найден или не принадлежит вам.")
                 return
@@ -4204,7 +4611,7 @@ def get_user_router() -> Router:
             if not host_name:
                 await callback.message.edit_text("❌ Ошибка: У этого ключа не указан сервер. Обратитесь в поддержку.")
                 return
-            plans = get_active_plans_for_host(host_name)
+            plans = await _db(get_active_plans_for_host_cached, host_name)
             if not plans:
                 await callback.message.edit_text(
                     f"❌ Извините, для сервера \"{host_name}\" в данный момент не настроены тарифы для продления."
@@ -4241,8 +4648,25 @@ def get_user_router() -> Router:
 
     async def show_payment_options(message: types.Message, state: FSMContext):
         data = await state.get_data()
-        user_data = get_user(message.chat.id)
-        plan = get_plan_by_id(data.get('plan_id'))
+        chat_id = message.chat.id
+        promo_code = (data.get('promo_code') or '').strip()
+
+        def _balance_or_zero() -> float:
+            try:
+                return get_balance(chat_id)
+            except Exception:
+                return 0.0
+
+        async def _no_promo():
+            return None, None
+
+        # Независимые чтения из БД — параллельно, а не четыре запроса подряд
+        user_data, plan, main_balance, (promo, promo_err) = await asyncio.gather(
+            _db(get_user, chat_id),
+            _db(get_plan_by_id, data.get('plan_id')),
+            _db(_balance_or_zero),
+            _db(check_promo_code_available_cached, promo_code, chat_id) if promo_code else _no_promo(),
+        )
         
         if not plan:
             try:
@@ -4257,31 +4681,28 @@ def get_user_router() -> Router:
         discount_applied = False
         message_text = CHOOSE_PAYMENT_METHOD_MESSAGE
 
-        if user_data.get('referred_by') and user_data.get('total_spent', 0) == 0:
-            discount_percentage_str = get_setting("referral_discount") or "0"
-            discount_percentage = Decimal(discount_percentage_str)
-            
-            if discount_percentage > 0:
-                discount_amount = (price * discount_percentage / 100).quantize(Decimal("0.01"))
-                final_price = price - discount_amount
+        discount_percentage = _referral_discount_percent(user_data)
+        if discount_percentage > 0:
+            discount_amount = (price * discount_percentage / 100).quantize(_D_CENT)
+            final_price = price - discount_amount
 
-                message_text = (
-                    f"🎉 Как приглашенному пользователю, на вашу первую покупку предоставляется скидка {discount_percentage_str}%!\n"
-                    f"Старая цена: <s>{price:.2f} RUB</s>\n"
-                    f"<b>Новая цена: {final_price:.2f} RUB</b>\n\n"
-                ) + CHOOSE_PAYMENT_METHOD_MESSAGE
+            message_text = (
+                f"🎉 Как приглашенному пользователю, на вашу первую покупку предоставляется скидка {discount_percentage}%!\n"
+                f"Старая цена: <s>{price:.2f} RUB</s>\n"
+                f"<b>Новая цена: {final_price:.2f} RUB</b>\n\n"
+            ) + CHOOSE_PAYMENT_METHOD_MESSAGE
 
-        promo_code = (data.get('promo_code') or '').strip()
-        promo_discount_amount = Decimal('0')
+        promo_discount_amount = _D_ZERO
+        # Все изменения FSM копим здесь и пишем одним update_data
+        updates: dict = {}
 
         if promo_code:
             # Re-check promo validity (it could be disabled/expired while user is on the payment screen)
-            promo, promo_err = check_promo_code_available(promo_code, message.chat.id)
             if promo_err:
                 # Drop promo from state if it's no longer applicable
-                await state.update_data(promo_code=None, promo_discount=0, promo_percent=None, promo_amount=None)
+                updates.update(promo_code=None, promo_discount=0, promo_percent=None, promo_amount=None)
                 promo_code = ''
-                promo_discount_amount = Decimal('0')
+                promo_discount_amount = _D_ZERO
                 message_text = (
                     "⚠️ Промокод больше недействителен и был снят.\n\n"
                 ) + message_text
@@ -4289,77 +4710,78 @@ def get_user_router() -> Router:
                 try:
                     percent = Decimal(str(promo.get('discount_percent') or 0))
                 except Exception:
-                    percent = Decimal('0')
+                    percent = _D_ZERO
                 try:
                     amount = Decimal(str(promo.get('discount_amount') or 0))
                 except Exception:
-                    amount = Decimal('0')
+                    amount = _D_ZERO
 
                 if percent > 0:
-                    promo_discount_amount = (final_price * percent / 100).quantize(Decimal('0.01'))
+                    promo_discount_amount = (final_price * percent / 100).quantize(_D_CENT)
                 elif amount > 0:
-                    promo_discount_amount = amount.quantize(Decimal('0.01')) if hasattr(amount, 'quantize') else Decimal(str(amount))
+                    promo_discount_amount = amount.quantize(_D_CENT) if hasattr(amount, 'quantize') else Decimal(str(amount))
                 if promo_discount_amount > 0:
                     # Clamp so price never becomes 0 or negative
                     if promo_discount_amount >= final_price:
-                        promo_discount_amount = (final_price - Decimal('0.01')).quantize(Decimal('0.01'))
-                    final_price = (final_price - promo_discount_amount).quantize(Decimal('0.01'))
-                    if final_price < Decimal('0.01'):
-                        final_price = Decimal('0.01')
+                        promo_discount_amount = (final_price - _D_CENT).quantize(_D_CENT)
+                    final_price = (final_price - promo_discount_amount).quantize(_D_CENT)
+                    if final_price < _D_CENT:
+                        final_price = _D_CENT
                     message_text = (
                         f"🎟 Промокод {promo_code} применён!\n"
                         f"Старая цена: <s>{price:.2f} RUB</s>\n"
                         f"<b>Новая цена: {final_price:.2f} RUB</b>\n\n"
                     ) + CHOOSE_PAYMENT_METHOD_MESSAGE
 
-                await state.update_data(
+                updates.update(
                     promo_code=promo.get('code'),
                     promo_percent=float(percent) if percent and percent > 0 else None,
                     promo_amount=float(amount) if amount and amount > 0 else None,
                     promo_discount=float(promo_discount_amount) if promo_discount_amount > 0 else 0,
                 )
 
-        await state.update_data(final_price=float(final_price))
-
-
-        try:
-            main_balance = get_balance(message.chat.id)
-        except Exception:
-            main_balance = 0.0
-
         show_balance_btn = main_balance >= float(final_price)
+        markup = keyboards.create_payment_method_keyboard(
+            payment_methods=_get_payment_methods(),
+            action=data.get('action'),
+            key_id=data.get('key_id'),
+            show_balance=show_balance_btn,
+            main_balance=main_balance,
+            price=float(final_price),
+            promo_applied=bool(data.get('promo_code')),
+        )
+
+        # Повторное нажатие с тем же результатом: не дёргаем Telegram ради
+        # "message is not modified". Клавиатуру сверяем и с текущей у сообщения —
+        # между рендерами его могли отредактировать (ввод промокода, email)
+        buttons = tuple((b.text, b.callback_data) for row in markup.inline_keyboard for b in row)
+        current_markup = getattr(message, "reply_markup", None)
+        current_buttons = tuple(
+            (b.text, b.callback_data) for row in current_markup.inline_keyboard for b in row
+        ) if current_markup is not None and getattr(current_markup, "inline_keyboard", None) else None
+        render_hash = hash((message.chat.id, message.message_id, message_text, buttons))
+        updates.update(
+            final_price=float(final_price),
+            final_price_decimal=str(final_price),
+            last_render_hash=render_hash,
+        )
+        await state.update_data(**updates)
+        if data.get('last_render_hash') == render_hash and current_buttons == buttons:
+            await state.set_state(PaymentProcess.waiting_for_payment_method)
+            return
 
         try:
-            await message.edit_text(
-                message_text,
-                reply_markup=keyboards.create_payment_method_keyboard(
-                    payment_methods=_get_payment_methods(),
-                    action=data.get('action'),
-                    key_id=data.get('key_id'),
-                    show_balance=show_balance_btn,
-                    main_balance=main_balance,
-                    price=float(final_price),
-                    promo_applied=bool(data.get('promo_code')),
-                )
-            )
+            await message.edit_text(message_text, reply_markup=markup)
         except TelegramBadRequest:
-            await message.answer(
-                message_text,
-                reply_markup=keyboards.create_payment_method_keyboard(
-                    payment_methods=_get_payment_methods(),
-                    action=data.get('action'),
-                    key_id=data.get('key_id'),
-                    show_balance=show_balance_btn,
-                    main_balance=main_balance,
-                    price=float(final_price)
-                )
-        )
+            await message.answer(message_text, reply_markup=markup)
+            # Исходное сообщение не изменилось — следующий рендер не должен считаться повтором
+            await state.update_data(last_render_hash=None)
         await state.set_state(PaymentProcess.waiting_for_payment_method)
 
     @user_router.callback_query(PaymentProcess.waiting_for_payment_method, F.data == "back_to_email_prompt")
     async def back_to_email_prompt_handler(callback: types.CallbackQuery, state: FSMContext):
         await callback.answer()
-        email_prompt_enabled = (_is_true(get_setting("payment_email_prompt_enabled") or "false"))
+        email_prompt_enabled = (_is_true(get_setting_cached("payment_email_prompt_enabled") or "false"))
         if not email_prompt_enabled:
             await back_to_plans_handler(callback, state)
             return
@@ -4390,10 +4812,10 @@ def get_user_router() -> Router:
         if not code_raw:
             await message.answer("❌ Промокод не должен быть пустым. Попробуйте снова или напишите 'отмена'.")
             return
-        if code_raw.lower() in {"отмена", "cancel", "назад", "stop", "стоп"}:
+        if code_raw.lower() in _CANCEL_WORDS:
             await show_payment_options(message, state)
             return
-        promo, error = check_promo_code_available(code_raw, message.from_user.id)
+        promo, error = await _db(check_promo_code_available_cached, code_raw, message.from_user.id)
         if error:
             errors = {
                 "not_found": "❌ Промокод не найден.",
@@ -4410,16 +4832,16 @@ def get_user_router() -> Router:
         percent = Decimal(str(promo.get('discount_percent') or 0))
         if percent > 0:
             data = await state.get_data()
-            plan = get_plan_by_id(data.get('plan_id'))
-            plan_price = Decimal(str(plan['price'])) if plan else Decimal('0')
-            discount_amount = (plan_price * percent / 100).quantize(Decimal("0.01"))
+            plan = await _db(get_plan_by_id, data.get('plan_id'))
+            plan_price = Decimal(str(plan['price'])) if plan else _D_ZERO
+            discount_amount = (plan_price * percent / 100).quantize(_D_CENT)
         if discount_amount <= 0:
             await message.answer("❌ Промокод не даёт скидку. Обратитесь в поддержку.")
             return
         try:
             promo_amount_raw = Decimal(str(promo.get('discount_amount') or 0))
         except Exception:
-            promo_amount_raw = Decimal('0')
+            promo_amount_raw = _D_ZERO
         await state.update_data(
             promo_code=promo['code'],
             promo_percent=float(percent) if percent and percent > 0 else None,
@@ -4429,13 +4851,12 @@ def get_user_router() -> Router:
         await message.answer(f"✅ Промокод {promo['code']} применён! Скидка: {float(discount_amount):.2f} RUB.")
         await show_payment_options(message, state)
 
-    @user_router.callback_query(PaymentProcess.waiting_for_payment_method, F.data == "pay_yookassa")
     async def create_yookassa_payment_handler(callback: types.CallbackQuery, state: FSMContext):
         await callback.answer("Создаю ссылку на оплату...")
         
         # Ensure YooKassa configuration is set
-        yookassa_shop_id = get_setting("yookassa_shop_id")
-        yookassa_secret_key = get_setting("yookassa_secret_key")
+        yookassa_shop_id = get_setting_cached("yookassa_shop_id")
+        yookassa_secret_key = get_setting_cached("yookassa_secret_key")
         
         if not yookassa_shop_id or not yookassa_secret_key:
             await callback.message.answer("❌ YooKassa не настроен. Обратитесь к администратору.")
@@ -4444,50 +4865,27 @@ def get_user_router() -> Router:
             
         Configuration.account_id = yookassa_shop_id
         Configuration.secret_key = yookassa_secret_key
-        
+        await _show_payment_placeholder(callback.message)
+
         data = await state.get_data()
-        user_data = get_user(callback.from_user.id)
-        
         plan_id = data.get('plan_id')
-        plan = get_plan_by_id(plan_id)
+        plan = await _db(get_plan_by_id, plan_id)
 
         if not plan:
-            await callback.message.answer("Произошла ошибка при выборе тарифа.")
+            await callback.message.edit_text("Произошла ошибка при выборе тарифа.")
             await state.clear()
             return
 
-        base_price = Decimal(str(plan['price']))
-        price_rub = base_price
-
-        if user_data.get('referred_by') and user_data.get('total_spent', 0) == 0:
-            discount_percentage_str = get_setting("referral_discount") or "0"
-            discount_percentage = Decimal(discount_percentage_str)
-            if discount_percentage > 0:
-                discount_amount = (base_price * discount_percentage / 100).quantize(Decimal("0.01"))
-                base_price -= discount_amount
+        price_rub = _final_price_from_state(data, plan, callback.from_user.id)
         promo_code = data.get('promo_code')
-        promo_discount = Decimal(str(data.get('promo_discount', 0)))
-        if promo_code and promo_discount > 0:
-            discount_amount = promo_discount
-            base_price = (base_price - discount_amount).quantize(Decimal("0.01"))
-            if base_price < Decimal('0.01'):
-                base_price = Decimal('0.01')
-        price_rub = base_price
 
-        plan_id = data.get('plan_id')
         customer_email = data.get('customer_email')
         host_name = data.get('host_name')
         action = data.get('action')
         key_id = data.get('key_id')
         
         if not customer_email:
-            customer_email = get_setting("receipt_email")
-
-        plan = get_plan_by_id(plan_id)
-        if not plan:
-            await callback.message.answer("Произошла ошибка при выборе тарифа.")
-            await state.clear()
-            return
+            customer_email = get_setting_cached("receipt_email")
 
         months = int(plan.get('months') or 0)
         duration_days = int(plan.get('duration_days') or 0)
@@ -4511,7 +4909,7 @@ def get_user_router() -> Router:
                         "payment_mode": "full_payment"
                     }]
                 }
-            payment_id = str(uuid.uuid4())
+            payment_id = str(_new_uuid())
             metadata = {
                 "user_id": int(user_id),
                 "months": int(months),
@@ -4528,7 +4926,7 @@ def get_user_router() -> Router:
                 "payment_id": payment_id,
             }
             try:
-                create_payload_pending(payment_id, int(user_id), float(price_float_for_metadata), metadata)
+                await _db(create_payload_pending, payment_id, int(user_id), float(price_float_for_metadata), metadata)
             except Exception as e:
                 logger.warning(f"YooKassa: не удалось создать pending для {payment_id}: {e}")
 
@@ -4542,13 +4940,11 @@ def get_user_router() -> Router:
             if receipt:
                 payment_payload['receipt'] = receipt
 
-            payment = Payment.create(payment_payload, uuid.uuid4())
+            payment = await asyncio.to_thread(Payment.create, payment_payload, _new_uuid())
             try:
                 provider_payment_id = getattr(payment, "id", None)
                 if provider_payment_id:
-                    metadata2 = dict(metadata)
-                    metadata2["yookassa_payment_id"] = str(provider_payment_id)
-                    create_payload_pending(payment_id, int(user_id), float(price_float_for_metadata), metadata2)
+                    await _db(update_pending_metadata, payment_id, {"yookassa_payment_id": str(provider_payment_id)})
             except Exception as e:
                 logger.warning(f"YooKassa: не удалось сохранить provider id для {payment_id}: {e}")
             
@@ -4560,52 +4956,38 @@ def get_user_router() -> Router:
             )
         except Exception as e:
             logger.error(f"Failed to create YooKassa payment: {e}", exc_info=True)
-            await callback.message.answer("Не удалось создать ссылку на оплату.")
+            await callback.message.edit_text("Не удалось создать ссылку на оплату.")
             await state.clear()
 
     
-    @user_router.callback_query(PaymentProcess.waiting_for_payment_method, F.data == "pay_platega")
     async def pay_platega_handler(callback: types.CallbackQuery, state: FSMContext):
         await callback.answer("Создаю ссылку Platega...")
         if not _platega_is_enabled():
             await callback.message.edit_text("❌ Platega не настроен. Обратитесь к администратору.")
             await state.clear()
             return
+        await _show_payment_placeholder(callback.message)
 
         data = await state.get_data()
         plan_id = data.get('plan_id')
-        plan = get_plan_by_id(plan_id)
+        plan = await _db(get_plan_by_id, plan_id)
         if not plan:
             await callback.message.edit_text("❌ Ошибка: Тариф не найден.")
             await state.clear()
             return
 
         # финальная цена (учитывает рефералку/промокод)
-        base_price = Decimal(str(plan['price']))
-        user_data = get_user(callback.from_user.id) or {}
-        if user_data.get('referred_by') and user_data.get('total_spent', 0) == 0:
-            try:
-                discount_percentage = Decimal(str(get_setting("referral_discount") or "0"))
-            except Exception:
-                discount_percentage = Decimal('0')
-            if discount_percentage > 0:
-                base_price -= (base_price * discount_percentage / 100).quantize(Decimal("0.01"))
-
+        base_price = _final_price_from_state(data, plan, callback.from_user.id)
         promo_code = data.get('promo_code')
-        promo_discount = Decimal(str(data.get('promo_discount', 0)))
-        if promo_code and promo_discount > 0:
-            base_price = (base_price - promo_discount).quantize(Decimal("0.01"))
-            if base_price < Decimal('0.01'):
-                base_price = Decimal('0.01')
 
-        payment_id = str(uuid.uuid4())
+        payment_id = str(_new_uuid())
 
         months = int(plan.get('months') or 0)
         duration_days = int(plan.get('duration_days') or 0)
         host_name = data.get('host_name')
         action = data.get('action')
         key_id = data.get('key_id')
-        customer_email = data.get('customer_email') or get_setting("receipt_email")
+        customer_email = data.get('customer_email') or get_setting_cached("receipt_email")
 
         metadata = {
             "user_id": callback.from_user.id,
@@ -4624,7 +5006,7 @@ def get_user_router() -> Router:
         }
 
         # сохраняем pending
-        create_payload_pending(payment_id, callback.from_user.id, float(base_price), metadata)
+        await _db(create_payload_pending, payment_id, callback.from_user.id, float(base_price), metadata)
 
         desc = f"Подписка на {months} мес." if months else "Оплата подписки"
         pay_url, txid = await _create_platega_payment_link(amount_rub=base_price, payment_id=payment_id, description=desc)
@@ -4635,9 +5017,7 @@ def get_user_router() -> Router:
 
         # обновляем pending с id транзакции (для ручной проверки)
         try:
-            metadata2 = dict(metadata)
-            metadata2["platega_transaction_id"] = txid
-            create_payload_pending(payment_id, callback.from_user.id, float(base_price), metadata2)
+            await _db(update_pending_metadata, payment_id, {"platega_transaction_id": txid})
         except Exception:
             pass
 
@@ -4647,12 +5027,10 @@ def get_user_router() -> Router:
         )
         await state.clear()
 
-    @user_router.callback_query(PaymentProcess.waiting_for_payment_method, F.data == "pay_cryptobot")
     async def create_cryptobot_invoice_handler(callback: types.CallbackQuery, state: FSMContext):
         await callback.answer("Создаю счет в Crypto Pay...")
         
         data = await state.get_data()
-        user_data = get_user(callback.from_user.id)
         
         plan_id = data.get('plan_id')
         user_id = data.get('user_id', callback.from_user.id)
@@ -4661,45 +5039,22 @@ def get_user_router() -> Router:
         action = data.get('action')
         key_id = data.get('key_id')
 
-        cryptobot_token = get_setting('cryptobot_token')
+        cryptobot_token = get_setting_cached('cryptobot_token')
         if not cryptobot_token:
             logger.error(f"Attempt to create Crypto Pay invoice failed for user {user_id}: cryptobot_token is not set.")
             await callback.message.edit_text("❌ Оплата криптовалютой временно недоступна. (Администратор не указал токен).")
             await state.clear()
             return
+        await _show_payment_placeholder(callback.message)
 
-        plan = get_plan_by_id(plan_id)
+        plan = await _db(get_plan_by_id, plan_id)
         if not plan:
             logger.error(f"Attempt to create Crypto Pay invoice failed for user {user_id}: Plan with id {plan_id} not found.")
             await callback.message.edit_text("❌ Произошла ошибка при выборе тарифа.")
             await state.clear()
             return
-        
-        plan_id = data.get('plan_id')
-        plan = get_plan_by_id(plan_id)
-
-        if not plan:
-            await callback.message.answer("Произошла ошибка при выборе тарифа.")
-            await state.clear()
-            return
 
-        base_price = Decimal(str(plan['price']))
-        price_rub_decimal = base_price
-
-        if user_data.get('referred_by') and user_data.get('total_spent', 0) == 0:
-            discount_percentage_str = get_setting("referral_discount") or "0"
-            discount_percentage = Decimal(discount_percentage_str)
-            if discount_percentage > 0:
-                discount_amount = (base_price * discount_percentage / 100).quantize(Decimal("0.01"))
-                base_price -= discount_amount
-        promo_code = data.get('promo_code')
-        promo_discount = Decimal(str(data.get('promo_discount', 0)))
-        if promo_code and promo_discount > 0:
-            discount_amount = promo_discount
-            base_price = (base_price - discount_amount).quantize(Decimal("0.01"))
-            if base_price < Decimal('0.01'):
-                base_price = Decimal('0.01')
-        price_rub_decimal = base_price
+        price_rub_decimal = _final_price_from_state(data, plan, callback.from_user.id)
         months = int(plan.get('months') or 0)
         duration_days = int(plan.get('duration_days') or 0)
         duration_label = _format_duration_label(months, duration_days)
@@ -4735,7 +5090,11 @@ def get_user_router() -> Router:
             await callback.message.answer("❌ Некорректный идентификатор инвойса.")
             return
 
-        token = (get_setting("cryptobot_token") or "").strip()
+        if _invoice_processed(invoice_id):
+            await callback.message.answer("✅ Платёж уже обработан.")
+            return
+
+        token = (get_setting_cached("cryptobot_token") or "").strip()
         if not token:
             await callback.message.answer("❌ CryptoBot токен не задан.")
             return
@@ -4748,14 +5107,14 @@ def get_user_router() -> Router:
         body = {"invoice_ids": [invoice_id]}
 
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, headers=headers, json=body, timeout=20) as resp:
-                    if resp.status != 200:
-                        text = await resp.text()
-                        logger.error(f"CryptoBot getInvoices HTTP {resp.status}: {text}")
-                        await callback.message.answer("⏳ Оплата ещё не поступила. Попробуйте позже.")
-                        return
-                    data = await resp.json(content_type=None)
+            session = _get_http_session()
+            async with session.post(url, headers=headers, data=_json_dumps(body), timeout=20) as resp:
+                if resp.status != 200:
+                    text = await resp.text()
+                    logger.error(f"CryptoBot getInvoices HTTP {resp.status}: {text}")
+                    await callback.message.answer("⏳ Оплата ещё не поступила. Попробуйте позже.")
+                    return
+                data = _json_loads(await resp.read())
         except Exception as e:
             logger.error(f"CryptoBot getInvoices failed: {e}", exc_info=True)
             await callback.message.answer("⏳ Не удалось проверить статус. Попробуйте позже.")
@@ -4784,6 +5143,7 @@ def get_user_router() -> Router:
         if not payload_string:
             await callback.message.answer("⚠️ Оплата получена, но отсутствует payload. Обратитесь в поддержку.")
             return
+        inv_cents = _invoice_amount_cents(inv)
 
         # New format: payload == our internal payment_id
         if ':' not in payload_string:
@@ -4794,9 +5154,8 @@ def get_user_router() -> Router:
                 return
             # Amount check (fiat RUB invoices)
             try:
-                inv_amount = Decimal(str(inv.get("amount") or inv.get("fiat_amount") or inv.get("paid_amount") or '0')).quantize(Decimal('0.01'))
-                exp_amount = Decimal(str(pending.get('price') or '0')).quantize(Decimal('0.01'))
-                if exp_amount > 0 and inv_amount != exp_amount:
+                exp_cents = _to_cents(pending.get('price'))
+                if inv_cents is not None and exp_cents > 0 and inv_cents != exp_cents:
                     await callback.message.answer("⚠️ Сумма оплаты не совпала с ожидаемой. Обратитесь в поддержку.")
                     return
             except Exception:
@@ -4808,10 +5167,15 @@ def get_user_router() -> Router:
                 return
 
             try:
-                await process_successful_payment(bot, metadata)
-                await callback.message.answer("✅ Оплата получена! Профиль/баланс скоро обновится.")
+                processed = await process_successful_payment(bot, metadata)
             except Exception as e:
                 logger.error(f"CryptoBot manual check: process_successful_payment failed: {e}", exc_info=True)
+                processed = False
+            if processed:
+                # Кэшируем инвойс, только когда платёж действительно занят и выдан (или уже был обработан)
+                _mark_invoice_processed(invoice_id)
+                await callback.message.answer("✅ Оплата получена! Профиль/баланс скоро обновится.")
+            else:
                 await callback.message.answer("⚠️ Оплата получена, но обработка не завершена. Обратитесь в поддержку.")
             return
 
@@ -4820,44 +5184,51 @@ def get_user_router() -> Router:
         if len(p) < 9:
             await callback.message.answer("⚠️ Оплата получена, но формат данных некорректен. Обратитесь в поддержку.")
             return
+        uid, months_s, price_s, action, kid, host, plan, email_raw, pm = p[:9]
 
         # Amount check for legacy payload
         try:
-            inv_amount = Decimal(str(inv.get("amount") or inv.get("fiat_amount") or inv.get("paid_amount") or '0')).quantize(Decimal('0.01'))
-            exp_amount = Decimal(str(p[2] or '0')).quantize(Decimal('0.01'))
-            if exp_amount > 0 and inv_amount != exp_amount:
+            exp_cents = _to_cents(price_s)
+            if inv_cents is not None and exp_cents > 0 and inv_cents != exp_cents:
                 await callback.message.answer("⚠️ Сумма оплаты не совпала с ожидаемой. Обратитесь в поддержку.")
                 return
         except Exception:
             pass
 
         metadata = {
-            "user_id": p[0],
-            "months": p[1],
-            "price": p[2],
-            "action": p[3],
-            "key_id": p[4],
-            "host_name": p[5],
-            "plan_id": p[6],
-            "customer_email": (p[7] if p[7] != 'None' else None),
-            "payment_method": p[8] or 'CryptoBot',
+            "user_id": uid,
+            "months": months_s,
+            "price": price_s,
+            "action": action,
+            "key_id": kid,
+            "host_name": host,
+            "plan_id": plan,
+            "customer_email": (email_raw if email_raw != 'None' else None),
+            "payment_method": pm or 'CryptoBot',
             "transaction_id": str(invoice_id),
             "payment_id": f'cryptobot:{invoice_id}',
         }
+        if len(p) >= 10:
+            metadata["promo_code"] = (p[9] if p[9] != 'None' else None)
+        if len(p) >= 11:
+            metadata["promo_discount"] = p[10]
 
         try:
-            await process_successful_payment(bot, metadata)
-            await callback.message.answer("✅ Оплата получена! Профиль/баланс скоро обновится.")
+            processed = await process_successful_payment(bot, metadata)
         except Exception as e:
             logger.error(f"CryptoBot manual check: process_successful_payment failed: {e}", exc_info=True)
+            processed = False
+        if processed:
+            _mark_invoice_processed(invoice_id)
+            await callback.message.answer("✅ Оплата получена! Профиль/баланс скоро обновится.")
+        else:
             await callback.message.answer("⚠️ Оплата получена, но обработка не завершена. Обратитесь в поддержку.")
-    @user_router.callback_query(PaymentProcess.waiting_for_payment_method, F.data == "pay_tonconnect")
     async def create_ton_invoice_handler(callback: types.CallbackQuery, state: FSMContext):
         logger.info(f"User {callback.from_user.id}: Entered create_ton_invoice_handler.")
         data = await state.get_data()
         user_id = callback.from_user.id
-        wallet_address = get_setting("ton_wallet_address")
-        plan = get_plan_by_id(data.get('plan_id'))
+        wallet_address = get_setting_cached("ton_wallet_address")
+        plan = await _db(get_plan_by_id, data.get('plan_id'))
         
         if not wallet_address or not plan:
             await callback.message.edit_text("❌ Оплата через TON временно недоступна.")
@@ -4876,42 +5247,32 @@ def get_user_router() -> Router:
             await state.clear()
             return
 
-        price_ton = (price_rub / usdt_rub_rate / ton_usdt_rate).quantize(Decimal("0.001"), rounding=ROUND_HALF_UP)
+        with localcontext(_TON_CTX):
+            price_ton = (price_rub / usdt_rub_rate / ton_usdt_rate).quantize(_D_TON_QUANT)
         amount_nanoton = int(price_ton * 1_000_000_000)
         
-        payment_id = str(uuid.uuid4())
-        metadata = {
-            "user_id": user_id, "months": int(plan.get('months') or 0), "duration_days": int(plan.get('duration_days') or 0), "price": float(price_rub),
-            "action": data.get('action'), "key_id": data.get('key_id'),
-            "host_name": data.get('host_name'), "plan_id": data.get('plan_id'),
-            "customer_email": data.get('customer_email'), "payment_method": "TON Connect",
-            "expected_amount_ton": float(price_ton)
-        }
-        create_pending_transaction(payment_id, user_id, float(price_rub), metadata)
+        payment_id = str(_new_uuid())
+        metadata = _plan_payment_metadata(
+            data, plan, user_id=user_id, price=price_rub, payment_method="TON Connect",
+            expected_amount_ton=float(price_ton),
+        )
+        await _db(create_pending_transaction, payment_id, user_id, float(price_rub), metadata)
 
         transaction_payload = {
             'messages': [{'address': wallet_address, 'amount': str(amount_nanoton), 'payload': payment_id}],
-            'valid_until': int(datetime.now().timestamp()) + 600
+            'valid_until': int(time.time()) + 600
         }
 
         try:
             connect_url = await _start_ton_connect_process(user_id, transaction_payload)
             
-            qr_img = qrcode.make(connect_url)
-            bio = BytesIO()
-            qr_img.save(bio, "PNG")
-            qr_file = BufferedInputFile(bio.getvalue(), "ton_qr.png")
+            qr_png = await asyncio.to_thread(_render_qr, connect_url)
+            qr_file = BufferedInputFile(qr_png, "ton_qr.png")
 
             await callback.message.delete()
             await callback.message.answer_photo(
                 photo=qr_file,
-                caption=(
-                    f"💎 **Оплата через TON Connect**\n\n"
-                    f"Сумма к оплате: `{price_ton}` **TON**\n\n"
-                    f"✅ **Способ 1 (на телефоне):** Нажмите кнопку **'Открыть кошелек'** ниже.\n"
-                    f"✅ **Способ 2 (на компьютере):** Отсканируйте QR-код кошельком.\n\n"
-                    f"После подключения кошелька подтвердите транзакцию."
-                ),
+                caption=_TON_CAPTION_TMPL % (price_ton,),
                 parse_mode="Markdown",
                 reply_markup=keyboards.create_ton_connect_keyboard(connect_url)
             )
@@ -4922,52 +5283,60 @@ def get_user_router() -> Router:
             await callback.message.answer("❌ Не удалось создать ссылку для TON Connect. Попробуйте позже.")
             await state.clear()
 
-    @user_router.callback_query(PaymentProcess.waiting_for_payment_method, F.data == "pay_balance")
     async def pay_with_main_balance_handler(callback: types.CallbackQuery, state: FSMContext, bot: Bot):
         await callback.answer()
         data = await state.get_data()
         user_id = callback.from_user.id
-        plan = get_plan_by_id(data.get('plan_id'))
+        plan = await _db(get_plan_by_id, data.get('plan_id'))
         if not plan:
             await callback.message.edit_text("❌ Ошибка: Тариф не найден.")
             await state.clear()
             return
-        months = int(plan.get('months') or 0)
-        duration_days = int(plan.get('duration_days') or 0)
         price = float(data.get('final_price', plan['price']))
 
 
-        if not deduct_from_balance(user_id, price):
+        if not await _db(deduct_from_balance, user_id, price):
             await callback.answer("Недостаточно средств на основном балансе.", show_alert=True)
             return
 
         promo_code = (data.get('promo_code') or '').strip() if isinstance(data, dict) else ''
         promo_discount = float(data.get('promo_discount') or 0) if promo_code else 0.0
 
-        metadata = {
-            "user_id": user_id,
-            "months": months,
-            "duration_days": duration_days,
-            "price": price,
-            "action": data.get('action'),
-            "key_id": data.get('key_id'),
-            "host_name": data.get('host_name'),
-            "plan_id": data.get('plan_id'),
-            "customer_email": data.get('customer_email'),
-            "payment_method": "Balance",
-            "chat_id": callback.message.chat.id,
-            "message_id": callback.message.message_id,
-            "promo_code": promo_code,
-            "promo_discount": promo_discount,
-        }
+        metadata = _plan_payment_metadata(
+            data, plan, user_id=user_id, price=price, payment_method="Balance",
+            chat_id=callback.message.chat.id,
+            message_id=callback.message.message_id,
+            promo_code=promo_code,
+            promo_discount=promo_discount,
+        )
         # Для оплаты с внутреннего баланса у нас нет внешнего идентификатора платежа.
         # Генерируем уникальный payment_id, чтобы process_successful_payment смог
         # корректно отработать и пройти идемпотентную проверку.
-        metadata.setdefault("payment_id", f"balance:{user_id}:{uuid.uuid4()}")
+        metadata.setdefault("payment_id", f"balance:{user_id}:{_new_uuid()}")
 
         await state.clear()
         await process_successful_payment(bot, metadata)
 
+    # Способы оплаты на экране выбора: одна регистрация в роутере вместо семи фильтров
+    # F.data == "pay_*", обработчик выбирается по словарю
+    _PAYMENT_METHOD_HANDLERS = {
+        "pay_stars": create_stars_invoice_handler,
+        "pay_yoomoney": pay_yoomoney_handler,
+        "pay_yookassa": create_yookassa_payment_handler,
+        "pay_platega": pay_platega_handler,
+        "pay_cryptobot": create_cryptobot_invoice_handler,
+        "pay_tonconnect": create_ton_invoice_handler,
+        "pay_balance": pay_with_main_balance_handler,
+    }
+
+    @user_router.callback_query(PaymentProcess.waiting_for_payment_method, F.data.in_(frozenset(_PAYMENT_METHOD_HANDLERS)))
+    async def payment_method_handler(callback: types.CallbackQuery, state: FSMContext, bot: Bot):
+        handler = _PAYMENT_METHOD_HANDLERS[callback.data]
+        if callback.data == "pay_balance":
+            await handler(callback, state, bot)
+        else:
+            await handler(callback, state)
+
     
 
     
@@ -4980,8 +5349,7 @@ def get_user_router() -> Router:
             return
         if text.startswith("@"):
             text = text[1:]
-        import re as _re
-        if not _re.match(r"^[A-Za-z0-9_]{5,}$", text):
+        if not _GIFT_USERNAME_RE.match(text):
             return
         
         pending = None
@@ -5023,7 +5391,7 @@ def get_user_router() -> Router:
                 except Exception:
                     recipient_email = f"{recipient_id}-{int(time.time())}@bot.local"
         if not recipient_email:
-            recipient_email = f"gift-{uuid.uuid4().hex[:8]}@bot.local"
+            recipient_email = f"gift-{_new_uuid().hex[:8]}@bot.local"
         
         try:
             result = await remnawave_api.create_or_update_key_on_host(
@@ -5061,40 +5429,47 @@ def get_user_router() -> Router:
             )
             return
         
-        # Привязываем ключ к локальному аккаунту получателя, если он уже пользовался ботом
-        try:
-            ru = recipient_user or get_user_by_username(text)
-            if ru and ru.get('telegram_id'):
-                rw_repo.record_key_from_payload(
-                    user_id=int(ru['telegram_id']),
-                    payload=result,
-                    host_name=host_name,
-                    tag="paid",
-                    description=_build_key_origin_meta(
-                        source="gift",
-                        plan_id=None,
-                        plan_name=None,
-                        months=months,
-                        duration_days=duration_days,
-                        is_trial=False,
-                        note=f"Gift received from {message.from_user.id}",
+        sender_id = message.from_user.id
+
+        def _finalize_gift() -> None:
+            # Привязываем ключ к локальному аккаунту получателя, если он уже пользовался ботом
+            try:
+                ru = recipient_user
+                if ru and ru.get('telegram_id'):
+                    rw_repo.record_key_from_payload(
+                        user_id=int(ru['telegram_id']),
+                        payload=result,
+                        host_name=host_name,
+                        tag="paid",
+                        description=_build_key_origin_meta(
+                            source="gift",
+                            plan_id=None,
+                            plan_name=None,
+                            months=months,
+                            duration_days=duration_days,
+                            is_trial=False,
+                            note=f"Gift received from {sender_id}",
+                        )
                     )
-                )
-                logger.info(f"Gift: key attached to local user {ru['telegram_id']}")
-        except Exception as e:
-            logger.warning(f"Gift: failed to record gifted key for recipient: {e}")
-        
-        try:
-            pid = pending.get("payment_id")
-            if pid:
-                find_and_complete_pending_transaction(str(pid))
-        except Exception:
-            pass
+                    logger.info(f"Gift: key attached to local user {ru['telegram_id']}")
+            except Exception as e:
+                logger.warning(f"Gift: failed to record gifted key for recipient: {e}")
+
+            try:
+                pid = pending.get("payment_id")
+                if pid:
+                    find_and_complete_pending_transaction(str(pid))
+            except Exception:
+                pass
+
+        # Ключ уже создан в панели: снимаем гифт из памяти сразу, а запись в БД
+        # (привязка ключа и закрытие pending) делаем в фоне, не задерживая ответ
         try:
-            PENDING_GIFTS.pop(int(message.from_user.id), None)
+            PENDING_GIFTS.pop(int(sender_id), None)
         except Exception:
             pass
-        
+        _spawn_background(asyncio.to_thread(_finalize_gift), name=f"gift-finalize-{sender_id}")
+
         await message.reply("✅ Подарочный ключ создан для пользователя @{}\nКлюч уже активен в панели, пользователь сможет подключиться сразу.".format(text))
 
 
@@ -5102,53 +5477,21 @@ def get_user_router() -> Router:
     # Franchise (clone bots)
     # =============================
 
-    def _kb_cancel_factory() -> types.InlineKeyboardMarkup:
-        b = InlineKeyboardBuilder()
-        b.button(text="❌ Отмена", callback_data="factory_cancel")
-        b.adjust(1)
-        return b.as_markup()
-
     def _kb_partner_cabinet() -> types.InlineKeyboardMarkup:
-        b = InlineKeyboardBuilder()
-        b.button(text="💳 Реквизиты", callback_data="partner_requisites")
-        b.button(text="💸 Вывод средств", callback_data="partner_withdraw")
-        b.button(text=(get_setting("btn_back_to_menu_text") or "⬅️ Назад в меню"), callback_data="back_to_main_menu")
-        b.adjust(1, 1, 1)
-        return b.as_markup()
-
-    def _kb_partner_withdraw() -> types.InlineKeyboardMarkup:
-        b = InlineKeyboardBuilder()
-        b.button(text="❌ Отмена", callback_data="partner_withdraw_cancel")
-        b.adjust(1)
-        return b.as_markup()
+        return _kb_partner_cabinet_for(get_setting_cached("btn_back_to_menu_text") or "⬅️ Назад в меню")
 
 
     def _kb_partner_requisites(items: list[dict] | None = None) -> types.InlineKeyboardMarkup:
-        b = InlineKeyboardBuilder()
-        b.button(text="➕ Добавить карту", callback_data="partner_requisite_add")
-        items = items or []
-        # One row per action to keep callback_data short and stable
-        for r in items[:20]:
-            rid = int(r.get("id") or 0)
-            if rid <= 0:
-                continue
-            is_def = int(r.get("is_default") or 0) == 1
-            if not is_def:
-                b.button(text=f"✅ Сделать основной #{rid}", callback_data=f"req_set_default:{rid}")
-            b.button(text=f"🗑 Удалить #{rid}", callback_data=f"req_delete:{rid}")
-        b.button(text="⬅️ Назад", callback_data="partner_cabinet")
-        b.adjust(1)
-        return b.as_markup()
-
-    def _kb_partner_requisite_input() -> types.InlineKeyboardMarkup:
-        b = InlineKeyboardBuilder()
-        b.button(text="❌ Отмена", callback_data="partner_requisite_cancel")
-        b.adjust(1)
-        return b.as_markup()
+        key = tuple(
+            (int(r.get("id") or 0), int(r.get("is_default") or 0) == 1)
+            for r in (items or [])[:20]
+        )
+        return _kb_partner_requisites_for(key)
 
+    @lru_cache(maxsize=4096)
     def _mask_requisite(value: str, rtype: str) -> str:
         s = (value or '').strip()
-        digits = ''.join(ch for ch in s if ch.isdigit())
+        digits = _NONDIGIT_RE.sub('', s)
         if not digits:
             return s
         last4 = digits[-4:]
@@ -5159,8 +5502,27 @@ def get_user_router() -> Router:
             masked = ' '.join(reversed(parts))
         return masked
 
+    def _render_requisites_html(items: list[dict]) -> str:
+        """Текст экрана «💳 Реквизиты» со списком привязанных реквизитов."""
+        if not items:
+            return (
+                "💳 <b>Реквизиты</b>\n\n"
+                "Пока нет привязанных реквизитов.\n"
+                "Нажмите <b>«Добавить карту»</b> и укажите банк и номер карты или телефона."
+            )
+        rows = [
+            f"{'⭐ ' if int(r.get('is_default') or 0) == 1 else ''}<b>{i}.</b> "
+            f"{_html_escape_cached(str(r.get('bank') or ''))} — "
+            f"{_REQUISITE_LABELS.get(r.get('requisite_type') or 'card', 'Телефон')}: "
+            f"<code>{_html_escape_cached(_mask_requisite(str(r.get('requisite_value') or ''), str(r.get('requisite_type') or 'card')))}</code> "
+            f"(id={r.get('id')})"
+            for i, r in enumerate(items, 1)
+        ]
+        return "💳 <b>Реквизиты</b>\n\n" + "\n".join(rows)
+
+    @lru_cache(maxsize=1024)
     def _infer_requisite_type(value: str) -> str:
-        digits = ''.join(ch for ch in (value or '') if ch.isdigit())
+        digits = _NONDIGIT_RE.sub('', value or '')
         # heuristic: 10-12 digits - чаще телефон, 13-19 - чаще карта
         if 10 <= len(digits) <= 12:
             return 'phone'
@@ -5176,42 +5538,27 @@ def get_user_router() -> Router:
             await state.clear()
         except Exception:
             pass
-        bot_id = rw_repo.resolve_factory_bot_id(getattr(bot, "id", None))
+        # Бот, владелец и список реквизитов — одним запросом
+        bot_id, owner_id, items = await asyncio.to_thread(rw_repo.get_bot_and_requisites, getattr(bot, "id", None))
         if bot_id <= 0:
             await cb.answer("Реквизиты доступны только в клонах.", show_alert=True)
             return
-        info = rw_repo.get_managed_bot(bot_id) or {}
-        owner_id = int(info.get("owner_telegram_id") or 0)
         if int(cb.from_user.id) != owner_id:
             await cb.answer("Доступно только владельцу.", show_alert=True)
             return
 
-        items = rw_repo.list_partner_requisites(bot_id, owner_id) or []
-        lines = ["💳 <b>Реквизиты</b>", ""]
-        if not items:
-            lines.append("Пока нет привязанных реквизитов.")
-            lines.append("Нажмите <b>«Добавить карту»</b> и укажите банк и номер карты или телефона.")
-        else:
-            for i, r in enumerate(items, 1):
-                bank = html_escape(str(r.get('bank') or ''))
-                rtype = (r.get('requisite_type') or 'card')
-                label = 'Номер карты' if rtype == 'card' else 'Телефон'
-                masked = html_escape(_mask_requisite(str(r.get('requisite_value') or ''), str(rtype)))
-                star = '⭐ ' if int(r.get('is_default') or 0) == 1 else ''
-                lines.append(f"{star}<b>{i}.</b> {bank} — {label}: <code>{masked}</code> (id={r.get('id')})")
-        text = "\n".join(lines)
+        text = _render_requisites_html(items)
         await cb.message.edit_text(text, reply_markup=_kb_partner_requisites(items), disable_web_page_preview=True)
         await fast_callback_answer(cb)
-        await fast_callback_answer(cb)
 
     @user_router.callback_query(F.data == "partner_requisite_add")
     @catch_callback_errors
     async def partner_requisite_add(cb: types.CallbackQuery, state: FSMContext, bot: Bot):
-        bot_id = rw_repo.resolve_factory_bot_id(getattr(bot, "id", None))
+        bot_id = rw_repo.resolve_factory_bot_id_cached(getattr(bot, "id", None))
         if bot_id <= 0:
             await cb.answer("Доступно только в клонах.", show_alert=True)
             return
-        info = rw_repo.get_managed_bot(bot_id) or {}
+        info = rw_repo.get_managed_bot_cached(bot_id) or {}
         owner_id = int(info.get("owner_telegram_id") or 0)
         if int(cb.from_user.id) != owner_id:
             await cb.answer("Только владелец.", show_alert=True)
@@ -5220,7 +5567,7 @@ def get_user_router() -> Router:
         await state.set_state(FranchiseStates.waiting_requisites_bank)
         await cb.message.edit_text(
             "🏦 <b>Добавление реквизитов</b>\n\nВведите название банка (например: <code>Тинькофф</code>):",
-            reply_markup=_kb_partner_requisite_input(),
+            reply_markup=_KB_PARTNER_REQUISITE_INPUT,
         )
         await fast_callback_answer(cb)
 
@@ -5243,8 +5590,8 @@ def get_user_router() -> Router:
     @user_router.message(FranchiseStates.waiting_requisites_bank)
     @registration_required
     async def partner_requisite_bank(message: types.Message, state: FSMContext, bot: Bot):
-        bot_id = rw_repo.resolve_factory_bot_id(getattr(bot, "id", None))
-        info = rw_repo.get_managed_bot(bot_id) or {}
+        bot_id = rw_repo.resolve_factory_bot_id_cached(getattr(bot, "id", None))
+        info = rw_repo.get_managed_bot_cached(bot_id) or {}
         owner_id = int(info.get("owner_telegram_id") or 0)
         if int(message.from_user.id) != owner_id:
             await message.answer("Только владелец.")
@@ -5262,14 +5609,14 @@ def get_user_router() -> Router:
         await state.set_state(FranchiseStates.waiting_requisites_value)
         await message.answer(
             "💳 Теперь пришлите <b>номер карты</b> или <b>номер телефона</b> (как удобно):",
-            reply_markup=_kb_partner_requisite_input(),
+            reply_markup=_KB_PARTNER_REQUISITE_INPUT,
         )
 
     @user_router.message(FranchiseStates.waiting_requisites_value)
     @registration_required
     async def partner_requisite_value(message: types.Message, state: FSMContext, bot: Bot):
-        bot_id = rw_repo.resolve_factory_bot_id(getattr(bot, "id", None))
-        info = rw_repo.get_managed_bot(bot_id) or {}
+        bot_id = rw_repo.resolve_factory_bot_id_cached(getattr(bot, "id", None))
+        info = rw_repo.get_managed_bot_cached(bot_id) or {}
         owner_id = int(info.get("owner_telegram_id") or 0)
         if int(message.from_user.id) != owner_id:
             await message.answer("Только владелец.")
@@ -5300,24 +5647,13 @@ def get_user_router() -> Router:
 
         # show list
         items = rw_repo.list_partner_requisites(bot_id, owner_id) or []
-        lines = ["💳 <b>Реквизиты</b>", ""]
-        if not items:
-            lines.append("Пока нет привязанных реквизитов.")
-        else:
-            for i, r in enumerate(items, 1):
-                bank_e = html_escape(str(r.get('bank') or ''))
-                rt = (r.get('requisite_type') or 'card')
-                label = 'Номер карты' if rt == 'card' else 'Телефон'
-                masked = html_escape(_mask_requisite(str(r.get('requisite_value') or ''), str(rt)))
-                star = '⭐ ' if int(r.get('is_default') or 0) == 1 else ''
-                lines.append(f"{star}<b>{i}.</b> {bank_e} — {label}: <code>{masked}</code> (id={r.get('id')})")
-        await message.answer("\n".join(lines), reply_markup=_kb_partner_requisites(items))
+        await message.answer(_render_requisites_html(items), reply_markup=_kb_partner_requisites(items))
 
     @user_router.callback_query(F.data.startswith("req_set_default:"))
     @catch_callback_errors
     async def partner_requisite_set_default(cb: types.CallbackQuery, state: FSMContext, bot: Bot):
-        bot_id = rw_repo.resolve_factory_bot_id(getattr(bot, "id", None))
-        info = rw_repo.get_managed_bot(bot_id) or {}
+        bot_id = rw_repo.resolve_factory_bot_id_cached(getattr(bot, "id", None))
+        info = rw_repo.get_managed_bot_cached(bot_id) or {}
         owner_id = int(info.get("owner_telegram_id") or 0)
         if bot_id <= 0 or int(cb.from_user.id) != owner_id:
             await cb.answer("Недостаточно прав.", show_alert=True)
@@ -5335,22 +5671,14 @@ def get_user_router() -> Router:
             await partner_requisites(cb, state, bot)
         except Exception:
             # rebuild text quickly
-            lines = ["💳 <b>Реквизиты</b>", ""]
-            for i, r in enumerate(items, 1):
-                bank_e = html_escape(str(r.get('bank') or ''))
-                rt = (r.get('requisite_type') or 'card')
-                label = 'Номер карты' if rt == 'card' else 'Телефон'
-                masked = html_escape(_mask_requisite(str(r.get('requisite_value') or ''), str(rt)))
-                star = '⭐ ' if int(r.get('is_default') or 0) == 1 else ''
-                lines.append(f"{star}<b>{i}.</b> {bank_e} — {label}: <code>{masked}</code> (id={r.get('id')})")
-            await cb.message.edit_text("\n".join(lines), reply_markup=_kb_partner_requisites(items), disable_web_page_preview=True)
+            await cb.message.edit_text(_render_requisites_html(items), reply_markup=_kb_partner_requisites(items), disable_web_page_preview=True)
         await fast_callback_answer(cb)
 
     @user_router.callback_query(F.data.startswith("req_delete:"))
     @catch_callback_errors
     async def partner_requisite_delete(cb: types.CallbackQuery, state: FSMContext, bot: Bot):
-        bot_id = rw_repo.resolve_factory_bot_id(getattr(bot, "id", None))
-        info = rw_repo.get_managed_bot(bot_id) or {}
+        bot_id = rw_repo.resolve_factory_bot_id_cached(getattr(bot, "id", None))
+        info = rw_repo.get_managed_bot_cached(bot_id) or {}
         owner_id = int(info.get("owner_telegram_id") or 0)
         if bot_id <= 0 or int(cb.from_user.id) != owner_id:
             await cb.answer("Недостаточно прав.", show_alert=True)
@@ -5364,18 +5692,7 @@ def get_user_router() -> Router:
         await cb.answer(("✅ " if ok else "❌ ") + msg, show_alert=not ok)
         # refresh list
         items = rw_repo.list_partner_requisites(bot_id, owner_id) or []
-        lines = ["💳 <b>Реквизиты</b>", ""]
-        if not items:
-            lines.append("Пока нет привязанных реквизитов.")
-        else:
-            for i, r in enumerate(items, 1):
-                bank_e = html_escape(str(r.get('bank') or ''))
-                rt = (r.get('requisite_type') or 'card')
-                label = 'Номер карты' if rt == 'card' else 'Телефон'
-                masked = html_escape(_mask_requisite(str(r.get('requisite_value') or ''), str(rt)))
-                star = '⭐ ' if int(r.get('is_default') or 0) == 1 else ''
-                lines.append(f"{star}<b>{i}.</b> {bank_e} — {label}: <code>{masked}</code> (id={r.get('id')})")
-        await cb.message.edit_text("\n".join(lines), reply_markup=_kb_partner_requisites(items), disable_web_page_preview=True)
+        await cb.message.edit_text(_render_requisites_html(items), reply_markup=_kb_partner_requisites(items), disable_web_page_preview=True)
         await fast_callback_answer(cb)
 
     @user_router.callback_query(F.data == "factory_create_bot")
@@ -5383,7 +5700,7 @@ def get_user_router() -> Router:
     async def franchise_create_bot(cb: types.CallbackQuery, state: FSMContext, bot: Bot):
         # Creation is allowed only from the root bot UI
         try:
-            current_bot_id = rw_repo.resolve_factory_bot_id(getattr(bot, "id", None))
+            current_bot_id = rw_repo.resolve_factory_bot_id_cached(getattr(bot, "id", None))
         except Exception:
             current_bot_id = 0
         if current_bot_id > 0:
@@ -5399,9 +5716,9 @@ def get_user_router() -> Router:
         )
         await state.set_state(FranchiseStates.waiting_bot_token)
         try:
-            await cb.message.edit_text(text, reply_markup=_kb_cancel_factory())
+            await cb.message.edit_text(text, reply_markup=_KB_CANCEL_FACTORY)
         except Exception:
-            await cb.message.answer(text, reply_markup=_kb_cancel_factory())
+            await cb.message.answer(text, reply_markup=_KB_CANCEL_FACTORY)
         await fast_callback_answer(cb)
 
     @user_router.callback_query(F.data == "factory_cancel")
@@ -5427,15 +5744,9 @@ def get_user_router() -> Router:
 
         # Validate token
         try:
-            tmp_bot = Bot(token=token)
+            # Сессия общая — закрывать её после проверки не нужно
+            tmp_bot = Bot(token=token, session=_get_token_check_session())
             me = await tmp_bot.get_me()
-            try:
-                await tmp_bot.close()
-            except Exception:
-                try:
-                    await tmp_bot.session.close()
-                except Exception:
-                    pass
         except Exception as e:
             logger.warning(f"Token validation failed: {e}")
             await message.answer("Не получилось проверить токен. Убедитесь, что он правильный и бот не заблокирован.")
@@ -5483,31 +5794,30 @@ def get_user_router() -> Router:
     @user_router.callback_query(F.data == "partner_cabinet")
     @catch_callback_errors
     async def partner_cabinet(cb: types.CallbackQuery, bot: Bot):
-        bot_id = rw_repo.resolve_factory_bot_id(getattr(bot, "id", None))
+        bot_id = rw_repo.resolve_factory_bot_id_cached(getattr(bot, "id", None))
         if bot_id <= 0:
             await cb.answer("Кабинет доступен только в клонах.", show_alert=True)
             return
-        info = rw_repo.get_managed_bot(bot_id) or {}
+        info = rw_repo.get_managed_bot_cached(bot_id) or {}
         owner_id = int(info.get("owner_telegram_id") or 0)
         if int(cb.from_user.id) != owner_id:
             await cb.answer("Кабинет доступен только владельцу.", show_alert=True)
             return
 
-        st = rw_repo.get_partner_cabinet(bot_id) or {}
-        gross = float(st.get("gross_paid_card", 0.0) or 0.0)
-        com_total = float(st.get("commission_total", 0.0) or 0.0)
-        avail = float(st.get("available", 0.0) or 0.0)
-        users = int(st.get("total_users", 0) or 0)
-
-        text = (
-            "👤 <b>Личный кабинет</b>\n\n"
-            f"Бот: @{info.get('username') or 'без_username'}\n"
-            f"Пользователей: <b>{users}</b>\n\n"
-            f"Оплачено картой: <b>{gross:.2f} ₽</b>\n"
-            f"Ваш процент: <b>{get_franchise_percent_default():.1f}%</b>\n"
-            f"Ваш доход: <b>{com_total:.2f} ₽</b>\n"
-            f"Доступно к выводу: <b>{avail:.2f} ₽</b>\n\n"
-            f"ℹ️ Минимальная сумма вывода: <b>{get_franchise_min_withdraw():.0f} ₽</b>\n"
+        st = await _db(rw_repo.get_partner_cabinet, bot_id) or {}
+        gross = _as_float(st.get("gross_paid_card"))
+        com_total = _as_float(st.get("commission_total"))
+        avail = _as_float(st.get("available"))
+        users = _as_int(st.get("total_users"))
+
+        text = _PARTNER_CABINET_TMPL.format(
+            username=info.get('username') or 'без_username',
+            users=users,
+            gross=gross,
+            percent=get_franchise_percent_default(),
+            commission=com_total,
+            available=avail,
+            min_withdraw=get_franchise_min_withdraw(),
         )
         await cb.message.edit_text(text, reply_markup=_kb_partner_cabinet(), disable_web_page_preview=True)
         await fast_callback_answer(cb)
@@ -5515,38 +5825,41 @@ def get_user_router() -> Router:
     @user_router.callback_query(F.data == "partner_withdraw")
     @catch_callback_errors
     async def partner_withdraw(cb: types.CallbackQuery, state: FSMContext, bot: Bot):
-        bot_id = rw_repo.resolve_factory_bot_id(getattr(bot, "id", None))
+        bot_id = rw_repo.resolve_factory_bot_id_cached(getattr(bot, "id", None))
         if bot_id <= 0:
             await cb.answer("Вывод доступен только в клонах.", show_alert=True)
             return
-        info = rw_repo.get_managed_bot(bot_id) or {}
+        info = rw_repo.get_managed_bot_cached(bot_id) or {}
         owner_id = int(info.get("owner_telegram_id") or 0)
         if int(cb.from_user.id) != owner_id:
             await cb.answer("Только владелец.", show_alert=True)
             return
 
-        st = rw_repo.get_partner_cabinet(bot_id) or {}
-        avail = float(st.get("available", 0.0) or 0.0)
+        st, default_req = await asyncio.gather(
+            _db(rw_repo.get_partner_cabinet, bot_id),
+            _db(rw_repo.get_default_partner_requisite, bot_id, owner_id),
+        )
+        avail = _as_float((st or {}).get("available"))
 
-        # Require payout requisites
-        default_req = rw_repo.get_default_partner_requisite(bot_id, owner_id)
+        # Require payout requisites. get_default_partner_requisite falls back to the
+        # first requisite, so no default means the list is empty — nothing to re-query
         if not default_req:
-            items = rw_repo.list_partner_requisites(bot_id, owner_id) or []
             await cb.message.edit_text(
                 "💳 <b>Реквизиты не указаны</b>\n\n"
                 "Сначала добавьте реквизиты для вывода (банк + номер карты или телефона).",
-                reply_markup=_kb_partner_requisites(items),
+                reply_markup=_kb_partner_requisites(),
             )
             await fast_callback_answer(cb)
             return
 
         await state.set_state(FranchiseStates.waiting_withdraw_amount)
+        min_withdraw = get_franchise_min_withdraw()
         await cb.message.edit_text(
             "💸 <b>Вывод средств</b>\n\n"
             f"Доступно: <b>{avail:.2f} ₽</b>\n"
-            f"Минимум: <b>{get_franchise_min_withdraw():.0f} ₽</b>\n\n"
-            f"Введите сумму для вывода числом (например: <code>{get_franchise_min_withdraw():.0f}</code>):",
-            reply_markup=_kb_partner_withdraw(),
+            f"Минимум: <b>{min_withdraw:.0f} ₽</b>\n\n"
+            f"Введите сумму для вывода числом (например: <code>{min_withdraw:.0f}</code>):",
+            reply_markup=_KB_PARTNER_WITHDRAW,
         )
         await fast_callback_answer(cb)
 
@@ -5570,8 +5883,8 @@ def get_user_router() -> Router:
     @user_router.message(FranchiseStates.waiting_withdraw_amount)
     @registration_required
     async def partner_withdraw_amount(message: types.Message, state: FSMContext, bot: Bot):
-        bot_id = rw_repo.resolve_factory_bot_id(getattr(bot, "id", None))
-        info = rw_repo.get_managed_bot(bot_id) or {}
+        bot_id = rw_repo.resolve_factory_bot_id_cached(getattr(bot, "id", None))
+        info = rw_repo.get_managed_bot_cached(bot_id) or {}
         owner_id = int(info.get("owner_telegram_id") or 0)
         if int(message.from_user.id) != owner_id:
             await message.answer("Только владелец.")
@@ -5589,11 +5902,11 @@ def get_user_router() -> Router:
             return
 
         # Attach payout requisites snapshot to the withdraw request
-        default_req = rw_repo.get_default_partner_requisite(bot_id, owner_id)
+        default_req = await _db(rw_repo.get_default_partner_requisite, bot_id, owner_id)
         if not default_req:
             await message.answer(
                 "💳 Реквизиты не указаны. Сначала добавьте банк и номер карты/телефона, затем повторите вывод.",
-                reply_markup=_kb_partner_requisites(rw_repo.list_partner_requisites(bot_id, owner_id) or []),
+                reply_markup=_kb_partner_requisites(),
             )
             try:
                 await state.clear()
@@ -5606,7 +5919,8 @@ def get_user_router() -> Router:
         rvalue = str(default_req.get('requisite_value') or '')
         rid = int(default_req.get('id') or 0) or None
 
-        ok, msg = rw_repo.create_withdraw_request(
+        ok, msg = await _db(
+            rw_repo.create_withdraw_request,
             bot_id,
             owner_id,
             amount,
@@ -5620,35 +5934,26 @@ def get_user_router() -> Router:
         # Notify admin from the ROOT bot token so the admin always receives it
         if ok:
             try:
-                admin_id_raw = get_setting("admin_telegram_id")
+                admin_id_raw = get_setting_cached("admin_telegram_id")
                 admin_id = int(str(admin_id_raw).strip()) if admin_id_raw else None
             except Exception:
                 admin_id = None
 
             if admin_id:
                 try:
-                    root_token = (get_setting("telegram_bot_token") or "").strip()
+                    root_token = (get_setting_cached("telegram_bot_token") or "").strip()
                     if root_token:
-                        tmp = Bot(token=root_token, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-                        try:
-                            await tmp.send_message(
-                                admin_id,
-                                (
-                                    "💸 <b>Заявка на вывод</b>\n"
-                                    f"Бот: @{info.get('username') or 'без_username'} (bot_id={bot_id})\n"
-                                    f"Владелец: <code>{owner_id}</code>\n"
-                                    f"Сумма: <b>{amount:.2f} ₽</b>\n"
-                                    f"Реквизиты: <b>{html_escape(str(default_req.get('bank') or ''))}</b> — <code>{html_escape(str(default_req.get('requisite_value') or ''))}</code>"
-                                ),
-                            )
-                        finally:
-                            try:
-                                await tmp.close()
-                            except Exception:
-                                try:
-                                    await tmp.session.close()
-                                except Exception:
-                                    pass
+                        _enqueue_root_notification(
+                            root_token,
+                            admin_id,
+                            (
+                                "💸 <b>Заявка на вывод</b>\n"
+                                f"Бот: @{info.get('username') or 'без_username'} (bot_id={bot_id})\n"
+                                f"Владелец: <code>{owner_id}</code>\n"
+                                f"Сумма: <b>{amount:.2f} ₽</b>\n"
+                                f"Реквизиты: <b>{_html_escape_cached(bank)}</b> — <code>{_html_escape_cached(rvalue)}</code>"
+                            ),
+                        )
                 except Exception:
                     pass
 
@@ -5657,15 +5962,12 @@ def get_user_router() -> Router:
         except Exception:
             pass
 
-        # Show cabinet again
+        # Show cabinet again: a CallbackQuery can't be constructed reliably here,
+        # so just show the main menu which contains the cabinet button
         try:
-            st = rw_repo.get_partner_cabinet(bot_id) or {}
             await message.answer(
                 "📊 Обновляю кабинет...",
             )
-            # reuse cabinet view
-            fake_cb = types.CallbackQuery(id="0", from_user=message.from_user, chat_instance="0", message=message)
-            # Can't construct reliably; instead just show main menu which contains cabinet button
         except Exception:
             pass
         try:
@@ -5675,9 +5977,22 @@ def get_user_router() -> Router:
 
     return user_router
 
+_PAYMENT_METHOD_LABELS: Final = {
+    'Balance': 'Баланс',
+    'Card': 'Карта',
+    'Crypto': 'Крипто',
+    'USDT': 'USDT',
+    'TON': 'TON',
+}
+_PROMO_DISABLED_REASONS: Final = {
+    'total_limit': 'исчерпан общий лимит',
+    'expired': 'истёк срок действия',
+}
+
+
 async def notify_admin_of_purchase(bot: Bot, metadata: dict):
     try:
-        admin_id_raw = get_setting("admin_telegram_id")
+        admin_id_raw = get_setting_cached("admin_telegram_id")
         if not admin_id_raw:
             return
         admin_id = int(admin_id_raw)
@@ -5688,20 +6003,13 @@ async def notify_admin_of_purchase(bot: Bot, metadata: dict):
         action = metadata.get('action')
         payment_method = metadata.get('payment_method') or 'Unknown'
 
-        payment_method_map = {
-            'Balance': 'Баланс',
-            'Card': 'Карта',
-            'Crypto': 'Крипто',
-            'USDT': 'USDT',
-            'TON': 'TON',
-        }
-        payment_method_display = payment_method_map.get(payment_method, payment_method)
+        payment_method_display = _PAYMENT_METHOD_LABELS.get(payment_method, payment_method)
         plan_id = metadata.get('plan_id')
         try:
             plan_id_int = int(plan_id) if plan_id not in (None, '', 'None') else 0
         except Exception:
             plan_id_int = 0
-        plan = get_plan_by_id(plan_id_int) if plan_id_int else None
+        plan = rw_repo.get_plan_by_id_cached(plan_id_int) if plan_id_int else None
         plan_name = plan.get('plan_name', 'Unknown') if plan else 'Unknown'
 
         duration_label = None
@@ -5710,7 +6018,7 @@ async def notify_admin_of_purchase(bot: Bot, metadata: dict):
         else:
             duration_label = _format_duration_label(months, metadata.get("duration_days"))
 
-        text = (
+        lines = [(
             "📥 Новая оплата\n"
             f"👤 Пользователь: {user_id}\n"
             f"🗺️ Хост: {host_name}\n"
@@ -5718,7 +6026,7 @@ async def notify_admin_of_purchase(bot: Bot, metadata: dict):
             f"💳 Метод: {payment_method_display}\n"
             f"💰 Сумма: {float(price):.2f} RUB\n"
             f"⚙️ Действие: {'Новый ключ' if action == 'new' else 'Продление'}"
-        )
+        )]
 
         promo_code = (metadata.get('promo_code') or '').strip() if isinstance(metadata, dict) else ''
         if promo_code:
@@ -5726,7 +6034,7 @@ async def notify_admin_of_purchase(bot: Bot, metadata: dict):
                 applied_amount = float(metadata.get('promo_applied_amount') or metadata.get('promo_discount') or 0)
             except Exception:
                 applied_amount = 0.0
-            text += f"\n🎟 Промокод: {promo_code} (-{applied_amount:.2f} RUB)"
+            lines.append(f"🎟 Промокод: {promo_code} (-{applied_amount:.2f} RUB)")
 
             def _to_int(val):
                 try:
@@ -5753,11 +6061,7 @@ async def notify_admin_of_purchase(bot: Bot, metadata: dict):
             status_parts = []
             if metadata.get('promo_disabled'):
                 reason = (metadata.get('promo_disabled_reason') or '').strip()
-                reason_map = {
-                    'total_limit': 'исчерпан общий лимит',
-                    'expired': 'истёк срок действия'
-                }
-                status_parts.append(f"Промокод отключён ({reason_map.get(reason, reason or 'причина неизвестна')})")
+                status_parts.append(f"Промокод отключён ({_PROMO_DISABLED_REASONS.get(reason, reason or 'причина неизвестна')})")
             else:
                 if metadata.get('promo_user_limit_reached'):
                     status_parts.append('Достигнут лимит на пользователя')
@@ -5773,15 +6077,99 @@ async def notify_admin_of_purchase(bot: Bot, metadata: dict):
                 status_parts.append('Redeem не выполнен — проверьте вручную')
 
             if extra_lines:
-                text += "\n📊 " + " | ".join(extra_lines)
+                lines.append("📊 " + " | ".join(extra_lines))
             if status_parts:
-                text += "\n⚠️ " + " | ".join(status_parts)
+                lines.append("⚠️ " + " | ".join(status_parts))
 
-        await bot.send_message(admin_id, text)
+        await bot.send_message(admin_id, "\n".join(lines))
     except Exception as e:
         logger.warning(f"notify_admin_of_purchase failed: {e}")
 
-async def process_successful_payment(bot: Bot, metadata: dict):
+@dataclass(slots=True, frozen=True)
+class _PlanLimits:
+    months: int
+    days: int
+    traffic_limit_bytes: int | None
+    traffic_limit_strategy: str | None
+    hwid_device_limit: int | None
+
+
+def _normalize_plan_limits(plan: dict | None, months: int, duration_days: int) -> _PlanLimits:
+    """Срок и лимиты тарифа в виде, пригодном для Remnawave, за один проход.
+
+    Без тарифа лимиты не передаются (None). С тарифом пустые значения означают
+    «без ограничений» и отправляются как 0, чтобы снять ранее выставленный лимит;
+    стратегия сброса трафика имеет смысл только при ненулевом лимите.
+    """
+    if not plan:
+        return _PlanLimits(months, duration_days, None, None, None)
+
+    try:
+        plan_months = int(plan.get('months') or 0)
+    except (TypeError, ValueError):
+        plan_months = months
+    try:
+        plan_days = int(plan.get('duration_days') or 0)
+    except (TypeError, ValueError):
+        plan_days = duration_days
+
+    # SQLite may store numbers as TEXT; in admin UI 0 values are stored as NULL
+    traffic = plan.get('traffic_limit_bytes')
+    strategy = plan.get('traffic_limit_strategy')
+    if traffic is None:
+        traffic = 0
+    try:
+        traffic = max(int(traffic), 0)
+    except (TypeError, ValueError):
+        pass
+    try:
+        devices = max(int(plan.get('hwid_device_limit') or 0), 0)
+    except (TypeError, ValueError):
+        devices = 0
+
+    if traffic == 0:
+        strategy = None
+    elif not strategy:
+        strategy = 'NO_RESET'
+    return _PlanLimits(plan_months, plan_days, traffic, strategy, devices)
+
+
+# Обработка платежей, выполняющаяся прямо сейчас: одновременные повторные
+# вебхуки с тем же payment_id ждут уже запущенную задачу, а не гонятся за claim
+_INFLIGHT_PAYMENTS: dict[str, asyncio.Task] = {}
+
+
+def _forget_inflight_payment(task: asyncio.Task) -> None:
+    for pid, t in list(_INFLIGHT_PAYMENTS.items()):
+        if t is task:
+            _INFLIGHT_PAYMENTS.pop(pid, None)
+
+
+async def process_successful_payment(bot: Bot, metadata: dict) -> bool:
+    try:
+        payment_id = str((metadata or {}).get("payment_id") or (metadata or {}).get("transaction_id") or "").strip()
+    except Exception:
+        payment_id = ""
+    if not payment_id:
+        return await _process_successful_payment(bot, metadata)
+
+    task = _INFLIGHT_PAYMENTS.get(payment_id)
+    if task is not None and task.get_loop() is not asyncio.get_running_loop():
+        # Резервный путь вебхука крутит свой цикл в отдельном потоке — там
+        # остаётся только проверка идемпотентности в БД
+        return await _process_successful_payment(bot, metadata)
+    if task is None:
+        task = asyncio.create_task(_process_successful_payment(bot, metadata), name=f"payment-{payment_id}")
+        _INFLIGHT_PAYMENTS[payment_id] = task
+        task.add_done_callback(_forget_inflight_payment)
+    else:
+        logger.info(f"process_successful_payment: joining in-flight processing of {payment_id}")
+    # shield: отмена одного из ожидающих не должна прерывать саму обработку платежа
+    return await asyncio.shield(task)
+
+
+async def _process_successful_payment(bot: Bot, metadata: dict) -> bool:
+    """True — платёж занят и выдан (или это подтверждённый дубль); False — обработка не состоялась."""
     candidate_email = None  # default for gift flow
     logger.info("💳 Обрабатываем успешный платеж")
     try:
@@ -5810,14 +6198,25 @@ async def process_successful_payment(bot: Bot, metadata: dict):
         payment_id = (metadata.get("payment_id") or metadata.get("transaction_id") or "").strip()
         if not payment_id:
             logger.error(f"process_successful_payment: missing payment_id in metadata; refusing to process: {metadata}")
-            return
+            return False
+        if payment_id in _RECENT_PAYMENTS:
+            logger.info(f"process_successful_payment: duplicate payment ignored: {payment_id}")
+            return True
         try:
-            if not claim_processed_payment(payment_id):
+            claimed = await _db(claim_processed_payment, payment_id)
+            # Запоминаем только успешный claim: False бывает и при ошибке SQLite,
+            # и тогда повтор вебхука от провайдера должен дойти до БД снова
+            if claimed:
+                _remember_payment(payment_id)
+            elif await _db(is_payment_processed, payment_id):
                 logger.info(f"process_successful_payment: duplicate payment ignored: {payment_id}")
-                return
+                return True
+            else:
+                logger.error(f"process_successful_payment: could not claim {payment_id}; leaving it for a retry")
+                return False
         except Exception as e:
             logger.error(f"process_successful_payment: idempotency check failed for {payment_id}: {e}", exc_info=True)
-            return
+            return False
 
                 # Franchise: accrue partner commission for payments made through a managed clone bot.
         try:
@@ -5826,12 +6225,12 @@ async def process_successful_payment(bot: Bot, metadata: dict):
             factory_bot_id = 0
         if factory_bot_id <= 0:
             try:
-                factory_bot_id = rw_repo.resolve_factory_bot_id(getattr(bot, "id", None))
+                factory_bot_id = rw_repo.resolve_factory_bot_id_cached(getattr(bot, "id", None))
             except Exception:
                 factory_bot_id = 0
         if factory_bot_id > 0:
             try:
-                rw_repo.accrue_partner_commission(factory_bot_id, str(payment_id), int(user_id), float(price), payment_method, 35.0)
+                await _db(rw_repo.accrue_partner_commission, factory_bot_id, str(payment_id), int(user_id), float(price), payment_method, 35.0)
             except Exception:
                 pass
 
@@ -5840,7 +6239,7 @@ async def process_successful_payment(bot: Bot, metadata: dict):
         
     except (ValueError, TypeError) as e:
         logger.error(f"FATAL: Could not parse metadata. Error: {e}. Metadata: {metadata}")
-        return
+        return False
 
     if chat_id_to_delete and message_id_to_delete:
         try:
@@ -5853,7 +6252,7 @@ async def process_successful_payment(bot: Bot, metadata: dict):
         logger.info(f"💰 Обрабатываем пополнение баланса для пользователя {user_id}: {float(price):.2f} RUB")
         ok = False
         try:
-            ok = add_to_balance(user_id, float(price))
+            ok = await _db(add_to_balance, user_id, float(price))
             if ok:
                 logger.info(f"✅ Баланс успешно обновлен для пользователя {user_id}: +{float(price):.2f} RUB")
             else:
@@ -5867,12 +6266,12 @@ async def process_successful_payment(bot: Bot, metadata: dict):
 
             log_username = (metadata.get('tg_username') or '').strip() if isinstance(metadata, dict) else ''
             if not log_username:
-                user_info = get_user(user_id)
+                user_info = await _db(get_user, user_id)
                 log_username = (user_info.get('username') if user_info else '') or f"@{user_id}"
-            log_transaction(
+            await _db(log_transaction,
                 username=log_username,
                 transaction_id=None,
-                payment_id=str(uuid.uuid4()),
+                payment_id=str(_new_uuid()),
                 user_id=user_id,
                 status='paid',
                 amount_rub=float(price),
@@ -5890,7 +6289,7 @@ async def process_successful_payment(bot: Bot, metadata: dict):
             if pm_for_ref == 'balance':
                 logger.info(f"Referral(top_up): skip accrual for user {user_id} because top-up was made from internal balance.")
             else:
-                user_data = get_user(user_id) or {}
+                user_data = await _db(get_user, user_id) or {}
                 referrer_id = user_data.get('referred_by')
                 if referrer_id:
                     try:
@@ -5900,29 +6299,29 @@ async def process_successful_payment(bot: Bot, metadata: dict):
                         referrer_id = None
                 if referrer_id:
                     try:
-                        reward_type = (get_setting("referral_reward_type") or "percent_purchase").strip()
+                        reward_type = (get_setting_cached("referral_reward_type") or "percent_purchase").strip()
                     except Exception:
                         reward_type = "percent_purchase"
-                    reward = Decimal("0")
+                    reward = _D_ZERO
                     if reward_type == "fixed_start_referrer":
-                        reward = Decimal("0")
+                        reward = _D_ZERO
                     elif reward_type == "fixed_purchase":
                         try:
-                            amount_raw = get_setting("fixed_referral_bonus_amount") or "50"
-                            reward = Decimal(str(amount_raw)).quantize(Decimal("0.01"))
+                            amount_raw = get_setting_cached("fixed_referral_bonus_amount") or "50"
+                            reward = _setting_decimal_cents(str(amount_raw))
                         except Exception:
                             reward = Decimal("50.00")
                     else:
 
                         try:
-                            percentage = Decimal(get_setting("referral_percentage") or "0")
+                            percentage = _setting_decimal(str(get_setting_cached("referral_percentage") or "0"))
                         except Exception:
-                            percentage = Decimal("0")
-                        reward = (Decimal(str(price)) * percentage / 100).quantize(Decimal("0.01"))
+                            percentage = _D_ZERO
+                        reward = (Decimal(str(price)) * percentage / 100).quantize(_D_CENT)
                     logger.info(f"Referral(top_up): user={user_id}, referrer={referrer_id}, type={reward_type}, reward={float(reward):.2f}")
                     if float(reward) > 0:
                         try:
-                            ok_ref = add_to_balance(referrer_id, float(reward))
+                            ok_ref = await _db(add_to_balance, referrer_id, float(reward))
                         except Exception as e:
                             logger.warning(f"Referral(top_up): add_to_balance failed for referrer {referrer_id}: {e}")
                             ok_ref = False
@@ -5950,7 +6349,7 @@ async def process_successful_payment(bot: Bot, metadata: dict):
         try:
             current_balance = 0.0
             try:
-                current_balance = float(get_balance(user_id))
+                current_balance = float(await _db(get_balance, user_id))
             except Exception:
                 pass
             if ok:
@@ -5977,14 +6376,14 @@ async def process_successful_payment(bot: Bot, metadata: dict):
         
 
         try:
-            admins = [u for u in (get_all_users() or []) if is_admin(u.get('telegram_id') or 0)]
-            for a in admins:
-                admin_id = a.get('telegram_id')
-                if admin_id:
-                    await bot.send_message(admin_id, f"📥 Пополнение: пользователь {user_id}, сумма {float(price):.2f} RUB")
+            admin_text = f"📥 Пополнение: пользователь {user_id}, сумма {float(price):.2f} RUB"
+            await _run_detached_if_possible(
+                _gather_quietly(*(bot.send_message(int(aid), admin_text) for aid in (rw_repo.get_admin_ids() or ()))),
+                name=f"topup-admin-notify-{user_id}",
+            )
         except Exception:
             pass
-        return
+        return bool(ok)
 
     processing_message = await bot.send_message(
         chat_id=user_id,
@@ -5995,6 +6394,7 @@ async def process_successful_payment(bot: Bot, metadata: dict):
 
         price = float(metadata.get('price'))
         result = None
+        existing_key = None
 
         if action == "new":
             try:
@@ -6005,71 +6405,20 @@ async def process_successful_payment(bot: Bot, metadata: dict):
             pass
         else:
 
-            existing_key = rw_repo.get_key_by_id(key_id)
+            existing_key = await _db(rw_repo.get_key_by_id, key_id)
             if not existing_key or not existing_key.get('key_email'):
                 await processing_message.edit_text("❌ Не удалось найти ключ для продления.")
-                return
+                return False
             candidate_email = existing_key['key_email']
 
         # plan-based duration & limits
-        plan = get_plan_by_id(plan_id) if plan_id else None
-        plan_months = months
-        plan_days = duration_days_meta
-        traffic_limit_bytes = None
-        traffic_limit_strategy = None
-        hwid_device_limit = None
-        if plan:
-            try:
-                plan_months = int(plan.get('months') or 0)
-            except Exception:
-                plan_months = months
-            try:
-                plan_days = int(plan.get('duration_days') or 0)
-            except Exception:
-                plan_days = duration_days_meta
-            traffic_limit_bytes = plan.get('traffic_limit_bytes')
-            traffic_limit_strategy = plan.get('traffic_limit_strategy')
-            hwid_device_limit = plan.get('hwid_device_limit')
-
-            # Ensure numeric type for Remnawave (SQLite may store numbers as TEXT)
-            try:
-                if hwid_device_limit is not None:
-                    hwid_device_limit = int(hwid_device_limit)
-            except Exception:
-                hwid_device_limit = None
-
-            # In admin UI, 0 values are stored as NULL. For Remnawave we must send 0 to explicitly remove an existing cap.
-            # Traffic: 0 means unlimited.
-            if traffic_limit_bytes is None:
-                traffic_limit_bytes = 0
-            # Devices: 0 means unlimited.
-            if hwid_device_limit is None:
-                hwid_device_limit = 0
-
-        # normalize limits (traffic_limit_bytes=0 means "no limit" and must be sent to Remnawave to clear an existing cap)
-        try:
-            if traffic_limit_bytes is not None and int(traffic_limit_bytes) < 0:
-                traffic_limit_bytes = 0
-        except Exception:
-            pass
-        try:
-            if hwid_device_limit is not None and int(hwid_device_limit) < 0:
-                hwid_device_limit = 0
-        except Exception:
-            pass
-
-        # strategy makes sense only when traffic limit exists (0 means unlimited)
-        if traffic_limit_bytes is None:
-            traffic_limit_strategy = None
-        else:
-            try:
-                if int(traffic_limit_bytes) == 0:
-                    traffic_limit_strategy = None
-                elif not traffic_limit_strategy:
-                    traffic_limit_strategy = 'NO_RESET'
-            except Exception:
-                if not traffic_limit_strategy:
-                    traffic_limit_strategy = 'NO_RESET'
+        plan = rw_repo.get_plan_by_id_cached(plan_id) if plan_id else None
+        limits = _normalize_plan_limits(plan, months, duration_days_meta)
+        plan_months = limits.months
+        plan_days = limits.days
+        traffic_limit_bytes = limits.traffic_limit_bytes
+        traffic_limit_strategy = limits.traffic_limit_strategy
+        hwid_device_limit = limits.hwid_device_limit
 
         days_to_add = _compute_days_to_add(plan_months, plan_days)
         if days_to_add <= 0:
@@ -6097,23 +6446,11 @@ async def process_successful_payment(bot: Bot, metadata: dict):
         expiry_timestamp_ms = None
         if action == "extend" and key_id:
             try:
-                exp_str = None
-                try:
-                    existing_key = rw_repo.get_key_by_id(key_id) or {}
-                    exp_str = existing_key.get('expire_at') or existing_key.get('expiry_date')
-                except Exception:
-                    exp_str = None
+                # The key row was already loaded above to validate its email
+                key_row = existing_key or {}
+                exp_str = key_row.get('expire_at') or key_row.get('expiry_date')
 
-                exp_ms = None
-                if exp_str:
-                    exp_norm = str(exp_str).replace('Z', '+00:00').replace(' ', 'T').replace('/', '-')
-                    try:
-                        exp_dt = datetime.fromisoformat(exp_norm)
-                        if exp_dt.tzinfo is None:
-                            exp_dt = exp_dt.replace(tzinfo=timezone.utc)
-                        exp_ms = int(exp_dt.timestamp() * 1000)
-                    except Exception:
-                        exp_ms = None
+                exp_ms = _parse_expire_ms(str(exp_str)) if exp_str else None
 
                 now_ms = int(time.time() * 1000)
                 base_ms = max(exp_ms or 0, now_ms)
@@ -6145,7 +6482,7 @@ async def process_successful_payment(bot: Bot, metadata: dict):
                 await processing_message.edit_text("❌ Не удалось создать ключ.")
             except Exception:
                 pass
-            return
+            return False
         if action != "gift" and not result:
             action_label = _format_key_action_label(action, price=price, key_id=key_id)
             await _handle_key_creation_failure(
@@ -6159,7 +6496,7 @@ async def process_successful_payment(bot: Bot, metadata: dict):
                 await processing_message.edit_text("❌ Не удалось создать ключ.")
             except Exception:
                 pass
-            return
+            return False
 
         if action == "new":
             key_id = rw_repo.record_key_from_payload(
@@ -6171,14 +6508,14 @@ async def process_successful_payment(bot: Bot, metadata: dict):
             )
             if not key_id:
                 await processing_message.edit_text("❌ Не удалось сохранить ключ. Попробуйте позже.")
-                return
+                return False
         
         elif action == "gift":
             # Подарок: не создаём ключ на дарителя, ждём username получателя
             try:
-                payment_id = (metadata.get('payment_id') or f"GIFT-{uuid.uuid4()}")
+                payment_id = (metadata.get('payment_id') or f"GIFT-{_new_uuid()}")
             except Exception:
-                payment_id = f"GIFT-{uuid.uuid4()}"
+                payment_id = f"GIFT-{_new_uuid()}"
             pending_meta = {
                 "type": "gift",
                 "user_id": user_id,
@@ -6200,7 +6537,7 @@ async def process_successful_payment(bot: Bot, metadata: dict):
             await processing_message.edit_text(
                 "🎁 Оплата подарка получена!\n\nВведите @username пользователя, которому хотите подарить ключ.\nНапример: @username"
             )
-            return
+            return True
 
         elif action == "extend":
             if not rw_repo.update_key(
@@ -6213,7 +6550,7 @@ async def process_successful_payment(bot: Bot, metadata: dict):
                 description=origin_desc,
             ):
                 await processing_message.edit_text("❌ Не удалось обновить информацию о ключе. Попробуйте позже.")
-                return
+                return False
 
 
         try:
@@ -6221,7 +6558,7 @@ async def process_successful_payment(bot: Bot, metadata: dict):
             if pm_for_ref == 'balance':
                 logger.info(f"Referral: skip accrual for user {user_id} because payment was made from internal balance.")
             else:
-                user_data = get_user(user_id) or {}
+                user_data = await _db(get_user, user_id) or {}
                 referrer_id = user_data.get('referred_by')
                 if referrer_id:
                     try:
@@ -6232,29 +6569,29 @@ async def process_successful_payment(bot: Bot, metadata: dict):
                 if referrer_id:
 
                     try:
-                        reward_type = (get_setting("referral_reward_type") or "percent_purchase").strip()
+                        reward_type = (get_setting_cached("referral_reward_type") or "percent_purchase").strip()
                     except Exception:
                         reward_type = "percent_purchase"
-                    reward = Decimal("0")
+                    reward = _D_ZERO
                     if reward_type == "fixed_start_referrer":
-                        reward = Decimal("0")
+                        reward = _D_ZERO
                     elif reward_type == "fixed_purchase":
                         try:
-                            amount_raw = get_setting("fixed_referral_bonus_amount") or "50"
-                            reward = Decimal(str(amount_raw)).quantize(Decimal("0.01"))
+                            amount_raw = get_setting_cached("fixed_referral_bonus_amount") or "50"
+                            reward = _setting_decimal_cents(str(amount_raw))
                         except Exception:
                             reward = Decimal("50.00")
                     else:
 
                         try:
-                            percentage = Decimal(get_setting("referral_percentage") or "0")
+                            percentage = _setting_decimal(str(get_setting_cached("referral_percentage") or "0"))
                         except Exception:
-                            percentage = Decimal("0")
-                        reward = (Decimal(str(price)) * percentage / 100).quantize(Decimal("0.01"))
+                            percentage = _D_ZERO
+                        reward = (Decimal(str(price)) * percentage / 100).quantize(_D_CENT)
                     logger.info(f"Referral: user={user_id}, referrer={referrer_id}, type={reward_type}, reward={float(reward):.2f}")
                     if float(reward) > 0:
                         try:
-                            ok = add_to_balance(referrer_id, float(reward))
+                            ok = await _db(add_to_balance, referrer_id, float(reward))
                         except Exception as e:
                             logger.warning(f"Referral: add_to_balance failed for referrer {referrer_id}: {e}")
                             ok = False
@@ -6289,9 +6626,9 @@ async def process_successful_payment(bot: Bot, metadata: dict):
                 months_for_stats = int(math.ceil(eff_days / 30)) if eff_days > 0 else 0
         except Exception:
             months_for_stats = months
-        update_user_stats(user_id, spent_for_stats, months_for_stats)
+        await _db(update_user_stats, user_id, spent_for_stats, months_for_stats)
         
-        user_info = get_user(user_id)
+        user_info = await _db(get_user, user_id)
 
         log_username = user_info.get('username', 'N/A') if user_info else 'N/A'
         log_status = 'paid'
@@ -6300,15 +6637,15 @@ async def process_successful_payment(bot: Bot, metadata: dict):
         
         log_metadata = json.dumps({
             "plan_id": metadata.get('plan_id'),
-            "plan_name": get_plan_by_id(metadata.get('plan_id')).get('plan_name', 'Unknown') if get_plan_by_id(metadata.get('plan_id')) else 'Unknown',
+            "plan_name": (rw_repo.get_plan_by_id_cached(metadata.get('plan_id')) or {}).get('plan_name', 'Unknown'),
             "host_name": metadata.get('host_name'),
             "customer_email": metadata.get('customer_email')
         })
 
 
-        payment_id_for_log = metadata.get('payment_id') or str(uuid.uuid4())
+        payment_id_for_log = metadata.get('payment_id') or str(_new_uuid())
 
-        log_transaction(
+        await _db(log_transaction,
             username=log_username,
             transaction_id=None,
             payment_id=payment_id_for_log,
@@ -6404,7 +6741,7 @@ async def process_successful_payment(bot: Bot, metadata: dict):
             connection_string = None
             new_expiry_date = None
         
-        all_user_keys = get_user_keys(user_id)
+        all_user_keys = await _db(get_user_keys, user_id)
         key_number = next((i + 1 for i, key in enumerate(all_user_keys) if key['key_id'] == key_id), len(all_user_keys))
 
         final_text = get_purchase_success_text(
@@ -6420,11 +6757,10 @@ async def process_successful_payment(bot: Bot, metadata: dict):
             reply_markup=keyboards.create_key_info_keyboard(key_id, connection_string)
         )
 
-        try:
-            await notify_admin_of_purchase(bot, metadata)
-        except Exception as e:
-            logger.warning(f"Failed to notify admin of purchase: {e}")
-        
+        # notify_admin_of_purchase сам логирует ошибки — не задерживаем обработку платежа
+        await _run_detached_if_possible(notify_admin_of_purchase(bot, metadata), name=f"purchase-admin-notify-{user_id}")
+        return True
+
     except Exception as e:
         logger.error(f"Error processing payment for user {user_id} on host {host_name}: {e}", exc_info=True)
         try:
@@ -6434,6 +6770,7 @@ async def process_successful_payment(bot: Bot, metadata: dict):
                 await bot.send_message(chat_id=user_id, text="❌ Ошибка при выдаче ключа.")
             except Exception:
                 pass
+        return False
 
 
 
@@ -1,16 +1,20 @@
 import logging
+import base64
 import hashlib
 import json
 import random
+import time
 
+from collections import OrderedDict
 from datetime import datetime
+from functools import lru_cache
 
 
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from shop_bot.data_manager.remnawave_repository import get_setting
-from shop_bot.data_manager.database import get_button_configs
+from shop_bot.data_manager.database import get_button_configs, get_settings_generation
 
 logger = logging.getLogger(__name__)
 
@@ -890,10 +894,62 @@ def create_host_selection_keyboard(hosts: list, action: str) -> InlineKeyboardMa
     builder.adjust(1)
     return builder.as_markup()
 
+# Кнопка тарифа несёт в callback_data только короткий токен "buy_<token>": полная
+# строка buy_<host>_<plan>_<action>_<key> с длинным (или кириллическим) именем хоста
+# не влезает в 64 байта Telegram. Токен детерминирован, поэтому закешированные
+# клавиатуры остаются валидными; соответствие токен -> параметры хранится в памяти.
+_PLAN_TOKEN_TTL = 1800.0
+_PLAN_TOKEN_MAX = 10_000
+_PLAN_TOKENS: OrderedDict[str, tuple[float, tuple[str, int, str, int]]] = OrderedDict()
+
+
+def _plan_token(host_name: str, plan_id: int, action: str, key_id: int) -> str:
+    raw = f"{host_name}\x00{plan_id}\x00{action}\x00{key_id}".encode("utf-8")
+    return base64.urlsafe_b64encode(hashlib.blake2b(raw, digest_size=6).digest()).decode("ascii")
+
+
+def _register_plan_token(host_name: str, plan_id: int, action: str, key_id: int) -> str:
+    token = _plan_token(host_name, plan_id, action, key_id)
+    _PLAN_TOKENS[token] = (time.monotonic(), (host_name, int(plan_id), action, int(key_id or 0)))
+    _PLAN_TOKENS.move_to_end(token)
+    while len(_PLAN_TOKENS) > _PLAN_TOKEN_MAX:
+        _PLAN_TOKENS.popitem(last=False)
+    return token
+
+
+def resolve_plan_token(token: str) -> tuple[str, int, str, int] | None:
+    """(host_name, plan_id, action, key_id) по токену из кнопки тарифа или None, если он устарел."""
+    entry = _PLAN_TOKENS.get(token)
+    if entry is None:
+        return None
+    ts, params = entry
+    if time.monotonic() - ts >= _PLAN_TOKEN_TTL:
+        _PLAN_TOKENS.pop(token, None)
+        return None
+    return params
+
+
 def create_plans_keyboard(plans: list[dict], action: str, host_name: str, key_id: int = 0) -> InlineKeyboardMarkup:
+    # Клавиатура целиком определяется полями тарифов, поэтому кешируется по ним:
+    # после правки тарифа в админке ключ меняется сам
+    plans_key = tuple(
+        (p.get('plan_id'), p.get('plan_name'), p.get('months'), p.get('duration_days'), p.get('price'), p.get('metadata'))
+        for p in plans
+    )
+    for p in plans:
+        _register_plan_token(host_name, p['plan_id'], action, key_id)
+    return _plans_keyboard_cached(plans_key, action, host_name, key_id)
+
+
+@lru_cache(maxsize=512)
+def _plans_keyboard_cached(plans_key: tuple, action: str, host_name: str, key_id: int) -> InlineKeyboardMarkup:
+    plans = [
+        {'plan_id': pid, 'plan_name': name, 'months': months, 'duration_days': days, 'price': price, 'metadata': meta}
+        for pid, name, months, days, price, meta in plans_key
+    ]
     builder = InlineKeyboardBuilder()
     for plan in plans:
-        callback_data = f"buy_{host_name}_{plan['plan_id']}_{action}_{key_id}"
+        callback_data = f"buy_{_plan_token(host_name, plan['plan_id'], action, key_id)}"
 
         # Показываем только дни (duration_days, иначе months*30)
         days = 0
@@ -951,6 +1007,34 @@ def create_payment_method_keyboard(
     main_balance: float | None = None,
     price: float | None = None,
     promo_applied: bool = False,
+) -> InlineKeyboardMarkup:
+    # Кнопки зависят только от настроек, баланса и флага промокода (payment_methods,
+    # action, key_id и price в разметку не попадают). Кеш сбрасывается записью настроек и раз в 30 секунд
+    balance_label = None
+    if show_balance and main_balance is not None:
+        try:
+            balance_label = f"{main_balance:.0f}"
+        except Exception:
+            balance_label = None
+    return _payment_method_keyboard_cached(
+        get_settings_generation(),
+        int(time.monotonic() // _PAYMENT_KBD_TTL),
+        bool(show_balance),
+        balance_label,
+        bool(promo_applied),
+    )
+
+
+_PAYMENT_KBD_TTL = 30
+
+
+@lru_cache(maxsize=512)
+def _payment_method_keyboard_cached(
+    _settings_generation: int,
+    _ttl_bucket: int,
+    show_balance: bool,
+    balance_label: str | None,
+    promo_applied: bool,
 ) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
 
@@ -975,11 +1059,8 @@ def create_payment_method_keyboard(
 
     if show_balance:
         label = _label("payment_label_balance", "💼 Оплатить с баланса")
-        if main_balance is not None:
-            try:
-                label += f" ({main_balance:.0f} RUB)"
-            except Exception:
-                pass
+        if balance_label is not None:
+            label += f" ({balance_label} RUB)"
         builder.button(text=label, callback_data="pay_balance")
 
 
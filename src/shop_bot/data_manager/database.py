@@ -986,6 +986,7 @@ def create_host(name: str, url: str, user: str, passwd: str, inbound: int, subsc
                     (name, url, user, passwd, inbound)
                 )
             conn.commit()
+            invalidate_hosts_cache()
             logging.info(f"Успешно создан новый хост: {name}")
     except sqlite3.Error as e:
         logging.error(f"Ошибка при создании хоста '{name}': {e}")
@@ -1006,6 +1007,7 @@ def update_host_subscription_url(host_name: str, subscription_url: str | None) -
                 (subscription_url, host_name)
             )
             conn.commit()
+            invalidate_hosts_cache()
             return True
     except sqlite3.Error as e:
         logging.error(f"Не удалось обновить subscription_url для хоста '{host_name}': {e}")
@@ -1061,6 +1063,7 @@ def update_host_url(host_name: str, new_url: str) -> bool:
                 (new_url, host_name)
             )
             conn.commit()
+            invalidate_hosts_cache()
             return cursor.rowcount > 0
     except sqlite3.Error as e:
         logging.error(f"Не удалось обновить host_url для хоста '{host_name}': {e}")
@@ -1105,6 +1108,7 @@ def update_host_remnawave_settings(
             sql = f"UPDATE xui_hosts SET {', '.join(sets)} WHERE TRIM(host_name) = TRIM(?)"
             cursor.execute(sql, params)
             conn.commit()
+            invalidate_hosts_cache()
             return True
     except sqlite3.Error as e:
         logging.error(f"Не удалось обновить Remnawave-настройки для хоста '{host_name}': {e}")
@@ -1143,6 +1147,7 @@ def update_host_name(old_name: str, new_name: str) -> bool:
                 (new_name_n, old_name_n)
             )
             conn.commit()
+            invalidate_hosts_cache()
             return True
     except sqlite3.Error as e:
         logging.error(f"Не удалось переименовать хост с '{old_name}' на '{new_name}': {e}")
@@ -1156,6 +1161,7 @@ def delete_host(host_name: str):
             cursor.execute("DELETE FROM plans WHERE TRIM(host_name) = TRIM(?)", (host_name,))
             cursor.execute("DELETE FROM xui_hosts WHERE TRIM(host_name) = TRIM(?)", (host_name,))
             conn.commit()
+            invalidate_hosts_cache()
             logging.info(f"Хост '{host_name}' и его тарифы успешно удалены.")
     except sqlite3.Error as e:
         logging.error(f"Ошибка удаления хоста '{host_name}': {e}")
@@ -1209,6 +1215,7 @@ def update_host_ssh_settings(
                 ),
             )
             conn.commit()
+            invalidate_hosts_cache()
             return True
     except sqlite3.Error as e:
         logging.error(f"Не удалось обновить SSH-настройки для хоста '{host_name}': {e}")
@@ -1255,6 +1262,60 @@ def get_all_hosts() -> list[dict]:
         logging.error(f"Ошибка получения списка всех хостов: {e}")
         return []
 
+# Hosts and active plans are read on nearly every purchase/switch callback but change
+# only from the admin side; every write path below calls invalidate_hosts_cache().
+_HOSTS_CACHE_TTL = 60.0
+_HOSTS_CACHE: tuple[float, list[dict]] | None = None
+_ACTIVE_PLANS_CACHE: dict[str, tuple[float, list[dict]]] = {}
+_PLAN_BY_ID_CACHE: dict[int, tuple[float, dict | None]] = {}
+
+
+def get_all_hosts_cached() -> list[dict]:
+    """Same as get_all_hosts(), but served from a short-lived in-process cache."""
+    global _HOSTS_CACHE
+    now = time.monotonic()
+    cached = _HOSTS_CACHE
+    if cached is None or now - cached[0] >= _HOSTS_CACHE_TTL:
+        hosts = get_all_hosts()
+        if not hosts:
+            return hosts
+        cached = (now, hosts)
+        _HOSTS_CACHE = cached
+    return [dict(h) for h in cached[1]]
+
+
+def get_active_plans_for_host_cached(host_name: str) -> list[dict]:
+    """Same as get_active_plans_for_host(), but served from a short-lived in-process cache."""
+    key = normalize_host_name(host_name)
+    now = time.monotonic()
+    cached = _ACTIVE_PLANS_CACHE.get(key)
+    if cached is None or now - cached[0] >= _HOSTS_CACHE_TTL:
+        plans = get_active_plans_for_host(key)
+        cached = (now, plans)
+        _ACTIVE_PLANS_CACHE[key] = cached
+    return [dict(p) for p in cached[1]]
+
+
+def get_plan_by_id_cached(plan_id: int) -> dict | None:
+    """Same as get_plan_by_id(), but served from a short-lived in-process cache."""
+    try:
+        key = int(plan_id)
+    except (TypeError, ValueError):
+        return None
+    now = time.monotonic()
+    cached = _PLAN_BY_ID_CACHE.get(key)
+    if cached is None or now - cached[0] >= _HOSTS_CACHE_TTL:
+        cached = (now, get_plan_by_id(key))
+        _PLAN_BY_ID_CACHE[key] = cached
+    return dict(cached[1]) if cached[1] else None
+
+
+def invalidate_hosts_cache() -> None:
+    global _HOSTS_CACHE
+    _HOSTS_CACHE = None
+    _ACTIVE_PLANS_CACHE.clear()
+    _PLAN_BY_ID_CACHE.clear()
+
 def get_speedtests(host_name: str, limit: int = 20) -> list[dict]:
     """Получить последние результаты спидтестов по хосту (ssh/net), новые сверху."""
     try:
@@ -1781,6 +1842,50 @@ def get_setting(key: str) -> str | None:
         logging.error(f"Failed to get setting '{key}': {e}")
         return None
 
+# In-process snapshot of bot_settings: one SELECT serves every get_setting_cached()
+# call until the TTL expires or update_setting() invalidates it.
+_SETTINGS_SNAPSHOT: dict[str, str | None] | None = None
+_SETTINGS_SNAPSHOT_TS = 0.0
+_SETTINGS_SNAPSHOT_TTL = 5.0
+# Bumped on every settings write so derived caches know when to recompute.
+_SETTINGS_GENERATION = 0
+
+
+def _load_settings_snapshot() -> dict[str, str | None] | None:
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT key, value FROM bot_settings")
+            return {row[0]: row[1] for row in cursor.fetchall()}
+    except sqlite3.Error as e:
+        logging.error(f"Failed to load settings snapshot: {e}")
+        return None
+
+
+def get_setting_cached(key: str) -> str | None:
+    """Same as get_setting(), but served from a short-lived settings snapshot."""
+    global _SETTINGS_SNAPSHOT, _SETTINGS_SNAPSHOT_TS
+    now = time.monotonic()
+    snapshot = _SETTINGS_SNAPSHOT
+    if snapshot is None or now - _SETTINGS_SNAPSHOT_TS >= _SETTINGS_SNAPSHOT_TTL:
+        snapshot = _load_settings_snapshot()
+        if snapshot is None:
+            return get_setting(key)
+        _SETTINGS_SNAPSHOT, _SETTINGS_SNAPSHOT_TS = snapshot, now
+    return snapshot.get(key)
+
+
+def invalidate_settings_cache() -> None:
+    global _SETTINGS_SNAPSHOT, _SETTINGS_GENERATION
+    _SETTINGS_SNAPSHOT = None
+    _SETTINGS_GENERATION += 1
+
+
+def get_settings_generation() -> int:
+    """Counter that changes whenever settings are written in this process."""
+    return _SETTINGS_GENERATION
+
+
 def get_admin_ids() -> set[int]:
     """Возвращает множество ID администраторов из настроек.
     Поддерживает оба варианта: одиночный 'admin_telegram_id' и список 'admin_telegram_ids'
@@ -1788,13 +1893,13 @@ def get_admin_ids() -> set[int]:
     """
     ids: set[int] = set()
     try:
-        single = get_setting("admin_telegram_id")
+        single = get_setting_cached("admin_telegram_id")
         if single:
             try:
                 ids.add(int(single))
             except Exception:
                 pass
-        multi_raw = get_setting("admin_telegram_ids")
+        multi_raw = get_setting_cached("admin_telegram_ids")
         if multi_raw:
             s = (multi_raw or "").strip()
 
@@ -1920,6 +2025,39 @@ def create_payload_pending(payment_id: str, user_id: int, amount_rub, metadata)
         return False
 
 
+def update_pending_metadata(payment_id: str, patch: dict) -> bool:
+    """Merge `patch` into metadata of a pending payload in place (SQLite json_patch).
+
+    Cheaper than a second create_payload_pending when only a provider id has to be
+    attached. Keys with None values are skipped; paid rows are left untouched.
+    """
+    pid = (payment_id or "").strip()
+    patch = {k: v for k, v in (patch or {}).items() if v is not None}
+    if not pid or not patch:
+        return False
+
+    def _work():
+        with _connect_pending_db() as conn:
+            cursor = conn.cursor()
+            _ensure_pending_tables(cursor)
+            cursor.execute(
+                """
+                UPDATE pending_transactions
+                SET metadata = json_patch(COALESCE(NULLIF(metadata, ''), '{}'), ?),
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE payment_id = ? AND status = 'pending'
+                """,
+                (json.dumps(patch, ensure_ascii=False), pid),
+            )
+            return cursor.rowcount > 0
+
+    try:
+        return bool(_retry_sqlite(_work))
+    except sqlite3.Error as e:
+        logging.error(f"Failed to update pending metadata {pid}: {e}")
+        return False
+
+
 def _get_pending_metadata(payment_id: str) -> dict | None:
     pid = (payment_id or "").strip()
     if not pid:
@@ -2313,7 +2451,28 @@ def claim_processed_payment(payment_id: str) -> bool:
     except sqlite3.Error as e:
         logging.error(f"Failed to claim processed payment {pid}: {e}")
         return False
-        
+
+
+def is_payment_processed(payment_id: str) -> bool | None:
+    """Whether payment_id is already in processed_payments; None if the lookup failed."""
+    pid = (payment_id or "").strip()
+    if not pid:
+        return False
+
+    def _work():
+        with _connect_pending_db() as conn:
+            cursor = conn.cursor()
+            _ensure_processed_payments_table(cursor)
+            cursor.execute("SELECT 1 FROM processed_payments WHERE payment_id = ?", (pid,))
+            return cursor.fetchone() is not None
+
+    try:
+        return bool(_retry_sqlite(_work))
+    except sqlite3.Error as e:
+        logging.error(f"Failed to look up processed payment {pid}: {e}")
+        return None
+
+
 def get_referrals_for_user(user_id: int) -> list[dict]:
     """Возвращает список пользователей, которых пригласил данный user_id.
     Поля: telegram_id, username, registration_date, total_spent.
@@ -2443,6 +2602,7 @@ def update_setting(key: str, value: str):
             cursor = conn.cursor()
             cursor.execute("INSERT OR REPLACE INTO bot_settings (key, value) VALUES (?, ?)", (key, value))
             conn.commit()
+            invalidate_settings_cache()
             logging.info(f"Setting '{key}' updated.")
     except sqlite3.Error as e:
         logging.error(f"Failed to update setting '{key}': {e}")
@@ -2963,6 +3123,7 @@ def create_plan(host_name: str, plan_name: str, months: int | None, price: float
                 (host_name, plan_name, months, duration_days, price, traffic_limit_bytes, traffic_limit_strategy, hwid_device_limit)
             )
             conn.commit()
+            invalidate_hosts_cache()
             logging.info(f"Created new plan '{plan_name}' for host '{host_name}'.")
     except sqlite3.Error as e:
         logging.error(f"Failed to create plan for host '{host_name}': {e}")
@@ -3011,6 +3172,7 @@ def set_plan_active(plan_id: int, is_active: bool) -> bool:
                 (1 if is_active else 0, int(plan_id))
             )
             conn.commit()
+            invalidate_hosts_cache()
             return cursor.rowcount > 0
     except sqlite3.Error as e:
         logging.error(f"Failed to set plan active status for id {plan_id}: {e}")
@@ -3050,6 +3212,7 @@ def update_plan_metadata(plan_id: int, metadata: dict | None) -> bool:
             cursor = conn.cursor()
             cursor.execute("UPDATE plans SET metadata = ? WHERE plan_id = ?", (raw, int(plan_id)))
             conn.commit()
+            invalidate_hosts_cache()
             return cursor.rowcount > 0
     except sqlite3.Error as e:
         logging.error(f"Failed to update plan metadata for id {plan_id}: {e}")
@@ -3061,6 +3224,7 @@ def delete_plan(plan_id: int):
             cursor = conn.cursor()
             cursor.execute("DELETE FROM plans WHERE plan_id = ?", (plan_id,))
             conn.commit()
+            invalidate_hosts_cache()
             logging.info(f"Deleted plan with id {plan_id}.")
     except sqlite3.Error as e:
         logging.error(f"Failed to delete plan with id {plan_id}: {e}")
@@ -3086,6 +3250,7 @@ def update_plan(plan_id: int, plan_name: str, months: int | None, price: float,
             cursor = conn.cursor()
             cursor.execute(f"UPDATE plans SET {set_clause} WHERE plan_id = ?", values)
             conn.commit()
+            invalidate_hosts_cache()
             if cursor.rowcount == 0:
                 logging.warning(f"No plan updated for id {plan_id} (not found).")
                 return False
@@ -3715,6 +3880,29 @@ def update_key_fields(
     return _apply_key_updates(key_id, updates)
 
 
+def bulk_set_missing_from_server(key_ids: list[int], missing_from_server_at: str | None) -> int:
+    """Set/clear vpn_keys.missing_from_server_at for many keys in one transaction.
+
+    Returns the number of updated rows.
+    """
+    ids = [int(k) for k in (key_ids or []) if k]
+    if not ids:
+        return 0
+    placeholders = ", ".join("?" for _ in ids)
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"UPDATE vpn_keys SET missing_from_server_at = ?, updated_at = ? WHERE key_id IN ({placeholders})",
+                (missing_from_server_at, _now_str(), *ids),
+            )
+            conn.commit()
+            return cursor.rowcount
+    except sqlite3.Error as e:
+        logging.error("Failed to bulk update missing_from_server_at for keys %s: %s", ids, e)
+        return 0
+
+
 def delete_key_by_email(email: str) -> bool:
     lookup = _normalize_email(email) or email.strip()
     try:
@@ -3749,6 +3937,29 @@ def get_user_keys(user_id: int) -> list[dict]:
         return []
 
 
+def get_key_ordinal(user_id: int, key_id: int) -> int:
+    """1-based position of the key in get_user_keys(user_id) order (0 if not found)."""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                SELECT rn FROM (
+                    SELECT key_id, ROW_NUMBER() OVER (ORDER BY datetime(created_at) DESC, key_id DESC) AS rn
+                    FROM vpn_keys
+                    WHERE user_id = ?
+                )
+                WHERE key_id = ?
+                """,
+                (user_id, key_id),
+            )
+            row = cursor.fetchone()
+            return int(row[0]) if row else 0
+    except sqlite3.Error as e:
+        logging.error("Failed to get ordinal for key %s of user %s: %s", key_id, user_id, e)
+        return 0
+
+
 def get_key_by_id(key_id: int) -> dict | None:
     try:
         with sqlite3.connect(DB_FILE) as conn:
@@ -3762,6 +3973,14 @@ def get_key_by_id(key_id: int) -> dict | None:
         return None
 
 
+def get_key_with_plans(key_id: int) -> tuple[dict | None, list[dict]]:
+    """Return the key row and the active plans of its host (plans come from the in-process cache)."""
+    key = get_key_by_id(key_id)
+    if not key or not key.get("host_name"):
+        return key, []
+    return key, get_active_plans_for_host_cached(key["host_name"])
+
+
 def get_key_by_email(key_email: str) -> dict | None:
     lookup = _normalize_email(key_email) or key_email.strip()
     try:
@@ -4582,7 +4801,7 @@ def update_key_usage_monitor(
 def get_franchise_percent_default() -> float:
     """Получить процент комиссии франшизы из настроек."""
     try:
-        val = (get_setting('franchise_commission_percent') or '35.0').strip()
+        val = (get_setting_cached('franchise_commission_percent') or '35.0').strip()
         return float(val)
     except Exception:
         return 35.0
@@ -4591,7 +4810,7 @@ def get_franchise_percent_default() -> float:
 def get_franchise_min_withdraw() -> float:
     """Получить минимум для вывода франшизников из настроек."""
     try:
-        val = (get_setting('franchise_min_withdraw_rub') or '1500.0').strip()
+        val = (get_setting_cached('franchise_min_withdraw_rub') or '1500.0').strip()
         return float(val)
     except Exception:
         return 1500.0
@@ -4631,6 +4850,49 @@ def get_managed_bot(bot_id: int) -> dict | None:
         return None
 
 
+# Клоны меняются редко (создание/вкл-выкл), а (bot_id, владелец) нужны в каждом
+# партнёрском обработчике — держим короткий in-process кеш.
+_MANAGED_BOTS_CACHE_TTL = 60
+_FACTORY_ID_CACHE: dict[int, tuple[float, int]] = {}
+_MANAGED_BOT_CACHE: dict[int, tuple[float, dict | None]] = {}
+
+
+def resolve_factory_bot_id_cached(telegram_bot_user_id: int | None) -> int:
+    """Same as resolve_factory_bot_id(), but served from a short-lived cache."""
+    try:
+        tg_id = int(telegram_bot_user_id or 0)
+    except Exception:
+        return 0
+    if tg_id <= 0:
+        return 0
+    now = time.monotonic()
+    cached = _FACTORY_ID_CACHE.get(tg_id)
+    if cached is not None and now - cached[0] < _MANAGED_BOTS_CACHE_TTL:
+        return cached[1]
+    bot_id = resolve_factory_bot_id(tg_id)
+    _FACTORY_ID_CACHE[tg_id] = (now, bot_id)
+    return bot_id
+
+
+def get_managed_bot_cached(bot_id: int) -> dict | None:
+    """Same as get_managed_bot(), but served from a short-lived cache (returns a copy)."""
+    try:
+        bot_id_i = int(bot_id)
+    except Exception:
+        return None
+    now = time.monotonic()
+    cached = _MANAGED_BOT_CACHE.get(bot_id_i)
+    if cached is None or now - cached[0] >= _MANAGED_BOTS_CACHE_TTL:
+        cached = (now, get_managed_bot(bot_id_i))
+        _MANAGED_BOT_CACHE[bot_id_i] = cached
+    return dict(cached[1]) if cached[1] is not None else None
+
+
+def invalidate_managed_bots_cache() -> None:
+    _FACTORY_ID_CACHE.clear()
+    _MANAGED_BOT_CACHE.clear()
+
+
 def get_managed_bot_by_telegram_id(telegram_bot_user_id: int) -> dict | None:
     try:
         with sqlite3.connect(DB_FILE) as conn:
@@ -4695,6 +4957,7 @@ def create_managed_bot(
                     (token_s, (username or None), owner_id, ref_bot_id, bot_id),
                 )
                 conn.commit()
+                invalidate_managed_bots_cache()
                 return True, "Бот обновлён.", bot_id
 
             cur.execute(
@@ -4705,6 +4968,7 @@ def create_managed_bot(
                 (tg_bot_id, (username or None), token_s, owner_id, ref_bot_id),
             )
             conn.commit()
+            invalidate_managed_bots_cache()
             bot_id = int(cur.lastrowid)
             return True, "Бот создан.", bot_id
     except sqlite3.Error as e:
@@ -4890,6 +5154,49 @@ def list_partner_requisites(bot_id: int, owner_telegram_id: int) -> list[dict]:
         return []
 
 
+def get_bot_and_requisites(telegram_bot_user_id: int | None) -> tuple[int, int, list[dict]]:
+    """Return (bot_id, owner_telegram_id, requisites) for an active managed bot in one query.
+
+    Root bot or unknown id => (0, 0, []).
+    """
+    try:
+        tg_id = int(telegram_bot_user_id or 0)
+    except Exception:
+        return 0, 0, []
+    if tg_id <= 0:
+        return 0, 0, []
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            conn.row_factory = sqlite3.Row
+            cur = conn.cursor()
+            cur.execute(
+                "SELECT b.id AS b_id, b.owner_telegram_id AS b_owner, "
+                "r.id, r.bot_id, r.owner_telegram_id, r.bank, r.requisite_type, r.requisite_value, r.is_default, r.created_at "
+                "FROM managed_bots b "
+                "LEFT JOIN partner_payout_requisites r ON r.bot_id = b.id AND r.owner_telegram_id = b.owner_telegram_id "
+                "WHERE b.telegram_bot_user_id = ? AND COALESCE(b.is_active,1)=1 "
+                "ORDER BY r.is_default DESC, r.created_at DESC",
+                (tg_id,),
+            )
+            rows = cur.fetchall() or []
+    except Exception as e:
+        logger.error(f"get_bot_and_requisites failed: {e}")
+        return 0, 0, []
+    if not rows:
+        return 0, 0, []
+    bot_id = int(rows[0]["b_id"])
+    owner_id = int(rows[0]["b_owner"] or 0)
+    items = []
+    for row in rows:
+        if row["id"] is None:
+            continue
+        item = dict(row)
+        item.pop("b_id", None)
+        item.pop("b_owner", None)
+        items.append(item)
+    return bot_id, owner_id, items
+
+
 def get_default_partner_requisite(bot_id: int, owner_telegram_id: int) -> dict | None:
     """Return the default payout requisite for a partner, if any."""
     items = list_partner_requisites(bot_id, owner_telegram_id)
@@ -1,5 +1,6 @@
 import logging
 import sqlite3
+import time
 from contextvars import ContextVar
 from datetime import datetime
 from typing import Any
@@ -113,6 +114,14 @@ def get_key_by_id(key_id: int) -> dict | None:
     return database.get_key_by_id(key_id)
 
 
+def get_key_with_plans(key_id: int) -> tuple[dict | None, list[dict]]:
+    return database.get_key_with_plans(key_id)
+
+
+def get_key_ordinal(user_id: int, key_id: int) -> int:
+    return database.get_key_ordinal(user_id, key_id)
+
+
 def get_key_by_email(email: str) -> dict | None:
     return database.get_key_by_email(email)
 
@@ -297,6 +306,7 @@ _LEGACY_FORWARDERS = (
     "create_pending_transaction",
     "create_payload_pending",
     "claim_processed_payment",
+    "is_payment_processed",
     "create_plan",
     "create_support_ticket",
     "deduct_from_balance",
@@ -314,6 +324,8 @@ _LEGACY_FORWARDERS = (
     "get_admin_ids",
     "get_admin_stats",
     "get_all_hosts",
+    "get_all_hosts_cached",
+    "invalidate_hosts_cache",
     "get_all_keys",
     "get_all_settings",
     "get_all_tickets_count",
@@ -330,14 +342,19 @@ _LEGACY_FORWARDERS = (
     "get_open_tickets_count",
     "get_paginated_transactions",
     "get_plan_by_id",
+    "get_plan_by_id_cached",
     "get_plans_for_host",
     "get_active_plans_for_host",
+    "get_active_plans_for_host_cached",
     "get_recent_transactions",
     "get_referral_balance",
     "get_referral_balance_all",
     "get_referral_count",
     "get_referrals_for_user",
     "get_setting",
+    "get_setting_cached",
+    "invalidate_settings_cache",
+    "get_settings_generation",
     "get_speedtests",
     "get_ticket",
     "get_ticket_by_thread",
@@ -374,9 +391,11 @@ _LEGACY_FORWARDERS = (
     "update_host_url",
     "update_key_comment",
     "update_key_fields",
+    "bulk_set_missing_from_server",
     "update_key_host",
     "update_key_host_and_info",
     "update_key_status_from_server",
+    "update_pending_metadata",
     "update_plan",
     "set_plan_active",
     "update_setting",
@@ -399,6 +418,10 @@ _LEGACY_FORWARDERS = (
     # Franchise (managed clone bots)
     "resolve_factory_bot_id",
     "get_managed_bot",
+    "resolve_factory_bot_id_cached",
+    "get_managed_bot_cached",
+    "get_bot_and_requisites",
+    "invalidate_managed_bots_cache",
     "get_managed_bot_by_telegram_id",
     "list_active_managed_bots",
     "create_managed_bot",
@@ -419,7 +442,7 @@ for _name in _LEGACY_FORWARDERS:
 
 __all__ = sorted(
     name for name in globals()
-    if not name.startswith('_') and name not in {"logging", "sqlite3", "datetime", "Any", "database", "logger"}
+    if not name.startswith('_') and name not in {"logging", "sqlite3", "time", "datetime", "Any", "database", "logger"}
 )
 
 
@@ -632,6 +655,7 @@ def create_promo_code(
                 ),
             )
             conn.commit()
+            invalidate_promo_check_cache(code_s)
             return True
     except sqlite3.IntegrityError:
         return False
@@ -718,6 +742,40 @@ def check_promo_code_available(code: str, user_id: int) -> tuple[dict | None, st
         return promo, None
 
 
+# Кеш результатов check_promo_code_available: (CODE, user_id) -> (monotonic ts, результат).
+# Один и тот же промокод проверяется при каждой перерисовке экрана оплаты.
+_PROMO_CHECK_TTL = 60.0
+_PROMO_CHECK_CACHE: dict[tuple[str, int], tuple[float, tuple[dict | None, str | None]]] = {}
+
+
+def check_promo_code_available_cached(code: str, user_id: int) -> tuple[dict | None, str | None]:
+    """То же, что check_promo_code_available, но с кешем на _PROMO_CHECK_TTL секунд."""
+    code_s = (code or "").strip().upper()
+    try:
+        key = (code_s, int(user_id))
+    except (TypeError, ValueError):
+        return check_promo_code_available(code, user_id)
+    cached = _PROMO_CHECK_CACHE.get(key)
+    now = time.monotonic()
+    if cached is not None and now - cached[0] < _PROMO_CHECK_TTL:
+        promo, error = cached[1]
+        return (dict(promo) if promo is not None else None), error
+    result = check_promo_code_available(code_s, key[1])
+    _PROMO_CHECK_CACHE[key] = (now, result)
+    promo, error = result
+    return (dict(promo) if promo is not None else None), error
+
+
+def invalidate_promo_check_cache(code: str | None = None) -> None:
+    """Сбросить кеш проверок промокода (целиком или для одного кода)."""
+    if code is None:
+        _PROMO_CHECK_CACHE.clear()
+        return
+    code_s = (code or "").strip().upper()
+    for key in [k for k in _PROMO_CHECK_CACHE if k[0] == code_s]:
+        _PROMO_CHECK_CACHE.pop(key, None)
+
+
 def update_promo_code_status(code: str, *, is_active: bool | None = None) -> bool:
     code_s = (code or "").strip().upper()
     if not code_s:
@@ -734,6 +792,7 @@ def update_promo_code_status(code: str, *, is_active: bool | None = None) -> boo
         cursor = conn.cursor()
         cursor.execute(f"UPDATE promo_codes SET {', '.join(sets)} WHERE code = ?", params)
         conn.commit()
+        invalidate_promo_check_cache(code_s)
         return cursor.rowcount > 0
 
 
@@ -745,6 +804,7 @@ def delete_promo_code(code: str) -> bool:
         cursor = conn.cursor()
         cursor.execute("DELETE FROM promo_codes WHERE code = ?", (code_s,))
         conn.commit()
+        invalidate_promo_check_cache(code_s)
         return cursor.rowcount > 0
 
 
@@ -823,6 +883,7 @@ def redeem_promo_code(code: str, user_id: int, *, applied_amount: float, order_i
                 (code_s,),
             )
             conn.commit()
+            invalidate_promo_check_cache(code_s)
             promo["used_total"] = used_total + 1
             promo["usage_limit_per_user"] = usage_limit_per_user
             promo["user_used_count"] = per_user_count + 1
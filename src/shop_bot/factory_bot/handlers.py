@@ -26,10 +26,10 @@ def get_factory_router() -> Router:
     @r.message(CommandStart())
     async def start(message: Message, bot: Bot):
         # Determine internal bot_id for this running bot (0 for root)
-        bot_id = rw_repo.resolve_factory_bot_id(getattr(bot, "id", None))
+        bot_id = rw_repo.resolve_factory_bot_id_cached(getattr(bot, "id", None))
         owner_id = None
         if bot_id != 0:
-            info = rw_repo.get_managed_bot(bot_id)
+            info = rw_repo.get_managed_bot_cached(bot_id)
             owner_id = info.get("owner_telegram_id") if info else None
         show_cabinet = owner_id is not None and message.from_user and message.from_user.id == int(owner_id)
         text = (
@@ -41,10 +41,10 @@ def get_factory_router() -> Router:
 
     @r.callback_query(F.data == "factory_back")
     async def back(cb: CallbackQuery, bot: Bot):
-        bot_id = rw_repo.resolve_factory_bot_id(getattr(bot, "id", None))
+        bot_id = rw_repo.resolve_factory_bot_id_cached(getattr(bot, "id", None))
         owner_id = None
         if bot_id != 0:
-            info = rw_repo.get_managed_bot(bot_id)
+            info = rw_repo.get_managed_bot_cached(bot_id)
             owner_id = info.get("owner_telegram_id") if info else None
         show_cabinet = owner_id is not None and cb.from_user.id == int(owner_id)
         await cb.message.edit_text(
@@ -95,7 +95,7 @@ def get_factory_router() -> Router:
             await message.answer("Не получилось проверить токен. Убедись, что он правильный и бот не заблокирован.")
             return
 
-        referrer_bot_id = rw_repo.resolve_factory_bot_id(getattr(bot, "id", None))
+        referrer_bot_id = rw_repo.resolve_factory_bot_id_cached(getattr(bot, "id", None))
         ok, msg, new_bot_id = rw_repo.create_managed_bot(
             token=token,
             telegram_bot_user_id=me.id,
@@ -126,11 +126,11 @@ def get_factory_router() -> Router:
 
     @r.callback_query(F.data == "factory_cabinet")
     async def cabinet(cb: CallbackQuery, bot: Bot):
-        bot_id = rw_repo.resolve_factory_bot_id(getattr(bot, "id", None))
+        bot_id = rw_repo.resolve_factory_bot_id_cached(getattr(bot, "id", None))
         if bot_id == 0:
             await cb.answer("Кабинет доступен только во клонах.", show_alert=True)
             return
-        info = rw_repo.get_managed_bot(bot_id) or {}
+        info = rw_repo.get_managed_bot_cached(bot_id) or {}
         owner_id = int(info.get("owner_telegram_id") or 0)
         if cb.from_user.id != owner_id:
             await cb.answer("Кабинет доступен только владельцу.", show_alert=True)
@@ -150,8 +150,8 @@ def get_factory_router() -> Router:
 
     @r.callback_query(F.data == "factory_withdraw")
     async def withdraw_start(cb: CallbackQuery, bot: Bot, state: FSMContext):
-        bot_id = rw_repo.resolve_factory_bot_id(getattr(bot, "id", None))
-        info = rw_repo.get_managed_bot(bot_id) or {}
+        bot_id = rw_repo.resolve_factory_bot_id_cached(getattr(bot, "id", None))
+        info = rw_repo.get_managed_bot_cached(bot_id) or {}
         owner_id = int(info.get("owner_telegram_id") or 0)
         if cb.from_user.id != owner_id:
             await cb.answer("Только владелец.", show_alert=True)
@@ -166,8 +166,8 @@ def get_factory_router() -> Router:
 
     @r.message(FactoryStates.waiting_withdraw_amount)
     async def withdraw_amount(message: Message, bot: Bot, state: FSMContext):
-        bot_id = rw_repo.resolve_factory_bot_id(getattr(bot, "id", None))
-        info = rw_repo.get_managed_bot(bot_id) or {}
+        bot_id = rw_repo.resolve_factory_bot_id_cached(getattr(bot, "id", None))
+        info = rw_repo.get_managed_bot_cached(bot_id) or {}
         owner_id = int(info.get("owner_telegram_id") or 0)
         if message.from_user.id != owner_id:
             await message.answer("Только владелец.")
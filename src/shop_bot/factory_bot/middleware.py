@@ -18,7 +18,7 @@ class FactoryStatsMiddleware(BaseMiddleware):
             bot = data.get("bot")
             event_from = data.get("event_from_user")
             if bot and event_from:
-                bot_id = rw_repo.resolve_factory_bot_id(getattr(bot, "id", None))
+                bot_id = rw_repo.resolve_factory_bot_id_cached(getattr(bot, "id", None))
                 rw_repo.record_factory_activity(bot_id, event_from.id)
                 data["factory_bot_id"] = bot_id
                 token = rw_repo.set_current_factory_bot_id(bot_id)
@@ -6,6 +6,7 @@ from typing import Any
 from urllib.parse import quote
 import re
 import asyncio
+import threading
 
 import httpx
 
@@ -26,32 +27,56 @@ class RemnawaveAPIError(RuntimeError):
 # Shared HTTPX clients (connection pooling) to avoid creating a new TCP/TLS connection
 # for each Remnawave request. This noticeably reduces latency and eliminates a source
 # of "bot подвисает" on slow networks.
-_CLIENTS: dict[tuple[str, str, bool], httpx.AsyncClient] = {}
-_CLIENTS_LOCK = asyncio.Lock()
+# Pools are per event loop: payment fulfillment may fall back to asyncio.run() in a
+# worker thread, and an AsyncClient must not be shared across loops.
+_CLIENTS: dict[tuple[int, str, str, bool], tuple[asyncio.AbstractEventLoop, httpx.AsyncClient]] = {}
+_CLIENTS_LOCK = threading.Lock()
 
 # Reasonable defaults: do not let handlers hang too long on network hiccups.
 _DEFAULT_TIMEOUT = httpx.Timeout(20.0, connect=10.0, read=20.0, write=20.0, pool=20.0)
-_DEFAULT_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20)
+_DEFAULT_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=75.0)
 
 
 async def _get_shared_client(config: dict[str, Any]) -> httpx.AsyncClient:
     base_url = (config.get("base_url") or "").strip().rstrip("/")
     token = (config.get("token") or "").strip()
     is_local = bool(config.get("is_local"))
-    key = (base_url, token, is_local)
-    async with _CLIENTS_LOCK:
-        client = _CLIENTS.get(key)
-        if client is not None and not getattr(client, "is_closed", False):
-            return client
+    loop = asyncio.get_running_loop()
+    key = (id(loop), base_url, token, is_local)
+    # Fast path: the pooled client already exists, no need to serialize on the lock.
+    entry = _CLIENTS.get(key)
+    if entry is not None and entry[0] is loop and not entry[1].is_closed:
+        return entry[1]
+    # Creating a client does not await, so a plain lock is enough and works from any loop.
+    with _CLIENTS_LOCK:
+        entry = _CLIENTS.get(key)
+        if entry is not None and entry[0] is loop and not entry[1].is_closed:
+            return entry[1]
+        # Forget pools of loops that are gone (their connections died with the loop)
+        for stale_key in [k for k, (lp, _c) in _CLIENTS.items() if lp.is_closed()]:
+            _CLIENTS.pop(stale_key, None)
         client = httpx.AsyncClient(
             cookies=config.get("cookies") or {},
             timeout=_DEFAULT_TIMEOUT,
             limits=_DEFAULT_LIMITS,
         )
-        _CLIENTS[key] = client
+        _CLIENTS[key] = (loop, client)
         return client
 
 
+async def close_shared_clients() -> None:
+    """Close pooled HTTPX clients of the current event loop (called on application shutdown)."""
+    loop = asyncio.get_running_loop()
+    with _CLIENTS_LOCK:
+        owned = [k for k, (lp, _c) in _CLIENTS.items() if lp is loop]
+        clients = [_CLIENTS.pop(k)[1] for k in owned]
+    for client in clients:
+        try:
+            await client.aclose()
+        except Exception:
+            logger.debug("Remnawave: ошибка закрытия HTTP-клиента", exc_info=True)
+
+
 def _normalize_email_for_remnawave(email: str) -> str:
     """Normalize and validate email for Remnawave API.
 
@@ -794,6 +819,7 @@ async def create_or_update_key_on_host(
             'traffic_limit_strategy': user_payload.get('trafficLimitStrategy'),
             'expiry_timestamp_ms': expiry_ts_ms,
             'connection_string': subscription_url,
+            'user': user_payload,
         }
     except RemnawaveAPIError as exc:
         logger.error("Remnawave: ошибка create_or_update_key_on_host %s/%s: %s", host_name, email, exc)
@@ -806,7 +832,32 @@ async def create_or_update_key_on_host(
     return None
 
 
+# (loop, key_id, host_name) -> in-flight details request: parallel clicks on the same key share one Remnawave GET.
+# Keyed per loop: a task from another loop (e.g. the webhook's asyncio.run fallback) can't be awaited here.
+_DETAILS_INFLIGHT: dict[Any, asyncio.Task] = {}
+
+
 async def get_key_details_from_host(key_data: dict) -> dict | None:
+    key_id = key_data.get('key_id')
+    if key_id is None:
+        return await _fetch_key_details(key_data)
+    loop = asyncio.get_running_loop()
+    inflight_key = (id(loop), key_id, key_data.get('host_name'))
+    task = _DETAILS_INFLIGHT.get(inflight_key)
+    if task is None or task.get_loop() is not loop:
+        task = asyncio.create_task(_fetch_key_details(key_data))
+        _DETAILS_INFLIGHT[inflight_key] = task
+
+        def _forget(t: asyncio.Task, k=inflight_key) -> None:
+            if _DETAILS_INFLIGHT.get(k) is t:
+                _DETAILS_INFLIGHT.pop(k, None)
+
+        task.add_done_callback(_forget)
+    # shield: cancelling one caller must not cancel the request shared with the others
+    return await asyncio.shield(task)
+
+
+async def _fetch_key_details(key_data: dict) -> dict | None:
     email = key_data.get('key_email') or key_data.get('email')
     user_uuid = key_data.get('remnawave_user_uuid') or key_data.get('xui_client_uuid')
     try:
@@ -3671,6 +3671,7 @@ def create_webhook_app(bot_controller_instance):
                 new_val = 0 if current == 1 else 1
                 cur.execute("UPDATE managed_bots SET is_active = ? WHERE id = ?", (new_val, int(bot_id)))
                 conn.commit()
+            rw_repo.invalidate_managed_bots_cache()
         except Exception:
             flash('Не удалось обновить статус бота.', 'danger')
             return redirect(request.referrer or url_for('franchise_page'))